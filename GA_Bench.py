@@ -0,0 +1,309 @@
+"""Micro-benchmarks for the go-around detection primitives.
+
+Each benchmark runs one function from OS_Funcs or OS_Output on fixed
+synthetic inputs of several sizes. The results are saved per commit in a
+local results directory and compared against a baseline run, so that the
+speed of changes to the detection code can be checked before they are
+accepted. A function is flagged as a regression if it is slower than the
+baseline by more than a threshold.
+"""
+from traffic.core import Flight
+from datetime import datetime, timezone
+import OS_Airports as OSA
+import metar_parse as MEP
+import OS_Output as OSO
+import OS_Funcs as OSF
+import pandas as pd
+import numpy as np
+import subprocess
+import platform
+import click
+import json
+import time
+import glob
+import os
+
+
+# The number of points in each of the synthetic inputs
+sizes = [200, 2000, 20000]
+
+
+def make_track(npts, apt, seed=1):
+    """Make a synthetic approach, go-around and second approach.
+
+    The aircraft flies along the extended centreline of the first runway
+    of the airport, with some noise on every channel.
+    Inputs:
+        -   The number of points, one per second
+        -   An airport class, from OS_Airports.get_airport()
+        -   (optional) An int seed for the random number generator
+    Returns:
+        -   A dataframe in the same format as Traffic.data
+    """
+    rng = np.random.default_rng(seed)
+    rwy = apt.rwy_list[0]
+    # Distance along the approach, in multiples of the gate distance:
+    # descend to the runway, climb away, then come back
+    frac = np.linspace(0, 1, npts)
+    pos = np.where(frac < 0.4, 5. * (1 - frac / 0.4),
+                   np.where(frac < 0.6, 5. * (frac - 0.4) / 0.2,
+                            5. * (1 - (frac - 0.6) / 0.4)))
+    lats = rwy.rwy[0] + (rwy.gate[0] - rwy.rwy[0]) * pos
+    lons = rwy.rwy[1] + (rwy.gate[1] - rwy.rwy[1]) * pos
+    alts = 200. + 600. * pos + rng.normal(0, 10, npts)
+    gals = alts + 150. + rng.normal(0, 10, npts)
+    rocs = np.gradient(alts) * 60. + rng.normal(0, 50, npts)
+    hdgs = np.full(npts, rwy.mainhdg) + rng.normal(0, 1, npts)
+    spds = 140. + 20. * pos + rng.normal(0, 2, npts)
+    times = pd.date_range('2019-08-10 06:00', periods=npts, freq='1s')
+
+    df = pd.DataFrame({'timestamp': times,
+                       'last_position': times,
+                       'icao24': '800b7b',
+                       'callsign': 'AIC123',
+                       'latitude': lats + rng.normal(0, 1e-5, npts),
+                       'longitude': lons + rng.normal(0, 1e-5, npts),
+                       'altitude': alts,
+                       'geoaltitude': gals,
+                       'groundspeed': spds,
+                       'track': hdgs,
+                       'vertical_rate': rocs,
+                       'onground': alts < 220.})
+    OSF.add_projection(df, apt)
+    return df
+
+
+def make_labels(fd):
+    """Make flight phase labels from the vertical rate alone."""
+    rocs = fd['rocs']
+    return np.where(fd['ongd'], 'GND',
+                    np.where(rocs > 250, 'CL',
+                             np.where(rocs < -250, 'DE', 'LVL')))
+
+
+def make_metars(n_met, seed=1):
+    """Make a synthetic METAR table, with one report every 30 minutes."""
+    rng = np.random.default_rng(seed)
+    tab = np.zeros(n_met, dtype=MEP.table_dtype)
+    t_start = datetime(2019, 8, 10, tzinfo=timezone.utc).timestamp()
+    t_start = int(t_start) - 900 * n_met
+    tab['time'] = t_start + 1800 * np.arange(n_met)
+    tab['temp'] = rng.uniform(20, 35, n_met)
+    tab['dewp'] = tab['temp'] - rng.uniform(0, 8, n_met)
+    tab['pres'] = rng.uniform(995, 1015, n_met)
+    tab['vis'] = 10000.
+    tab['cld'] = 10000.
+    return MEP.metar_table(tab)
+
+
+def get_benchmarks(apt):
+    """Return the benchmarks, as a dict of name -> setup function.
+
+    Each setup function takes the input size, and returns the function to
+    time and the arguments to call it with.
+    """
+    cache = {}
+
+    def flight(npts):
+        # Share the inputs between benchmarks of the same size
+        if (npts not in cache):
+            fl = Flight(make_track(npts, apt))
+            fd = OSF.preproc_data(fl, False)
+            fd['labl'] = make_labels(fd)
+            cache[npts] = (fl, fd)
+        return cache[npts]
+
+    def get_future_time(npts):
+        fd = flight(npts)[1]
+        return OSF.get_future_time, (fd['time'], npts // 2, 60)
+
+    def check_ga(npts):
+        return OSF.check_ga, (flight(npts)[1], False)
+
+    def check_takeoff(npts):
+        return OSF.check_takeoff, (flight(npts)[1],)
+
+    def estimate_rwy(npts):
+        return OSF.estimate_rwy, (flight(npts)[1], apt.rwy_list, False)
+
+    def correct_baro(npts):
+        return OSF.correct_baro, (flight(npts)[1]['alts'], 28., 1005.)
+
+    def find_closest_metar(npts):
+        l_time = pd.Timestamp('2019-08-10 06:10', tz='UTC')
+        return OSF.find_closest_metar, (l_time, make_metars(npts))
+
+    def create_spline(npts):
+        return OSO.create_spline, (flight(npts)[1],)
+
+    def do_labels(npts):
+        return OSF.do_labels, (flight(npts)[1],)
+
+    def preproc_data(npts):
+        return OSF.preproc_data, (flight(npts)[0], False)
+
+    def make_yvals(npts):
+        dists = np.linspace(-10, 0, npts)
+        return OSO.make_yvals, (dists, apt.rwy_list[0].altm)
+
+    return {'get_future_time': get_future_time,
+            'check_ga': check_ga,
+            'check_takeoff': check_takeoff,
+            'estimate_rwy': estimate_rwy,
+            'correct_baro': correct_baro,
+            'find_closest_metar': find_closest_metar,
+            'create_spline': create_spline,
+            'do_labels': do_labels,
+            'preproc_data': preproc_data,
+            'make_yvals': make_yvals}
+
+
+def time_call(func, args, repeats=5, min_time=0.05):
+    """Time a function call, as the best of several repeats.
+
+    The number of calls in each repeat is increased until a repeat takes
+    at least 'min_time' seconds.
+    Inputs:
+        -   The function to time
+        -   A tuple of arguments to call it with
+        -   (optional) An int specifying the number of repeats
+        -   (optional) A float specifying the minimum time of a repeat
+    Returns:
+        -   The best time per call in seconds
+    """
+    n_call = 1
+    while True:
+        t_start = time.perf_counter()
+        for i in range(0, n_call):
+            func(*args)
+        t_run = time.perf_counter() - t_start
+        if (t_run >= min_time):
+            break
+        n_call *= 10
+    best = t_run / n_call
+    for i in range(1, repeats):
+        t_start = time.perf_counter()
+        for j in range(0, n_call):
+            func(*args)
+        best = min(best, (time.perf_counter() - t_start) / n_call)
+    return best
+
+
+def get_commit():
+    """Return the current commit hash, with '-dirty' if there are changes."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short',
+                                          'HEAD'], text=True).strip()
+        diff = subprocess.check_output(['git', 'status', '--porcelain',
+                                        '--untracked-files=no'], text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    if (len(diff.strip()) > 0):
+        commit = commit + '-dirty'
+    return commit
+
+
+def find_baseline(resdir, commit, baseline):
+    """Find the results file to compare against.
+
+    Inputs:
+        -   The results directory
+        -   The commit being benchmarked
+        -   The baseline commit, or 'previous' for the most recent results
+            from any other commit
+    Returns:
+        -   The results filename, or None if there is no baseline
+    """
+    if (baseline != 'previous'):
+        inf = os.path.join(resdir, baseline + '.json')
+        return inf if os.path.exists(inf) else None
+    files = [inf for inf in glob.glob(os.path.join(resdir, '*.json'))
+             if os.path.basename(inf) != commit + '.json']
+    if (len(files) == 0):
+        return None
+    return max(files, key=os.path.getmtime)
+
+
+def compare(res, base, thresh):
+    """Compare results against a baseline.
+
+    Inputs:
+        -   A dict of benchmark key -> time in seconds
+        -   A dict of baseline benchmark key -> time in seconds
+        -   A float giving the fractional slow-down counted as a regression
+    Returns:
+        -   A list of (key, baseline time, time, ratio) for each regression
+        -   A list of strings, one line per benchmark
+    """
+    regs = []
+    lines = []
+    for key in res:
+        if (key not in base):
+            lines.append('%-32s %12.3e %12s' % (key, res[key], 'new'))
+            continue
+        ratio = res[key] / base[key]
+        flag = ''
+        if (ratio > 1. + thresh):
+            flag = '  <-- REGRESSION'
+            regs.append((key, base[key], res[key], ratio))
+        lines.append('%-32s %12.3e %12.3e %7.2fx%s' %
+                     (key, res[key], base[key], ratio, flag))
+    return regs, lines
+
+
+@click.command()
+@click.option('--airport', default='VABB')
+@click.option('--resdir', default='BENCH_RESULTS/')
+@click.option('--baseline', default='previous',
+              help="Commit to compare against, default is the latest run")
+@click.option('--thresh', default=0.15,
+              help="Fractional slow-down that counts as a regression")
+@click.option('--only', multiple=True, help="Only run these benchmarks")
+@click.option('--repeats', default=5)
+def main(airport, resdir, baseline, thresh, only, repeats):
+    """Run the benchmarks, save the results and check for regressions."""
+    apt = OSA.get_airport(airport)
+    benches = get_benchmarks(apt)
+    if (len(only) > 0):
+        benches = {name: benches[name] for name in only}
+
+    res = {}
+    for name in benches:
+        for npts in sizes:
+            func, args = benches[name](npts)
+            key = name + '@' + str(npts)
+            res[key] = time_call(func, args, repeats)
+            print('%-32s %12.3e s' % (key, res[key]))
+
+    commit = get_commit()
+    os.makedirs(resdir, exist_ok=True)
+    basef = find_baseline(resdir, commit, baseline)
+
+    outf = os.path.join(resdir, commit + '.json')
+    with open(outf, 'w') as fid:
+        json.dump({'commit': commit,
+                   'date': datetime.now(timezone.utc).isoformat(),
+                   'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'machine': platform.node(),
+                   'results': res}, fid, indent=1)
+    print("Saved results to", outf)
+
+    if (basef is None):
+        print("No baseline to compare against")
+        return
+    with open(basef, 'r') as fid:
+        base = json.load(fid)
+    regs, lines = compare(res, base['results'], thresh)
+    print("Compared with", base['commit'], "from", base['date'])
+    print('%-32s %12s %12s %8s' % ('Benchmark', 'Time', 'Baseline', 'Ratio'))
+    for line in lines:
+        print(line)
+    if (len(regs) > 0):
+        print(len(regs), "benchmarks are slower by more than",
+              str(int(thresh * 100)) + '%')
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
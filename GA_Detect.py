@@ -1,10 +1,10 @@
 """A script to process OpenSky ADS-B data in an attempt to detect go-around events at an airport."""
-from traffic.core import Traffic
-from datetime import timedelta
-import multiprocessing as mp
-from OS_Airports import VABB
-import OS_Funcs as OSF
-import glob
+import OS_Aggregate as OSAG
+import OS_Airports as OSA
+import OS_Detect as OSD
+import OS_Metrics as OSM
+import OS_Results as OSR
+import OS_Stats as OSS
 
 
 def main(start_n, fidder, do_write):
@@ -16,29 +16,13 @@ def main(start_n, fidder, do_write):
     do_write -- boolean flag specifying whether to output data to textfile
 
     """
-    # Total number of aircraft seen
-    tot_n_ac = 0
-
-    # Of which go-arounds
-    tot_n_ga = 0
-
     top_dir = '/gf2/eodg/SRP002_PROUD_ADSBREP/GO_AROUNDS/VABB/'
     # indir stores the opensky data
     indir = top_dir + 'INDATA/'
 
-    # odir_nm stores plots for normal landings
-    odir_pl_nm = top_dir + 'OUT_PLOT/NORM/'
-
-    # odir_ga stores plots for detected go-arounds
-    odir_pl_ga = top_dir + 'OUT_PLOT/PSGA/'
-
-    # odir_nm stores plots for normal landings
-    odir_da_nm = top_dir + 'OUT_DATA/NORM/'
-
-    # odir_ga stores plots for detected go-arounds
-    odir_da_ga = top_dir + 'OUT_DATA/PSGA/'
-
-    odirs = [odir_pl_nm, odir_pl_ga, odir_da_nm, odir_da_ga]
+    # Plots and data for normal landings and go-arounds are saved in the
+    # OUT_PLOT/NORM, OUT_PLOT/PSGA, OUT_DATA/NORM and OUT_DATA/PSGA
+    # subdirectories of top_dir
 
     # Output filenames for saving data about go-arounds
     out_file_ga = 'GA_MET_NEW.csv'
@@ -47,6 +31,9 @@ def main(start_n, fidder, do_write):
 
     t_frmt = "%Y/%m/%d %H:%M:%S"
 
+    # The airport, and hence runways, to check for landings
+    airport = OSA.get_airport('VABB')
+
     # File to save met info for g/a flights
     if (do_write):
         metfid = open(out_file_ga, 'w')
@@ -59,149 +46,154 @@ def main(start_n, fidder, do_write):
                       hdgvar, latvar, lonvar, gspvar, \
                       Temp, Dewp, Wind_Spd, Wind_Gust, Wind_Dir,Cld_Base,\
                       CB, Vis, Pressure\n')
-    files = []
-    files = glob.glob(indir+'**.pkl')
-    files.sort()
-
-    fli_len = len(files)
-
-    colormap = {'GND': 'black', 'CL': 'green', 'CR': 'blue',
-                'DE': 'orange', 'LVL': 'purple', 'NA': 'red'}
 
-    # Number of files to open in one go
+    # Maximum number of files to open in one go, batches are also limited
+    # to about batch_mb of data (see OS_Consts)
     n_files_proc = 55
 
     pool_proc = 100
 
-    f_data = []
-    pool = mp.Pool(processes=pool_proc)
-
-    for main_count in range(start_n, fli_len, n_files_proc):
-        print("Processing batch starting with "
-              + str(main_count + 1).zfill(5) + " of "
-              + str(fli_len).zfill(5))
-        fidder.write("Processing batch starting with "
-                     + str(main_count + 1).zfill(5) + " of "
-                     + str(fli_len).zfill(5) + '\n')
-
-        p_list = []
-        # First we load several files at once
-        for j in range(0, n_files_proc):
-            if (main_count+j < fli_len):
-                p_list.append(pool.apply_async(OSF.get_flight,
-                                               args=(files[main_count+j],)))
-
-        for p in p_list:
-            t_res = p.get()
-            for fli in t_res:
-                f_data.append(fli)
-        if(len(f_data) < 1):
-            continue
-        traf_arr = Traffic.from_flights(f_data)
-        p_list = []
-        f_data = []
-        # Extend array end time if there's only one flight, else processing
-        # will fail as we check to ensure latest flight is > 5 mins from end
-        if (len(traf_arr) == 1):
-            end_time = traf_arr.end_time + timedelta(minutes=10)
-            print("Extending timespan due to single aircraft")
-        else:
-            end_time = traf_arr.end_time
-
-        # Now we process the results
-        for flight in traf_arr:
-            if (flight.stop + timedelta(minutes=5) < end_time):
-                p_list.append(pool.apply_async(OSF.proc_fl,
-                                               args=(flight,
-                                                     VABB.rwy_list,
-                                                     odirs,
-                                                     colormap,
-                                                     True,
-                                                     False,)))
-            else:
-                f_data.append(flight)
-
-        for p in p_list:
-            t_res = p.get()
-            if (t_res != -1):
-                tot_n_ac += 1
-                # If there's a go-around, this will be True
-                if (t_res[0]):
-                    if (do_write):
-                        metfid.write(t_res[1] + ',' + t_res[2] + ',')
-                        metfid.write(t_res[3].strftime(t_frmt) + ',')
-                        metfid.write(t_res[4].strftime(t_frmt) + ',')
-                        metfid.write(t_res[5] + ',')
-                        if (t_res[6] < 0):
-                            t_res[6] = 360 + t_res[6]
-                        metfid.write(str(t_res[6]) + ',')
-                        metfid.write(str(t_res[7]) + ',')
-                        metfid.write(str(t_res[8]) + ',')
-                        metfid.write(str(t_res[9]) + ',')
-                        metfid.write(str(t_res[10]) + ',')
-                        metfid.write(str(t_res[11]) + ',')
-                        metfid.write(str(t_res[12]) + ',')
-                        metfid.write(str(t_res[13]) + ',')
-                        metfid.write(str(t_res[14]) + ',')
-                        metfid.write(str(t_res[15]) + ',')
-                        metfid.write(str(t_res[16].temp) + ',')
-                        metfid.write(str(t_res[16].dewp) + ',')
-                        metfid.write(str(t_res[16].w_s) + ',')
-                        metfid.write(str(t_res[16].w_g) + ',')
-                        metfid.write(str(t_res[16].w_d) + ',')
-                        metfid.write(str(t_res[16].cld) + ',')
-                        if t_res[16].cb:
-                            metfid.write('1,')
-                        else:
-                            metfid.write('0,')
-                        metfid.write(str(t_res[16].vis) + ',')
-                        metfid.write(str(t_res[16].pres) + '\n')
-                    tot_n_ga += 1
-                # Otherwise, do the following (doesn't save g/a location etc).
+    # Whether to plot every flight as it is processed. Plots can instead be
+    # made on request from the saved data using GA_View.py
+    do_plot = False
+
+    # Set this to a filename prefix to log the details of every event for
+    # every flight, one file per worker. Counts are always collected.
+    fl_log = None
+
+    # Live metrics, in the Prometheus text format. Set metrics_file to a
+    # filename to rewrite it every metrics_int seconds, and/or metrics_port
+    # to serve the metrics at http://127.0.0.1:<port>/
+    metrics_file = 'GA_METRICS.prom'
+    metrics_port = None
+    metrics_int = 10.
+
+    # Flights or files that time out, crash a worker or raise an error are
+    # listed in this file along with the traceback, see OS_Supervise
+    q_file = 'GA_QUARANTINE.jsonl'
+
+    # Counts and statistics per runway and hour are added to this store
+    # after every batch, see OS_Aggregate. Flights already in the store are
+    # not added again. Set to None to disable.
+    agg_file = 'GA_AGG.npz'
+
+    # Every landing and go-around is also saved to this database, see
+    # OS_Results. Re-processed flights replace their earlier entries.
+    res_db = 'GA_RESULTS.sqlite'
+
+    # Set to True to keep running after the existing files are processed,
+    # and process new files in indir as they are downloaded. Files that
+    # have been processed are listed in watch_state so that a restart
+    # carries on from where it stopped.
+    do_watch = False
+    watch_state = 'GA_WATCH.json'
+
+    cfg = OSD.config(indir, outdir=top_dir, n_files_proc=n_files_proc,
+                     pool_proc=pool_proc, do_plot=do_plot, fl_log=fl_log,
+                     q_file=q_file, start_n=start_n, fidder=fidder)
+    tally = OSS.tally()
+    mets = OSM.metrics(pool_proc)
+    mets.start(metrics_file, metrics_port, metrics_int)
+
+    store = None
+    if (agg_file is not None):
+        store = OSAG.agg_store.load(agg_file)
+    conn = None
+    if (res_db is not None):
+        conn = OSR.open_db(res_db)
+
+    def on_batch(dets):
+        if (store is not None):
+            store.add_batch(dets, airport.icao_name)
+            store.save(agg_file)
+        if (conn is not None):
+            OSR.save_batch(conn, dets, airport.icao_name)
+
+    if (do_watch):
+        dets = OSD.watch(airport, cfg, tally=tally, mets=mets,
+                         on_batch=on_batch, state_file=watch_state)
+    else:
+        dets = OSD.detect(airport, cfg=cfg, tally=tally, mets=mets,
+                          on_batch=on_batch)
+    for det in dets:
+        # If there's a go-around, this will be True
+        if (det.is_ga):
+            if (do_write):
+                metfid.write(det.icao24 + ',' + det.callsign + ',')
+                metfid.write(det.l_time.strftime(t_frmt) + ',')
+                metfid.write(det.ga_time.strftime(t_frmt) + ',')
+                metfid.write(det.rwy + ',')
+                metfid.write(str(det.hdg) + ',')
+                metfid.write(str(det.alt) + ',')
+                metfid.write(str(det.lat) + ',')
+                metfid.write(str(det.lon) + ',')
+                metfid.write(str(det.gapt) + ',')
+                metfid.write(str(det.rocvar) + ',')
+                metfid.write(str(det.hdgvar) + ',')
+                metfid.write(str(det.latvar) + ',')
+                metfid.write(str(det.lonvar) + ',')
+                metfid.write(str(det.gspvar) + ',')
+                metfid.write(str(det.metar.temp) + ',')
+                metfid.write(str(det.metar.dewp) + ',')
+                metfid.write(str(det.metar.w_s) + ',')
+                metfid.write(str(det.metar.w_g) + ',')
+                metfid.write(str(det.metar.w_d) + ',')
+                metfid.write(str(det.metar.cld) + ',')
+                if det.metar.cb:
+                    metfid.write('1,')
                 else:
-                    if (do_write):
-                        nogfid.write(t_res[1] + ',' + t_res[2] + ',')
-                        nogfid.write(t_res[3].strftime(t_frmt) + ',')
-                        nogfid.write(t_res[4].strftime(t_frmt) + ',')
-                        nogfid.write(t_res[5] + ',')
-                        nogfid.write(str(t_res[10]) + ',')
-                        nogfid.write(str(t_res[11]) + ',')
-                        nogfid.write(str(t_res[12]) + ',')
-                        nogfid.write(str(t_res[13]) + ',')
-                        nogfid.write(str(t_res[14]) + ',')
-                        nogfid.write(str(t_res[15]) + ',')
-                        try:
-                            outstr = str(t_res[16].temp) + ','
-                            outstr = outstr + str(t_res[16].dewp) + ','
-                            outstr = outstr + str(t_res[16].w_s) + ','
-                            outstr = outstr + str(t_res[16].w_g) + ','
-                            outstr = outstr + str(t_res[16].w_d) + ','
-                            outstr = outstr + str(t_res[16].cld) + ','
-                            if t_res[16].cb:
-                                outstr = outstr + '1,'
-                            else:
-                                outstr = outstr + '0,'
-                            outstr = outstr + str(t_res[16].vis) + ','
-                            outstr = outstr + str(t_res[16].pres)
-                        except Exception as e:
-                            print("No METAR data for this flight")
-                            outstr = ''
-                        nogfid.write(outstr + '\n')
-
-        print("\t-\tHave processed " + str(tot_n_ac) +
-              " aircraft. Have seen " + str(tot_n_ga) + " go-arounds.")
+                    metfid.write('0,')
+                metfid.write(str(det.metar.vis) + ',')
+                metfid.write(str(det.metar.pres) + '\n')
+        # Otherwise, do the following (doesn't save g/a location etc).
+        else:
+            if (do_write):
+                nogfid.write(det.icao24 + ',' + det.callsign + ',')
+                nogfid.write(det.l_time.strftime(t_frmt) + ',')
+                nogfid.write(det.ga_time.strftime(t_frmt) + ',')
+                nogfid.write(det.rwy + ',')
+                nogfid.write(str(det.gapt) + ',')
+                nogfid.write(str(det.rocvar) + ',')
+                nogfid.write(str(det.hdgvar) + ',')
+                nogfid.write(str(det.latvar) + ',')
+                nogfid.write(str(det.lonvar) + ',')
+                nogfid.write(str(det.gspvar) + ',')
+                try:
+                    outstr = str(det.metar.temp) + ','
+                    outstr = outstr + str(det.metar.dewp) + ','
+                    outstr = outstr + str(det.metar.w_s) + ','
+                    outstr = outstr + str(det.metar.w_g) + ','
+                    outstr = outstr + str(det.metar.w_d) + ','
+                    outstr = outstr + str(det.metar.cld) + ','
+                    if det.metar.cb:
+                        outstr = outstr + '1,'
+                    else:
+                        outstr = outstr + '0,'
+                    outstr = outstr + str(det.metar.vis) + ','
+                    outstr = outstr + str(det.metar.pres)
+                except Exception as e:
+                    print("No METAR data for this flight")
+                    outstr = ''
+                nogfid.write(outstr + '\n')
+
+    print(tally.report())
+    fidder.write(tally.report())
+    mets.stop()
+    if (conn is not None):
+        conn.close()
 
     if (do_write):
         metfid.close()
         nogfid.close()
 
 
-# Use this to start processing from a given file number.
-# Can be helpful if processing fails at some point.
-init_num = 0
+if __name__ == '__main__':
+    # Use this to start processing from a given file number.
+    # Can be helpful if processing fails at some point.
+    init_num = 0
 
-fid = open('/home/proud/Desktop/log.log', 'w')
+    fid = open('/home/proud/Desktop/log.log', 'w')
 
-main(init_num, fid, False)
+    main(init_num, fid, False)
 
-fid.close()
+    fid.close()
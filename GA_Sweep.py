@@ -0,0 +1,226 @@
+"""Sweep the go-around detection thresholds over a grid of values.
+
+The slow part of detection (loading, cleaning, resampling, labelling and
+altitude correction) does not depend on the thresholds in OS_Consts, so it
+is done once and the results cached on disk. Every combination of the
+requested thresholds is then evaluated on the cached flights in parallel,
+and a table of go-around counts and flagged flights is written out.
+"""
+from datetime import timedelta
+import OS_Supervise as OSV
+import OS_Airports as OSA
+import OS_Detect as OSD
+import OS_Consts as CNS
+import OS_Funcs as OSF
+import itertools
+import pathlib
+import pickle
+import click
+import glob
+import os
+
+
+# The thresholds that can be swept
+sweep_params = ['alt_thresh', 'vrt_thresh', 'ga_tcheck', 'ga_st_alt_t',
+                'gate_alt', 'gate_roc', 'gate_dist']
+
+
+def prep_cached(flight):
+    """Prepare a single flight for the sweep.
+
+    Input:
+        -   A 'traffic' flight object
+    Returns:
+        -   The flight data and resampled flight data, or -1 if unsuitable
+    """
+    t_res = OSF.prep_fl(flight, False)
+    if (t_res == -1):
+        return -1
+    fd, fd2 = t_res
+    OSF.baro_correct_fl(fd)
+    return fd, fd2
+
+
+def build_cache(files, cachedir, n_files_proc, pool, apt):
+    """Preprocess all input files and save the flights into a cache.
+
+    One cache file is written per batch of input files. Batches that are
+    already cached are not loaded again, apart from the batch before each
+    missing one, which is loaded for the flights that it carries over.
+    Inputs:
+        -   A sorted list of input filenames
+        -   A string specifying the cache directory
+        -   An int specifying the maximum number of files in each batch
+        -   A pool of workers, from OS_Supervise.supervisor()
+        -   An airport class, from OS_Airports.get_airport()
+    Returns:
+        -   A sorted list of cache filenames
+    """
+    pathlib.Path(cachedir).mkdir(parents=True, exist_ok=True)
+    # Batches are sized by their data, so name each cache file by the
+    # range of input files that it holds
+    plan = OSF.plan_batches(files, 0, n_files_proc)
+    outfs = {i: os.path.join(cachedir, 'SWP_' + str(i).zfill(6) + '_' +
+                             str(j).zfill(6) + '.pkl') for i, j in plan}
+    missing = [not os.path.exists(outfs[i]) for i, j in plan]
+    # Flights near the end of a batch are carried into the next one, so
+    # the batch before a missing one must be loaded too
+    need = [missing[k] or (k + 1 < len(plan) and missing[k + 1])
+            for k in range(0, len(plan))]
+    runs = []
+    for k in range(0, len(plan)):
+        if (not need[k]):
+            continue
+        if (k > 0 and need[k - 1]):
+            runs[-1].append(plan[k])
+        else:
+            runs.append([plan[k]])
+
+    for run in runs:
+        batches = ((i, files[i:j]) for i, j in run)
+        for main_count, flights, srcs in OSF.get_batches(files, 0,
+                                                         n_files_proc, pool,
+                                                         apt,
+                                                         batches=batches):
+            outf = outfs[main_count]
+            if (os.path.exists(outf)):
+                continue
+            _cache_batch(flights, srcs, outf, pool)
+
+    return sorted(glob.glob(os.path.join(cachedir, 'SWP_*_*.pkl')))
+
+
+def _cache_batch(flights, srcs, outf, pool):
+    """Preprocess the flights in one batch and save them to a cache file."""
+    tasks = [((flight.icao24, flight.callsign,
+               srcs.get(flight.flight_id)), (flight,))
+             for flight in flights]
+    costs = [OSF.flight_cost(flight) for flight in flights]
+    fds = []
+    for key, t_res in pool.run(prep_cached, tasks, costs=costs):
+        if (t_res != -1):
+            fds.append(t_res)
+    with open(outf + '.tmp', 'wb') as fid:
+        pickle.dump(fds, fid, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(outf + '.tmp', outf)
+
+
+def sweep_file(inf, rwy_list, combos):
+    """Evaluate every threshold combination on one cache file.
+
+    Inputs:
+        -   A cache filename, as written by build_cache()
+        -   A list of runways to check, defined in OS_Airports
+        -   A list of dicts, each mapping threshold name -> value
+    Returns:
+        -   A list, one per combination, of:
+            -   Number of flights in the file
+            -   Number of flights with a runway found
+            -   A list of (icao24, callsign, g/a time, runway) for each
+                flight flagged as a go-around
+    """
+    with open(inf, 'rb') as fid:
+        fds = pickle.load(fid)
+
+    defaults = {param: getattr(CNS, param) for param in sweep_params}
+    results = []
+    for combo in combos:
+        for param in sweep_params:
+            setattr(CNS, param, combo.get(param, defaults[param]))
+        n_rwy = 0
+        flagged = []
+        for fd, fd2 in fds:
+            rwy, posser = OSF.estimate_rwy(fd2, rwy_list, False)
+            if (rwy is not None):
+                n_rwy += 1
+            # check_ga() can modify the altitudes, so work on a copy
+            fdc = fd.copy()
+            ga_flag, gapt = OSF.check_ga(fdc, False)
+            if (ga_flag):
+                ga_time = fd['strt'] + timedelta(seconds=int(fd['time'][gapt]))
+                flagged.append((fd['ic24'], fd['call'], ga_time,
+                                'None' if rwy is None else rwy.name))
+        results.append((len(fds), n_rwy, flagged))
+    for param in sweep_params:
+        setattr(CNS, param, defaults[param])
+
+    return results
+
+
+def parse_grid(grid):
+    """Convert grid options into a list of threshold combinations.
+
+    Input:
+        -   A list of strings, each of the form 'name=val1,val2,...'
+    Returns:
+        -   A list of dicts, each mapping threshold name -> value
+    """
+    names = []
+    values = []
+    for item in grid:
+        name, vals = item.split('=')
+        name = name.strip()
+        if (name not in sweep_params):
+            raise click.BadParameter("Cannot sweep " + name + ", choose from "
+                                     + ', '.join(sweep_params))
+        names.append(name)
+        values.append([float(val) for val in vals.split(',')])
+    return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+
+@click.command()
+@click.option('--airport', default='VABB')
+@click.option('--indir', default='INDATA/')
+@click.option('--cachedir', default='SWEEP_CACHE/')
+@click.option('--outfile', default='GA_SWEEP.csv')
+@click.option('--grid', multiple=True,
+              help="A threshold and its values, i.e: alt_thresh=400,500,600")
+@click.option('--n-files', default=55)
+@click.option('--n-jobs', default=8)
+def main(airport, indir, cachedir, outfile, grid, n_files, n_jobs):
+    """Build the cache if needed, then run the sweep."""
+    combos = parse_grid(grid)
+    if (len(combos) == 0):
+        combos = [{}]
+    apt = OSA.get_airport(airport)
+
+    files = OSD.list_files(indir)
+
+    OSF.use_metars(apt.metar_file)
+    OSF.get_metar_table()
+    pool = OSV.supervisor(n_jobs, initializer=OSF.init_worker,
+                          initargs=(apt.metar_file,),
+                          preload=[apt.icao_name])
+    cfiles = build_cache(files, cachedir, n_files, pool, apt)
+    print("Sweeping", len(combos), "combinations over",
+          len(cfiles), "cached batches")
+
+    tasks = [((None, None, inf), (inf, apt.rwy_list, combos))
+             for inf in cfiles]
+    costs = [OSF.file_mb(inf) for inf in cfiles]
+    f_res = [res for key, res in pool.run(sweep_file, tasks,
+                                          CNS.task_timeout * len(combos),
+                                          costs)]
+    pool.close()
+
+    t_frmt = "%Y/%m/%d %H:%M:%S"
+    flagfile = os.path.splitext(outfile)[0] + '_FLAGGED.csv'
+    with open(outfile, 'w') as fid, open(flagfile, 'w') as ffid:
+        fid.write('Combo, ' + ', '.join(sweep_params) +
+                  ', N_Flights, N_Runway, N_GA\n')
+        ffid.write('Combo, ICAO24, Callsign, GA_Time, Runway\n')
+        for i, combo in enumerate(combos):
+            n_fl = sum(res[i][0] for res in f_res)
+            n_rwy = sum(res[i][1] for res in f_res)
+            flagged = [fl for res in f_res for fl in res[i][2]]
+            vals = [str(combo.get(param, getattr(CNS, param)))
+                    for param in sweep_params]
+            fid.write(str(i) + ',' + ','.join(vals) + ',' + str(n_fl) + ','
+                      + str(n_rwy) + ',' + str(len(flagged)) + '\n')
+            for fl in flagged:
+                ffid.write(str(i) + ',' + fl[0] + ',' + fl[1] + ','
+                           + fl[2].strftime(t_frmt) + ',' + fl[3] + '\n')
+
+
+if __name__ == '__main__':
+    main()
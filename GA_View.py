@@ -0,0 +1,157 @@
+"""Render plots of processed flights on request.
+
+This reads the flight data saved by the detector (OS_Output.to_numpy) and
+produces the same time or distance plots as OS_Output.do_plots and
+OS_Output.do_plots_dist. Rendered images are kept in a cache directory,
+and the least recently used images are removed once the cache grows
+beyond a size limit.
+"""
+import OS_Airports as OSA
+import OS_Output as OSO
+import hashlib
+import shutil
+import click
+import glob
+import os
+
+
+class plot_cache:
+    """A size-limited cache of rendered plots.
+
+    cdir = directory holding the cache, with one subdirectory per plot
+    max_bytes = maximum total size of the cache in bytes
+    """
+
+    def __init__(self, cdir, max_bytes):
+        """Setup the class."""
+        self.cdir = cdir
+        self.max_bytes = max_bytes
+        os.makedirs(cdir, exist_ok=True)
+
+    def key(self, inf, ptype):
+        """Make a key that changes if the input file changes."""
+        stat = os.stat(inf)
+        kstr = (os.path.abspath(inf) + ':' + str(stat.st_mtime_ns) + ':'
+                + str(stat.st_size) + ':' + ptype)
+        return hashlib.sha1(kstr.encode('utf-8')).hexdigest()
+
+    def get(self, inf, ptype, apt=None):
+        """Return the images for a flight, rendering them if not cached.
+
+        Inputs:
+            -   The filename of a flight saved by OS_Output.to_numpy()
+            -   The plot type, either 'time' or 'dist'
+            -   (optional) An airport class, used to find the runway
+        Returns:
+            -   A list of image filenames
+        """
+        kdir = os.path.join(self.cdir, self.key(inf, ptype))
+        pngs = sorted(glob.glob(os.path.join(kdir, '*', '*.png')))
+        if (len(pngs) > 0):
+            # Mark as recently used
+            os.utime(kdir)
+            return pngs
+
+        fd = OSO.from_numpy(inf)
+        render(fd, ptype, kdir + '/', apt)
+        self.evict(keep=kdir)
+        return sorted(glob.glob(os.path.join(kdir, '*', '*.png')))
+
+    def evict(self, keep=None):
+        """Remove the least recently used plots until under the size limit.
+
+        Input:
+            -   (optional) A cache subdirectory that must not be removed
+        """
+        entries = []
+        tot_size = 0
+        for kdir in glob.glob(os.path.join(self.cdir, '*')):
+            size = sum(os.path.getsize(fname) for fname in
+                       glob.glob(os.path.join(kdir, '*', '*')))
+            entries.append((os.path.getmtime(kdir), size, kdir))
+            tot_size += size
+        entries.sort()
+        for mtime, size, kdir in entries:
+            if (tot_size <= self.max_bytes):
+                break
+            if (kdir == keep):
+                continue
+            shutil.rmtree(kdir, ignore_errors=True)
+            tot_size -= size
+
+
+def render(fd, ptype, outdir, apt=None):
+    """Render the plots for a single flight.
+
+    Inputs:
+        -   A flight_data class, such as that saved by to_numpy()
+        -   The plot type, either 'time' or 'dist'
+        -   A string specifying the output directory
+        -   (optional) An airport class, used to find the runway
+    Returns:
+        -   Nothing
+    """
+    os.makedirs(outdir, exist_ok=True)
+    spldict = OSO.create_spline(fd, bpos=None)
+    rwy = None
+    if (apt is not None and fd.get('rwy', 'None') != 'None'):
+        rwy = apt.get_runway(fd['rwy'])
+    if (ptype == 'time'):
+        OSO.do_plots(fd, spldict, OSO.colormap, outdir, rwy=rwy, bpos=None)
+    else:
+        OSO.do_plots_dist(fd, spldict, OSO.colormap, outdir,
+                          rwy=rwy, bpos=None)
+
+
+def is_ga(inf):
+    """Check whether a saved flight was flagged as a go-around."""
+    fd = OSO.from_numpy(inf)
+    return fd.get('gapt', 0) > 0
+
+
+@click.group()
+@click.option('--cachedir', default='PLOT_CACHE/')
+@click.option('--cache-mb', default=2000)
+@click.option('--airport', default='VABB')
+@click.pass_context
+def cli(ctx, cachedir, cache_mb, airport):
+    """Render plots of processed flights on request."""
+    ctx.obj = {'cache': plot_cache(cachedir, cache_mb * 1024 * 1024),
+               'apt': OSA.get_airport(airport)}
+
+
+@cli.command()
+@click.argument('files', nargs=-1)
+@click.option('--ptype', default='time', type=click.Choice(['time', 'dist']))
+@click.option('--view', is_flag=True, help="Open the images once rendered")
+@click.pass_context
+def show(ctx, files, ptype, view):
+    """Render and print the plots for one or more saved flights."""
+    for inf in files:
+        for png in ctx.obj['cache'].get(inf, ptype, ctx.obj['apt']):
+            print(png)
+            if (view):
+                click.launch(png)
+
+
+@cli.command()
+@click.argument('datadir')
+@click.option('--ptype', default='time', type=click.Choice(['time', 'dist']))
+@click.option('--all-flights', is_flag=True,
+              help="Render every flight, not only go-arounds")
+@click.pass_context
+def prerender(ctx, datadir, ptype, all_flights):
+    """Render the plots for the go-arounds saved in a directory."""
+    files = sorted(glob.glob(os.path.join(datadir, '**', 'FLT_*.np[yz]'),
+                             recursive=True))
+    n_done = 0
+    for inf in files:
+        if (not all_flights and not is_ga(inf)):
+            continue
+        ctx.obj['cache'].get(inf, ptype, ctx.obj['apt'])
+        n_done += 1
+    print("Rendered plots for", n_done, "of", len(files), "flights")
+
+
+if __name__ == '__main__':
+    cli()
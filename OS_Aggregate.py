@@ -0,0 +1,421 @@
+"""An incremental store of landing and go-around counts for reporting.
+
+Detections are added to hourly cells, one per airport, runway and hour,
+as each batch completes. Each cell holds partial aggregates that can be
+merged by addition (counts, sums and sums of squares) or by min / max, so
+cells can be combined into days, months, years or whole runways, and
+stores from separate runs can be merged, without reading the results
+files again. The store is saved as a single compact .npz file.
+
+The store also records the icao24 and l_time of every flight it holds, the
+same key as OS_Results, so that flights in re-processed files are not
+counted twice. A store can be rebuilt from the results database, which
+holds the latest result for every flight.
+"""
+from types import SimpleNamespace
+import OS_Results as OSR
+import pandas as pd
+import numpy as np
+import click
+import os
+
+
+# Upper bounds of the METAR wind speed bins, in kts
+wind_bins = [5., 10., 15., 20., 25., 30., np.inf]
+
+# The values that are summarised in each cell, either from the detection
+# itself or from the METAR used for the barometric correction
+feat_names = ['rocvar', 'hdgvar', 'latvar', 'lonvar', 'gspvar']
+met_names = ['temp', 'dewp', 'w_s', 'w_g', 'vis', 'pres', 'cld']
+
+# Time bucket sizes for queries, as numpy datetime64 units
+freqs = {'hour': 'h', 'day': 'D', 'month': 'M', 'year': 'Y'}
+
+# The same bucket sizes, as pandas frequencies
+pd_freqs = {'hour': 'h', 'day': 'D', 'month': 'MS', 'year': 'YS'}
+
+
+def _layout():
+    """Return the column of each value in a cell, and how it is merged."""
+    cols = ['n_land', 'n_ga', 'n_met']
+    for i in range(0, len(wind_bins)):
+        cols += ['n_land_w' + str(i), 'n_ga_w' + str(i)]
+    for name in feat_names + met_names:
+        cols += [name + '_n', name + '_sum', name + '_sq', name + '_min',
+                 name + '_max']
+    col_idx = {name: i for i, name in enumerate(cols)}
+    is_min = np.array([name.endswith('_min') for name in cols])
+    is_max = np.array([name.endswith('_max') for name in cols])
+    return cols, col_idx, is_min, is_max
+
+
+cols, col_idx, _is_min, _is_max = _layout()
+_is_add = ~(_is_min | _is_max)
+
+
+def empty_cells(n):
+    """Return n empty cells, with min / max values that any value replaces."""
+    vals = np.zeros((n, len(cols)))
+    vals[:, _is_min] = np.inf
+    vals[:, _is_max] = -np.inf
+    return vals
+
+
+def merge_cells(dst, src):
+    """Merge the values of one cell (or array of cells) into another."""
+    dst[..., _is_add] += src[..., _is_add]
+    dst[..., _is_min] = np.minimum(dst[..., _is_min], src[..., _is_min])
+    dst[..., _is_max] = np.maximum(dst[..., _is_max], src[..., _is_max])
+
+
+def _add_value(row, name, val):
+    """Add a single value to the count, sum, square, min and max of a cell.
+
+    Values that are not finite are left out, so each value has its own
+    count of the flights it is known for.
+    """
+    val = float(val)
+    if (not np.isfinite(val)):
+        return
+    row[col_idx[name + '_n']] += 1
+    row[col_idx[name + '_sum']] += val
+    row[col_idx[name + '_sq']] += val * val
+    row[col_idx[name + '_min']] = min(row[col_idx[name + '_min']], val)
+    row[col_idx[name + '_max']] = max(row[col_idx[name + '_max']], val)
+
+
+def _to_secs(t_val):
+    """Return a time as whole seconds since 1970, as in OS_Results."""
+    return int(pd.Timestamp(t_val).value // 1000000000)
+
+
+def _to_hour(t_val):
+    """Return a time as whole hours since 1970."""
+    return int(pd.Timestamp(t_val).value // 3600000000000)
+
+
+def det_cell(det):
+    """Return the cell values for a single detection.
+
+    Input:
+        -   A detection class, from OS_Detect.detect()
+    Returns:
+        -   A 1-d array of cell values
+    """
+    row = empty_cells(1)[0]
+    row[col_idx['n_land']] = 1
+    row[col_idx['n_ga']] = int(det.is_ga)
+    for name in feat_names:
+        _add_value(row, name, getattr(det, name))
+    if (det.metar is not None):
+        row[col_idx['n_met']] = 1
+        wbin = int(np.searchsorted(wind_bins, det.metar.w_s))
+        row[col_idx['n_land_w' + str(wbin)]] = 1
+        row[col_idx['n_ga_w' + str(wbin)]] = int(det.is_ga)
+        for name in met_names:
+            _add_value(row, name, getattr(det.metar, name))
+    return row
+
+
+class agg_store:
+    """Hourly partial aggregates per airport and runway.
+
+    apts = array of airport ICAO codes, one per cell
+    rwys = array of runway names, one per cell
+    hours = array of the start of each cell, in hours since 1970
+    vals = 2-d array of cell values, one row per cell, see 'cols'
+    n = number of cells in use, rows after this are spare space
+    seen = set of (icao24, l_time in seconds since 1970) of every flight
+           that has been added
+    """
+
+    def __init__(self):
+        """Setup the class, with no cells."""
+        self.apts = np.zeros(0, dtype='U8')
+        self.rwys = np.zeros(0, dtype='U8')
+        self.hours = np.zeros(0, dtype=np.int64)
+        self.vals = empty_cells(0)
+        self.n = 0
+        self.seen = set()
+        self._index = None
+
+    @classmethod
+    def load(cls, inf):
+        """Load a store from a file, or return an empty one if not found."""
+        store = cls()
+        if (not os.path.exists(inf)):
+            return store
+        with np.load(inf) as data:
+            if (list(data['cols']) != cols):
+                raise ValueError(inf + " was saved with different columns, "
+                                 "it must be rebuilt")
+            store.apts = data['apts']
+            store.rwys = data['rwys']
+            store.hours = data['hours']
+            store.vals = data['vals']
+            if ('seen_ic24' in data.files):
+                store.seen = set(zip(data['seen_ic24'].tolist(),
+                                     data['seen_time'].tolist()))
+        store.n = len(store.hours)
+        return store
+
+    @classmethod
+    def from_results(cls, conn, apt=None):
+        """Build a store from the results database.
+
+        Inputs:
+            -   An sqlite3 connection, from OS_Results.open_db()
+            -   (optional) An airport ICAO code to select
+        Returns:
+            -   An agg_store class
+        """
+        store = cls()
+        res = OSR.query(conn, apt=apt)
+        dets = {}
+        for row in res.itertuples(index=False):
+            # The METAR values are in the same row, and are NULL if none
+            det = SimpleNamespace(**row._asdict())
+            det.metar = det if (pd.notna(det.temp)) else None
+            dets.setdefault(det.airport, []).append(det)
+        for icao in dets:
+            store.add_batch(dets[icao], icao)
+        return store
+
+    def save(self, outf):
+        """Save the store, replacing the file in a single step."""
+        tmpf = outf + '.tmp.npz'
+        seen = sorted(self.seen)
+        np.savez(tmpf, cols=np.array(cols), apts=self.apts[:self.n],
+                 rwys=self.rwys[:self.n], hours=self.hours[:self.n],
+                 vals=self.vals[:self.n],
+                 seen_ic24=np.array([key[0] for key in seen], dtype='U8'),
+                 seen_time=np.array([key[1] for key in seen],
+                                    dtype=np.int64))
+        os.replace(tmpf, outf)
+
+    def _get_index(self):
+        """Return the dict of (airport, runway, hour) -> cell row."""
+        if (self._index is None):
+            self._index = {key: i for i, key in enumerate(
+                zip(self.apts[:self.n].tolist(), self.rwys[:self.n].tolist(),
+                    self.hours[:self.n].tolist()))}
+        return self._index
+
+    def _grow(self, n_new):
+        """Make space for at least n_new more cells."""
+        if (self.n + n_new <= len(self.hours)):
+            return
+        size = max(self.n + n_new, 2 * len(self.hours), 64)
+        self.apts = np.resize(self.apts, size)
+        self.rwys = np.resize(self.rwys, size)
+        self.hours = np.resize(self.hours, size)
+        vals = empty_cells(size)
+        vals[:self.n] = self.vals[:self.n]
+        self.vals = vals
+
+    def add_cells(self, keys, vals):
+        """Merge cells into the store.
+
+        Inputs:
+            -   A list of (airport, runway, hour) keys
+            -   A 2-d array of cell values, one row per key
+        """
+        index = self._get_index()
+        self._grow(len(keys))
+        for key, row in zip(keys, vals):
+            i = index.get(key)
+            if (i is None):
+                i = self.n
+                index[key] = i
+                self.apts[i], self.rwys[i], self.hours[i] = key
+                self.vals[i] = empty_cells(1)[0]
+                self.n += 1
+            merge_cells(self.vals[i], row)
+
+    def add_batch(self, dets, icao):
+        """Add the detections from one batch.
+
+        Detections are placed in the hour of their l_time, the mid-point
+        of the flight, which is the same time used to select the METAR.
+        Flights that are already in the store are skipped, to replace
+        them rebuild the store with from_results().
+        Inputs:
+            -   A list of detection classes, from OS_Detect.detect()
+            -   The ICAO code of the airport
+        Returns:
+            -   The number of detections skipped
+        """
+        cells = {}
+        n_skip = 0
+        for det in dets:
+            fl_key = (det.icao24, _to_secs(det.l_time))
+            if (fl_key in self.seen):
+                n_skip += 1
+                continue
+            self.seen.add(fl_key)
+            key = (icao, det.rwy, _to_hour(det.l_time))
+            if (key in cells):
+                merge_cells(cells[key], det_cell(det))
+            else:
+                cells[key] = det_cell(det)
+        if (len(cells) > 0):
+            self.add_cells(list(cells.keys()), np.array(list(cells.values())))
+        return n_skip
+
+    def merge(self, other):
+        """Merge another store into this one.
+
+        The stores must hold different flights, as the cells of a flight
+        in both cannot be separated.
+        """
+        if (not self.seen.isdisjoint(other.seen)):
+            raise ValueError("Cannot merge stores that hold the same flights")
+        self.seen.update(other.seen)
+        self.add_cells(list(zip(other.apts[:other.n].tolist(),
+                                other.rwys[:other.n].tolist(),
+                                other.hours[:other.n].tolist())),
+                       other.vals[:other.n])
+
+    def query(self, apt=None, rwy=None, start=None, end=None, freq='day',
+              by_rwy=True, by_wind=False, roll=None):
+        """Combine cells into larger time buckets and compute rates.
+
+        Inputs:
+            -   (optional) An airport ICAO code to select
+            -   (optional) A runway name to select
+            -   (optional) The earliest time to include, a datetime
+            -   (optional) The latest time to include, a datetime
+            -   (optional) The bucket size: 'hour', 'day', 'month', 'year'
+                or None to combine all times
+            -   (optional) A bool, if False then runways are combined
+            -   (optional) A bool, if True then the result has one row per
+                METAR wind speed bin in each bucket
+            -   (optional) An int number of buckets to compute rolling
+                go-around rates over, as 'roll_rate'. Buckets with no
+                landings count towards the window.
+        Returns:
+            -   A dataframe with the counts, go-around rate and the mean,
+                standard deviation, min and max of each value per bucket
+        """
+        sel = np.ones(self.n, dtype=bool)
+        if (apt is not None):
+            sel &= self.apts[:self.n] == apt
+        if (rwy is not None):
+            sel &= self.rwys[:self.n] == rwy
+        if (start is not None):
+            sel &= self.hours[:self.n] >= _to_hour(start)
+        if (end is not None):
+            sel &= self.hours[:self.n] <= _to_hour(end)
+        apts = self.apts[:self.n][sel]
+        rwys = self.rwys[:self.n][sel]
+        vals = self.vals[:self.n][sel]
+        if (freq is None):
+            times = np.zeros(len(apts), dtype='datetime64[h]')
+        else:
+            times = self.hours[:self.n][sel].astype('datetime64[h]')
+            times = times.astype('datetime64[' + freqs[freq] + ']')
+        if (not by_rwy):
+            rwys = np.full(len(apts), 'ALL', dtype='U8')
+
+        # Sort the cells into groups, then merge each run of cells
+        order = np.lexsort((times, rwys, apts))
+        apts, rwys, times = apts[order], rwys[order], times[order]
+        vals = vals[order]
+        new = np.ones(len(apts), dtype=bool)
+        new[1:] = ((apts[1:] != apts[:-1]) | (rwys[1:] != rwys[:-1]) |
+                   (times[1:] != times[:-1]))
+        starts = np.flatnonzero(new)
+        out = empty_cells(len(starts))
+        if (len(starts) > 0):
+            out[:, _is_add] = np.add.reduceat(vals[:, _is_add], starts)
+            out[:, _is_min] = np.minimum.reduceat(vals[:, _is_min], starts)
+            out[:, _is_max] = np.maximum.reduceat(vals[:, _is_max], starts)
+
+        res = pd.DataFrame({'apt': apts[starts], 'rwy': rwys[starts]})
+        if (freq is not None):
+            res['time'] = times[starts]
+        if (by_wind):
+            return self._wind_table(res, out)
+        res['n_land'] = out[:, col_idx['n_land']].astype(np.int64)
+        res['n_ga'] = out[:, col_idx['n_ga']].astype(np.int64)
+        res['ga_rate'] = res['n_ga'] / res['n_land']
+        for name in feat_names + met_names:
+            cnt = out[:, col_idx[name + '_n']]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = out[:, col_idx[name + '_sum']] / cnt
+                var = out[:, col_idx[name + '_sq']] / cnt - mean * mean
+            res[name + '_mean'] = mean
+            res[name + '_std'] = np.sqrt(np.maximum(var, 0.))
+            for stat in ('_min', '_max'):
+                val = out[:, col_idx[name + stat]]
+                res[name + stat] = np.where(np.isfinite(val), val, np.nan)
+        if (roll is not None and freq is not None):
+            res['roll_rate'] = np.nan
+            for key, grp in res.groupby(['apt', 'rwy'], sort=False):
+                # Fill in the empty buckets, so the window is a fixed time
+                full = pd.date_range(grp['time'].min(), grp['time'].max(),
+                                     freq=pd_freqs[freq])
+                cnts = grp.set_index('time')[['n_land', 'n_ga']].reindex(
+                    full, fill_value=0).rolling(roll, min_periods=1).sum()
+                cnts = cnts.loc[grp['time'].values]
+                res.loc[grp.index, 'roll_rate'] = (cnts['n_ga'] /
+                                                   cnts['n_land']).values
+        return res
+
+    def _wind_table(self, res, out):
+        """Expand the result of query() into one row per wind speed bin."""
+        parts = []
+        lo = [0.] + wind_bins[:-1]
+        for i in range(0, len(wind_bins)):
+            part = res.copy()
+            part['wind_lo'] = lo[i]
+            part['wind_hi'] = wind_bins[i]
+            part['n_land'] = out[:, col_idx['n_land_w' + str(i)]].astype(
+                np.int64)
+            part['n_ga'] = out[:, col_idx['n_ga_w' + str(i)]].astype(np.int64)
+            parts.append(part)
+        res = pd.concat(parts, ignore_index=True)
+        res = res[res['n_land'] > 0].sort_values(
+            [col for col in ('apt', 'rwy', 'time', 'wind_lo')
+             if col in res]).reset_index(drop=True)
+        res['ga_rate'] = res['n_ga'] / res['n_land']
+        return res
+
+
+@click.command()
+@click.argument('inf')
+@click.option('--airport', default=None)
+@click.option('--rwy', default=None)
+@click.option('--start', default=None, help="Start time, i.e: 2019-08-01")
+@click.option('--end', default=None)
+@click.option('--freq', default='day',
+              type=click.Choice(['hour', 'day', 'month', 'year', 'all']))
+@click.option('--all-rwys', is_flag=True, help="Combine the runways")
+@click.option('--by-wind', is_flag=True, help="One row per wind speed bin")
+@click.option('--roll', default=None, type=int,
+              help="Add a rolling go-around rate over this many buckets")
+@click.option('--outf', default=None, help="Save the result as CSV")
+@click.option('--from-db', default=None,
+              help="Rebuild the store from this results database first")
+def main(inf, airport, rwy, start, end, freq, all_rwys, by_wind, roll, outf,
+         from_db):
+    """Print go-around rates from an aggregation store."""
+    if (from_db is not None):
+        store = agg_store.from_results(OSR.open_db(from_db))
+        store.save(inf)
+    else:
+        store = agg_store.load(inf)
+    res = store.query(airport, rwy, start, end,
+                      None if freq == 'all' else freq,
+                      not all_rwys, by_wind, roll)
+    if (outf is not None):
+        res.to_csv(outf, index=False)
+    show = [col for col in ('apt', 'rwy', 'time', 'wind_lo', 'wind_hi',
+                            'n_land', 'n_ga', 'ga_rate', 'roll_rate',
+                            'w_s_mean') if col in res]
+    with pd.option_context('display.max_rows', 200, 'display.width', 160):
+        print(res[show])
+
+
+if __name__ == '__main__':
+    main()
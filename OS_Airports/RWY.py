@@ -13,15 +13,16 @@ class rwy_data:
     Then follows a series of numbers to define lines of best fit for approaches
     to a given runway. Each of these are a list containing 6 values for a
     polynomial fit: y = f0 * x^6 + f1 * x^5 ... f6
+    These fits are optional and are None if not known for a runway.
     '''
     def __init__(self, name, mainhdg, heading, rwy, rwy2, gate,
-                 lons1, lonm, lonp1,
-                 lats1, latm, latp1,
-                 hdgs1, hdgm, hdgp1,
-                 gals1, galm, galp1,
-                 alts1, altm, altp1,
-                 rocs1, rocm, rocp1):
-                 
+                 lons1=None, lonm=None, lonp1=None,
+                 lats1=None, latm=None, latp1=None,
+                 hdgs1=None, hdgm=None, hdgp1=None,
+                 gals1=None, galm=None, galp1=None,
+                 alts1=None, altm=None, altp1=None,
+                 rocs1=None, rocm=None, rocp1=None):
+
         self.name = name
         self.mainhdg = mainhdg
         self.heading = heading 
@@ -1,131 +0,0 @@
-import OS_Airports.RWY as RWY
-
-rwy_09 = RWY.rwy_data('09',
-                      89.,
-                      [79., 89., 89., 99.],
-                      [19.088441, 72.849415],
-                      [19.088789, 72.875840],
-                      [19.088200, 72.821867],
-                      
-                      [0., 0., 0., 0., 0., 0.009904, 72.849302],
-                      [0., 0., 0., 0., 0., 0.0087480, 72.8488650],
-                      [0., 0., 0., 0., 0., 0.0075920, 72.8484270],
-                      
-                      [0., 0., -2E-06, -2.7E-05, -0.000185, 0.000183, 19.088421],
-                      [0., 0., 0., 0., 0., 0.000122, 19.088446],
-                      [0., 0., 2E-06, 2.3E-05, 0.000158, 0.000011, 19.088477],
-                      
-                      [0., 0., 0., 0., 0., 0.976308,82.666172],
-                      [0., 0., 0., 0., 0., -0.113222, 89.23379],
-                      [0., 0., 0., 0., 0., -1.202753, 95.801409],
-                      
-                      [0., 0., 0., 0., 0., -126.883262, -275.816982],
-                      [0., 0., 0., 0., 0., -164.013189, -45.9979],
-                      [0., 0., 0., 0., 0., -201.143117, 183.821183],
-                      
-                      [0., 0., 0., 0., 0., -109.762783, -36.563216],
-                      [0., 0., 0., 0., 0., -164.499523, 55.034495],
-                      [0., 0., 0., 0., 0., -219.236263, 146.632207],
-                      
-                      [0., 0., 0.1291, 4.763232, 55.335578, 234.439884, -647.268555],
-                      [0., 0., 0.196353, 5.471767, 48.940069, 167.013344, -502.714751],
-                      [0., 0., 0.263606, 6.180303, 42.544559, 99.586804, -358.160948])
-
-rwy_14 = RWY.rwy_data('14',
-                      134.,
-                      [124., 134., 134., 144.],
-                      [19.095866, 72.859985],
-                      [19.081736, 72.875313],
-                      [19.114399, 72.840536],
-                      
-                      [0., 0., 0., 0., 0., 0.0068800, 72.8587900],
-                      [0., 0., 0., 0., 0., 0.0065820, 72.8602840],
-                      [0., 0., 0., 0., 0., 0.0062850, 72.8617790],
-                      
-                      [0., 0., 0., 0., 0., -0.005657, 19.094802],
-                      [0., 0., 0., 0., 0., -0.006029, 19.095772],
-                      [0., 0., 0., 0., 0., -0.006402, 19.096742],
-                      
-                      [-7.7E-05, -0.003032, -0.041713, -0.242629, -0.529168, -0.151943, 133.445092],
-                      [-6.1E-05, -0.002638, -0.039075, -0.245117, -0.604805, -0.331047, 134.079674],
-                      [0.000102, 0.002208, 0.013192, -0.006314, -0.237958, -0.44773, 134.672269],
-                      
-                      [0., 0., 0., 0., 0., -184.758095, -493.127196],
-                      [0., 0., 0., 0., 0., -155.334603, 52.11372],
-                      [0., 0., 0., 0., 0., -125.911112, 597.354637],
-                      
-                      [0., 0., 0., 0., 0., -143.718309, -97.941909],
-                      [0., 0., 0., 0., 0., -165.680455, 87.315007],
-                      [0., 0., 0., 0., 0., -187.642601, 272.571924],
-                      
-                      [0., 0., 0., 1.920535, 27.049767, 88.953695, -936.612691],
-                      [0., 0., 0., 1.450319, 23.076103, 125.842468, -482.748803],
-                      [0., 0., 0., 0.980103, 19.10244, 162.73124, -28.884915])
-                   
-rwy_27 = RWY.rwy_data('27',
-                      -91.,
-                      [-101., -91., -91., -81.],
-                      [19.088789, 72.875840],
-                      [19.088441, 72.849415],
-                      [19.089381, 72.903396],
-                      
-                      [0., 0., 0., 0., 0., -0.0084655, 72.8757470],
-                      [0., 0., 0., 0., 0., -0.0089070, 72.8758400],
-                      [0., 0., 0., 0., 0., -0.0093493, 72.8759340],
-                      
-                      [0., 0., 0., 4E-06, 1.7E-05, 0.000140, 19.088810],
-                      [0., 0., 0., 0., 0., -0.000119, 19.088832],
-                      [0., 0., 0., -3E-06, -1.1E-05, -0.000366, 19.088846],
-                      
-                      [0., 0., 0., 0., 0., 0.701817, -94.511715],
-                      [0., 0., 0., 0., 0., 0.037605, -91.161396],
-                      [0., 0., 0., 0., 0., -0.626606, -87.811076],
-                      
-                      [0., 0., 0., 0., 0., -175.274007, -460.335219],
-                      [0., 0., 0., 0., 0., -162.056614, -43.694519],
-                      [0., 0., 0., 0., 0., -148.866481, 372.758020],
-                      
-                      [0., 0., 0., 0., 0., -139.069932, -67.23504],
-                      [0., 0., 0., 0., 0., -163.260234, 48.798617],
-                      [0., 0., 0., 0., 0., -187.450536, 164.832275],
-                      
-                      [0., 0., 0.506252, 10.78815, 78.170898, 234.0929, -624.564073],
-                      [0., 0., 0.454237, 9.892442, 72.868658, 226.305335, -444.228413],
-                      [0., 0., 0.402222, 8.996734, 67.566417, 218.517769, -263.892753])
-
-rwy_32 = RWY.rwy_data('32',
-                      -46.,
-                      [-56., -46., -46., -36.],
-                      [19.081736, 72.875313],
-                      [19.095866, 72.859985],
-                      [19.063165, 72.894773],
-                      
-                      [0., 0., 0., 0., 0., 0., -0.0054260, 72.8766100],
-                      [0., 0., 0., 0., 0., 0., -0.0060530, 72.8762350],
-                      [0., 0., 0., 0., 0., 0., -0.0066790, 72.8758600],
-                      
-                      [0., 0., 0., 0., 0., 0.007090, 19.083027],
-                      [0., 0., 0., 0., 0., 0.006503, 19.082561],
-                      [0., 0., 0., 0., 0., 0.005916, 19.082094],
-                      
-                      [0.000730, 0.021043, 0.213370, 0.801475, 0.321767, -0.404711, -46.500762],
-                      [0.000752, 0.021942, 0.229974, 0.980459, 1.172476, 0.020045, -46.198730],
-                      [-0.000335, -0.007240, -0.042249, -0.000217, 0.268993, -0.045591, -45.629600],
-                      
-                      [0., 0., 0., 0., 0., -192.70363, -301.85719],
-                      [0., 0., 0., 0., 0., -193.671668, -44.331021],
-                      [0., 0., 0., 0., 0., -194.639705, 213.195148],
-                      
-                      [0., 0., 0., 0., 0., -184.311355, -95.603957],
-                      [0., 0., 0., 0., 0., -194.816913, 49.532693],
-                      [0., 0., 0., 0., 0., -205.32247, 194.669344],
-                      
-                      [0., 0., 0., 4.732624, 79.222797, 370.074985, -700.282085],
-                      [0., 0., 0., 1.782086, 32.025775, 189.154659, -463.293086],
-                      [0., 0., 0., -1.168452, -15.171247, 8.234332, -226.304088])
-
-rwy_list = [rwy_09, rwy_14, rwy_27, rwy_32]
-
-airport_name = 'Mumbai'
-icao_name = 'VABB'
-iata_name = 'BOM'
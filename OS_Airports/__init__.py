@@ -0,0 +1,4 @@
+"""Airport and runway definitions, see registry.py for details."""
+from OS_Airports.registry import get_airport, list_airports
+
+__all__ = ['get_airport', 'list_airports']
@@ -0,0 +1,75 @@
+"""Local map projection for an airport and runway-aligned coordinates.
+
+An azimuthal equidistant projection is centred on each airport, so that
+distances from the airport are in km and correct at any latitude. Runway
+coordinates are then the along-track distance from the threshold (negative
+on approach) and cross-track distance from the centreline (positive to the
+right of the landing direction).
+"""
+import numpy as np
+
+
+# Mean radius of the Earth in km
+earth_rad = 6371.0088
+
+
+class projection:
+    """An azimuthal equidistant projection centred on a point.
+
+    lat0 = latitude of the projection centre in degrees
+    lon0 = longitude of the projection centre in degrees
+    """
+
+    def __init__(self, lat0, lon0):
+        """Setup the class."""
+        self.lat0 = float(lat0)
+        self.lon0 = float(lon0)
+        self._sin0 = np.sin(np.radians(self.lat0))
+        self._cos0 = np.cos(np.radians(self.lat0))
+
+    def to_xy(self, lats, lons):
+        """Project latitudes and longitudes.
+
+        Inputs:
+            -   An array of latitudes in degrees
+            -   An array of longitudes in degrees
+        Returns:
+            -   An array of distances east of the centre in km
+            -   An array of distances north of the centre in km
+        """
+        phi = np.radians(np.asarray(lats, dtype=np.float64))
+        dlam = np.radians(np.asarray(lons, dtype=np.float64) - self.lon0)
+        sphi = np.sin(phi)
+        cphi = np.cos(phi)
+        cdlam = np.cos(dlam)
+
+        cosc = np.clip(self._sin0 * sphi + self._cos0 * cphi * cdlam, -1, 1)
+        c = np.arccos(cosc)
+        sinc = np.sin(c)
+        kp = np.ones_like(c)
+        pts = (sinc > 1e-12).nonzero()
+        kp[pts] = c[pts] / sinc[pts]
+
+        x = earth_rad * kp * cphi * np.sin(dlam)
+        y = earth_rad * kp * (self._cos0 * sphi - self._sin0 * cphi * cdlam)
+        return x, y
+
+
+def runway_coords(x, y, rwy):
+    """Convert projected positions into runway-aligned coordinates.
+
+    Inputs:
+        -   An array of projected x positions in km
+        -   An array of projected y positions in km
+        -   A runway class, with projected geometry from the registry
+    Returns:
+        -   An array of along-track distances from the threshold in km,
+            negative before the threshold
+        -   An array of cross-track distances from the centreline in km,
+            positive to the right of the landing direction
+    """
+    dx = np.asarray(x) - rwy.rwy_xy[0]
+    dy = np.asarray(y) - rwy.rwy_xy[1]
+    along = dx * rwy.rwy_dir[0] + dy * rwy.rwy_dir[1]
+    cross = dx * rwy.rwy_dir[1] - dy * rwy.rwy_dir[0]
+    return along, cross
@@ -0,0 +1,259 @@
+"""A registry of airport definitions, loaded from data files on request.
+
+Each airport is stored as a JSON file in this directory, named by its ICAO
+code, i.e: 'VABB.json'. Only the airports that are requested get loaded.
+Geometry derived from the runways (retrieval bounds, gate vectors, heading
+windows and projected positions) is cached on disk as a numpy .npz file,
+which is rebuilt automatically if the JSON file changes.
+"""
+from OS_Airports.projection import projection
+import OS_Airports.RWY as RWY
+import numpy as np
+import hashlib
+import json
+import os
+
+
+# Location of the airport JSON files
+data_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Location of the cached geometry files
+cache_dir = os.path.join(data_dir, 'cache')
+
+# Size of the retrieval box around the airport midpoint, in degrees
+bound_size = 0.45
+
+# Increment this if the contents of the geometry cache change
+geom_version = 2
+
+# Airports that have already been loaded, keyed by ICAO code
+_airports = {}
+
+
+class airport:
+    """An airport and its runways.
+
+    icao_name = ICAO code, i.e: 'VABB'
+    iata_name = IATA code, i.e: 'BOM'
+    airport_name = Name of the airport, i.e: 'Mumbai'
+    rwy_list = list of runways, each a rwy_data class
+    src = path to the JSON file describing the airport
+    src_hash = SHA1 hash of the JSON file
+    metar_file = path to the METAR archive for the airport, or None
+    """
+
+    def __init__(self, icao_name, iata_name, airport_name, rwy_list,
+                 src, src_hash, metar_file=None):
+        """Setup the class."""
+        self.icao_name = icao_name
+        self.iata_name = iata_name
+        self.airport_name = airport_name
+        self.rwy_list = rwy_list
+        self.src = src
+        self.src_hash = src_hash
+        self.metar_file = metar_file
+        self._rwys = {rwy.name: rwy for rwy in rwy_list}
+        self._geom = None
+        self._proj = None
+
+    def get_runway(self, name):
+        """Return the runway with a given name, or None if not found."""
+        return self._rwys.get(name)
+
+    @property
+    def geom(self):
+        """The derived geometry for this airport, see get_geometry()."""
+        if (self._geom is None):
+            self._geom = get_geometry(self)
+        return self._geom
+
+    @property
+    def proj(self):
+        """The local projection for this airport, centred on 'centre'."""
+        if (self._proj is None):
+            self._proj = projection(*self.geom['centre'])
+        return self._proj
+
+    @property
+    def bounds(self):
+        """The retrieval bounds for this airport: [lon0, lat0, lon1, lat1]."""
+        return [float(b) for b in self.geom['bounds']]
+
+
+def list_airports(indir=None):
+    """List the ICAO codes of all the airports with a data file.
+
+    Input:
+        -   (optional) A directory to search instead of the default
+    Returns:
+        -   A sorted list of ICAO codes
+    """
+    if (indir is None):
+        indir = data_dir
+    return sorted(os.path.splitext(fname)[0]
+                  for fname in os.listdir(indir)
+                  if fname.endswith('.json'))
+
+
+def get_airport(icao, indir=None):
+    """Load an airport from its data file, or return it if already loaded.
+
+    Inputs:
+        -   The ICAO code of the airport, i.e: 'VABB'
+        -   (optional) A directory to load from instead of the default
+    Returns:
+        -   An airport class
+    """
+    if (icao in _airports):
+        return _airports[icao]
+    if (indir is None):
+        indir = data_dir
+    inf = os.path.join(indir, icao + '.json')
+    if (not os.path.exists(inf)):
+        raise KeyError("No airport definition for " + icao + " in " + indir)
+
+    with open(inf, 'rb') as fid:
+        raw = fid.read()
+    adef = json.loads(raw.decode('utf-8'))
+
+    rwy_list = []
+    for rdef in adef['runways']:
+        rdef = dict(rdef)
+        rwy_list.append(RWY.rwy_data(rdef.pop('name'),
+                                     rdef.pop('mainhdg'),
+                                     rdef.pop('heading'),
+                                     rdef.pop('rwy'),
+                                     rdef.pop('rwy2'),
+                                     rdef.pop('gate'),
+                                     **rdef))
+
+    # The METAR archive is optional, relative paths are relative to indir
+    metar_file = adef.get('metar_file')
+    if (metar_file is not None):
+        metar_file = os.path.join(indir, metar_file)
+
+    apt = airport(adef['icao_name'], adef['iata_name'],
+                  adef['airport_name'], rwy_list,
+                  inf, hashlib.sha1(raw).hexdigest(), metar_file)
+
+    # Attach the projected geometry to each runway, so that it travels
+    # with the runway when it is passed to worker processes
+    geom = apt.geom
+    for i, rwy in enumerate(rwy_list):
+        rwy.rwy_xy = geom['rwy_xy'][i]
+        rwy.rwy2_xy = geom['rwy2_xy'][i]
+        rwy.gate_xy = geom['gate_xy'][i]
+        rwy.rwy_dir = geom['rwy_dir'][i]
+
+    _airports[icao] = apt
+    return apt
+
+
+def compute_bounds(rwys):
+    """Get bounding box for the airport.
+
+    The box is approx. 'bound_size' degrees in each direction around
+    the midpoint of all the runway thresholds.
+    Input:
+        -   A list of runways
+    Returns:
+        -   A list of [min lon, min lat, max lon, max lat]
+    """
+    latlist = []
+    lonlist = []
+    for rwy in rwys:
+        latlist.append(rwy.rwy[0])
+        lonlist.append(rwy.rwy[1])
+        latlist.append(rwy.rwy2[0])
+        lonlist.append(rwy.rwy2[1])
+
+    lat_ave = np.nanmean(latlist)
+    lon_ave = np.nanmean(lonlist)
+    bounds = [lon_ave - bound_size, lat_ave - bound_size,
+              lon_ave + bound_size, lat_ave + bound_size]
+
+    return bounds
+
+
+def _to_xy(pts, proj):
+    """Project an (n, 2) array of lat/lon into an (n, 2) array of x/y."""
+    pts = np.asarray(pts, dtype=np.float64)
+    x, y = proj.to_xy(pts[:, 0], pts[:, 1])
+    return np.stack((x, y), axis=1)
+
+
+def make_geometry(apt):
+    """Compute the derived geometry for an airport.
+
+    Input:
+        -   An airport class
+    Returns:
+        A dict containing:
+        -   names: Runway names
+        -   bounds: Retrieval bounds, as returned by compute_bounds()
+        -   centre: Lat, lon of the centre of the local projection
+        -   rwy, rwy2, gate: Lat, lon arrays (n_rwy, 2) from the runways
+        -   heading: Heading windows (n_rwy, 4)
+        -   mainhdg: Runway headings (n_rwy)
+        -   rwy_xy, rwy2_xy, gate_xy: Projected positions in km east/north
+        -   rwy_dir: Unit vector (east, north) along the landing direction
+        -   gate_vec: Unit vector (east, north) from gate to threshold
+    """
+    rwys = apt.rwy_list
+    bounds = compute_bounds(rwys)
+    centre = np.array([(bounds[1] + bounds[3]) / 2.,
+                       (bounds[0] + bounds[2]) / 2.])
+    geom = {'names': np.array([rwy.name for rwy in rwys]),
+            'bounds': np.array(bounds),
+            'centre': centre,
+            'rwy': np.array([rwy.rwy for rwy in rwys], dtype=np.float64),
+            'rwy2': np.array([rwy.rwy2 for rwy in rwys], dtype=np.float64),
+            'gate': np.array([rwy.gate for rwy in rwys], dtype=np.float64),
+            'heading': np.array([rwy.heading for rwy in rwys],
+                                dtype=np.float64),
+            'mainhdg': np.array([rwy.mainhdg for rwy in rwys],
+                                dtype=np.float64)}
+    proj = projection(centre[0], centre[1])
+    for key in ['rwy', 'rwy2', 'gate']:
+        geom[key + '_xy'] = _to_xy(geom[key], proj)
+    vec = geom['rwy2_xy'] - geom['rwy_xy']
+    geom['rwy_dir'] = vec / np.linalg.norm(vec, axis=1)[:, np.newaxis]
+    vec = geom['rwy_xy'] - geom['gate_xy']
+    geom['gate_vec'] = vec / np.linalg.norm(vec, axis=1)[:, np.newaxis]
+
+    return geom
+
+
+def get_geometry(apt, cdir=None):
+    """Load the derived geometry for an airport from cache, or create it.
+
+    Inputs:
+        -   An airport class
+        -   (optional) A directory to cache into instead of the default
+    Returns:
+        -   A dict of geometry, as returned by make_geometry()
+    """
+    if (cdir is None):
+        cdir = cache_dir
+    cfile = os.path.join(cdir, apt.icao_name + '.npz')
+    if (os.path.exists(cfile)):
+        try:
+            with np.load(cfile) as cdata:
+                if (int(cdata['version']) == geom_version and
+                        str(cdata['src_hash']) == apt.src_hash):
+                    return {key: cdata[key] for key in cdata.files
+                            if key not in ('version', 'src_hash')}
+        except Exception as e:
+            print("Rebuilding bad geometry cache", cfile, e)
+
+    geom = make_geometry(apt)
+    try:
+        os.makedirs(cdir, exist_ok=True)
+        # Write to a temporary file first, as several processes may
+        # be building the same cache at once
+        tmpf = cfile + '.' + str(os.getpid()) + '.npz'
+        np.savez(tmpf, version=geom_version, src_hash=apt.src_hash, **geom)
+        os.replace(tmpf, cfile)
+    except OSError as e:
+        print("Cannot save geometry cache", cfile, e)
+    return geom
@@ -0,0 +1,369 @@
+"""Lossy compression of saved flights with bounded errors.
+
+Points are dropped if every channel can be linearly interpolated (in time)
+from the points either side to within the tolerances in OS_Consts. The
+points to keep are found by recursively splitting each track at its worst
+point, as in the Douglas-Peucker algorithm, using the largest error across
+all channels relative to each tolerance. Flight phase labels and the
+on-ground flag are kept exactly.
+
+The kept values are quantised to a fraction of each tolerance, and times,
+kept positions and values are all delta-encoded before being written to a
+compressed .npz file. The quantisation is accounted for when choosing the
+points, so the reconstructed values always stay within the tolerances.
+"""
+import OS_Flight as OSFL
+import OS_Consts as CNS
+import numpy as np
+import glob
+import json
+import sys
+import os
+
+
+# The quantisation step, as a fraction of the tolerance of each channel
+quant_frac = 0.25
+
+# Km per degree of latitude
+km_per_deg = 111.2
+
+# The tolerance from CNS.compress_tol used for each float channel
+chan_tol = {'lats': 'pos', 'lons': 'pos', 'xs': 'pos', 'ys': 'pos',
+            'rdis': 'pos', 'xtrk': 'pos', 'alts': 'alts', 'gals': 'gals',
+            'rocs': 'rocs', 'hdgs': 'hdgs', 'spds': 'spds'}
+
+# Channels that are held at the last kept value rather than interpolated
+hold_chans = ['ongd', 'labl']
+
+# The value used in place of NaN once quantised
+nan_code = np.iinfo(np.int64).min
+
+
+def get_tols(fd, tols=None):
+    """Find the tolerance of each float channel in its own units.
+
+    Inputs:
+        -   A flight_data class
+        -   (optional) A dict of tolerances, as CNS.compress_tol
+    Returns:
+        -   A dict of channel name -> tolerance
+    """
+    if (tols is None):
+        tols = CNS.compress_tol
+    out = {}
+    for chan in chan_tol:
+        if (chan not in fd):
+            continue
+        tol = tols[chan_tol[chan]]
+        if (chan == 'lats'):
+            tol = tol / km_per_deg
+        elif (chan == 'lons'):
+            coslat = np.cos(np.radians(np.nanmean(fd['lats'])))
+            tol = tol / (km_per_deg * max(coslat, 0.01))
+        out[chan] = tol
+    return out
+
+
+def _fracs(times, pos, idx_a, idx_b):
+    """Find where each point lies between the kept points either side.
+
+    Inputs:
+        -   The array of times
+        -   An array of point positions
+        -   An array of the kept point before each position
+        -   An array of the kept point after each position
+    Returns:
+        -   An array of fractions between 0 and 1
+    """
+    dt = (times[idx_b] - times[idx_a]).astype(np.float64)
+    di = (idx_b - idx_a).astype(np.float64)
+    dt_p = (times[pos] - times[idx_a]).astype(np.float64)
+    di_p = (pos - idx_a).astype(np.float64)
+    # Fall back to the position if the times are identical
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(dt > 0, dt_p / np.where(dt > 0, dt, 1),
+                        di_p / np.maximum(di, 1))
+
+
+def keep_points(times, chans, tols, holds):
+    """Choose which points to keep so that every channel is within tolerance.
+
+    Inputs:
+        -   An int array of times
+        -   A dict of channel name -> float array
+        -   A dict of channel name -> tolerance
+        -   A list of arrays that must be reproduced exactly
+    Returns:
+        -   A bool array, True for the points to keep
+    """
+    npts = len(times)
+    keep = np.zeros(npts, dtype=bool)
+    if (npts == 0):
+        return keep
+    keep[0] = True
+    keep[-1] = True
+    for hold in holds:
+        keep[1:] |= hold[1:] != hold[:-1]
+
+    # Leave room for the quantisation error at the kept points
+    scale = 1. - quant_frac / 2.
+    names = list(chans.keys())
+
+    stack = []
+    kpts = keep.nonzero()[0]
+    for a, b in zip(kpts[:-1], kpts[1:]):
+        stack.append((a, b))
+    while (len(stack) > 0):
+        a, b = stack.pop()
+        if (b - a < 2):
+            continue
+        pos = np.arange(a + 1, b)
+        frac = _fracs(times, pos, np.full(len(pos), a), np.full(len(pos), b))
+        err = np.zeros(len(pos))
+        for name in names:
+            val = chans[name]
+            interp = val[a] + (val[b] - val[a]) * frac
+            with np.errstate(invalid='ignore'):
+                cur = np.abs(val[pos] - interp) / (tols[name] * scale)
+            both_nan = np.isnan(val[pos]) & np.isnan(interp)
+            cur = np.where(both_nan, 0., np.where(np.isnan(cur), np.inf, cur))
+            err = np.maximum(err, cur)
+        pt = int(np.argmax(err))
+        if (err[pt] > 1):
+            mid = a + 1 + pt
+            keep[mid] = True
+            stack.append((a, mid))
+            stack.append((mid, b))
+
+    return keep
+
+
+def _quantise(val, step):
+    """Quantise a float array into ints, with NaN as nan_code."""
+    out = np.full(len(val), nan_code, dtype=np.int64)
+    good = np.isfinite(val)
+    out[good] = np.round(val[good] / step).astype(np.int64)
+    return out
+
+
+def _unquantise(ival, step):
+    """Convert the output of _quantise() back into floats."""
+    out = ival.astype(np.float64) * step
+    out[ival == nan_code] = np.nan
+    return out
+
+
+def _delta(ival):
+    """Delta-encode an int array, using int32 where possible.
+
+    Input:
+        -   An int array from _quantise()
+    Returns:
+        -   An int array of differences, with NaNs encoded as zero
+        -   A bool array, True where the value was NaN
+    """
+    bad = ival == nan_code
+    dlt = np.diff(np.where(bad, 0, ival), prepend=0)
+    if (len(dlt) == 0 or np.abs(dlt).max() < 2**31):
+        dlt = dlt.astype(np.int32)
+    return dlt, bad
+
+
+def pack_flight(fd, tols=None):
+    """Compress a flight into a dict of arrays.
+
+    Inputs:
+        -   A flight_data class
+        -   (optional) A dict of tolerances, as CNS.compress_tol
+    Returns:
+        -   A dict of arrays, suitable for numpy.savez_compressed()
+    """
+    times = fd['time'].astype(np.int64)
+    tols = get_tols(fd, tols)
+    chans = {}
+    for chan in tols:
+        val = fd[chan].astype(np.float64)
+        if (chan == 'hdgs'):
+            # Avoid jumps where the heading wraps around
+            good = np.isfinite(val)
+            val[good] = np.degrees(np.unwrap(np.radians(val[good])))
+        chans[chan] = val
+    holds = [fd.codes(chan) for chan in hold_chans if chan in fd]
+    keep = keep_points(times, chans, tols, holds)
+    kpts = keep.nonzero()[0]
+
+    out = {'time': np.diff(times, prepend=0).astype(np.int32),
+           'kpts': np.diff(kpts, prepend=0).astype(np.int32)}
+    for chan in chans:
+        step = tols[chan] * quant_frac
+        dlt, bad = _delta(_quantise(chans[chan][kpts], step))
+        out['v_' + chan] = dlt
+        if (np.any(bad)):
+            out['n_' + chan] = bad.nonzero()[0].astype(np.int32)
+    for chan in hold_chans:
+        if (chan in fd):
+            out['h_' + chan] = fd.codes(chan)[kpts].astype(np.int8)
+
+    meta = {'n': len(times), 'tols': tols}
+    for name in OSFL.meta_names:
+        if (name in fd):
+            meta[name] = getattr(fd, name)
+    out['meta'] = np.array(json.dumps(meta, default=_to_json))
+    return out
+
+
+def _to_json(obj):
+    """Convert numpy values for json.dumps()."""
+    if (isinstance(obj, np.generic)):
+        return obj.item()
+    raise TypeError(type(obj))
+
+
+def save_flight(fd, outf, tols=None):
+    """Compress a flight and save it to a .npz file.
+
+    Inputs:
+        -   A flight_data class
+        -   The output filename
+        -   (optional) A dict of tolerances, as CNS.compress_tol
+    """
+    with open(outf, 'wb') as fid:
+        np.savez_compressed(fid, **pack_flight(fd, tols))
+
+
+class packed_flight:
+    """A compressed flight, with each column reconstructed when first used.
+
+    Values are accessed by name, as with a flight_data class.
+    raw = dict of the arrays written by pack_flight()
+    n = number of points in the original flight
+    tols = dict of channel name -> tolerance
+    meta = flight_data class holding the per-flight values only
+    """
+
+    __slots__ = ('raw', 'n', 'tols', 'meta', '_kpts', '_frac', '_cols')
+
+    def __init__(self, inf):
+        """Setup the class by reading a file saved by save_flight()."""
+        with np.load(inf, allow_pickle=False) as npz:
+            self.raw = {key: npz[key] for key in npz.files}
+        meta = json.loads(str(self.raw.pop('meta')))
+        self.n = meta.pop('n')
+        self.tols = meta.pop('tols')
+        self.meta = OSFL.flight_data(0)
+        for name in meta:
+            setattr(self.meta, name, meta[name])
+        self._kpts = None
+        self._frac = None
+        self._cols = {}
+
+    def _interp(self):
+        """Find the kept points either side of every point."""
+        if (self._kpts is None):
+            kpts = np.cumsum(self.raw['kpts'].astype(np.int64))
+            pos = np.arange(self.n)
+            idx_a = np.searchsorted(kpts, pos, side='right') - 1
+            idx_b = np.minimum(idx_a + 1, len(kpts) - 1)
+            times = self['time']
+            self._frac = _fracs(times, pos, kpts[idx_a], kpts[idx_b])
+            self._kpts = (idx_a, idx_b)
+        return self._kpts, self._frac
+
+    def _decode(self, key):
+        """Reconstruct a single column."""
+        if (key == 'time'):
+            return np.cumsum(self.raw['time'].astype(np.int64)).astype(
+                np.int32)
+        (idx_a, idx_b), frac = self._interp()
+        if (key in hold_chans):
+            codes = self.raw['h_' + key][idx_a]
+            if (key == 'labl'):
+                return OSFL.label_names[codes]
+            return codes.astype(np.bool_)
+        step = self.tols[key] * quant_frac
+        ival = np.cumsum(self.raw['v_' + key].astype(np.int64))
+        if ('n_' + key in self.raw):
+            ival[self.raw['n_' + key]] = nan_code
+        val = _unquantise(ival, step)
+        # Kept points are used as they are, in case the next point is NaN
+        out = np.where(frac == 0, val[idx_a],
+                       val[idx_a] + (val[idx_b] - val[idx_a]) * frac)
+        if (key == 'hdgs'):
+            out = (out + 180.) % 360. - 180.
+        return out.astype(OSFL.col_types[key])
+
+    def __getitem__(self, key):
+        """Return a column, or a per-flight value, by name."""
+        if (key in OSFL.meta_names):
+            return self.meta[key]
+        if (key not in self):
+            raise KeyError(key)
+        if (key not in self._cols):
+            self._cols[key] = self._decode(key)
+        return self._cols[key]
+
+    def __contains__(self, key):
+        """Check whether a column or per-flight value is present."""
+        if (key in OSFL.meta_names):
+            return key in self.meta
+        return (key == 'time' or 'v_' + key in self.raw or
+                'h_' + key in self.raw)
+
+    def __len__(self):
+        """Return the number of points in the original flight."""
+        return self.n
+
+    def get(self, key, default=None):
+        """Return a column or per-flight value, or default if not present."""
+        if (key in self):
+            return self[key]
+        return default
+
+    def keys(self):
+        """Return the names of the columns and values that are present."""
+        return [key for key in OSFL.col_names + OSFL.meta_names
+                if key in self]
+
+    def n_kept(self):
+        """Return the number of points that were kept."""
+        return len(self.raw['kpts'])
+
+    def to_flight_data(self):
+        """Reconstruct every column into a flight_data class."""
+        fd = OSFL.flight_data(self.n)
+        for key in OSFL.col_names:
+            if (key in self):
+                fd[key] = self[key]
+        for name in OSFL.meta_names:
+            setattr(fd, name, getattr(self.meta, name))
+        return fd
+
+
+def compress_dir(indir):
+    """Compress every flight saved by OS_Output.to_numpy() in a directory.
+
+    Each FLT_*.npy file is written alongside as FLT_*.npz, the originals
+    are not removed.
+    Input:
+        -   The directory to search, including subdirectories
+    Returns:
+        -   The total size of the original and the compressed files
+    """
+    tot_in = 0
+    tot_out = 0
+    for inf in sorted(glob.glob(os.path.join(indir, '**', 'FLT_*.npy'),
+                                recursive=True)):
+        fd = np.load(inf, allow_pickle=True).item()
+        if (not isinstance(fd, OSFL.flight_data)):
+            continue
+        outf = inf[:-4] + '.npz'
+        save_flight(fd, outf)
+        tot_in += os.path.getsize(inf)
+        tot_out += os.path.getsize(outf)
+    return tot_in, tot_out
+
+
+if __name__ == '__main__':
+    for indir in sys.argv[1:]:
+        tot_in, tot_out = compress_dir(indir)
+        print(indir + ':', tot_in, 'bytes compressed to', tot_out, 'bytes')
@@ -32,9 +32,9 @@ gate_alt = 4000
 gate_roc = 150
 
 
-# The threshold distance between the aircraft and the gate, aircraft
+# The threshold distance (km) between the aircraft and the gate, aircraft
 # further than this are not considered for a given runway
-gate_dist = 1. / 112.
+gate_dist = 1.
 
 
 # The threshold altitude for the state change, if change occurs above
@@ -47,6 +47,84 @@ ga_st_alt_t = 2500.
 exclude_list = ['800b7b', '800b7c', '800b7d', '800d5f', '800b87', ]
 
 
+# This is a list of callsign prefixes to exclude, most of these are
+# ground vehicles rather than aircraft.
+exclude_calls = ['WILDLIF', 'AGM000', 'FOLOWME', 'RADAR', 'FIRETEN',
+                 'DUTYOFIR', ]
+
+
 # This variable allows you to select a single callsign to process
 # To keep all aircraft use '', otherwise enter your own, i.e: 'IGO366'
 search_call = ''
+
+
+# Points with the same icao24 and callsign are split into separate flights
+# wherever there is a gap of more than this many minutes between them, as
+# 'traffic' does when iterating over flights. A batch often holds both a
+# departure and a later arrival of the same aircraft.
+flight_gap = 10.
+
+
+# The backend used for the per-point kernels in OS_Kernels. Use 'auto' to
+# select numba if it is installed (and numpy otherwise), or force either
+# 'numba' or 'numpy'.
+kernel_backend = 'auto'
+
+
+# The distance grid (km from the runway threshold) on which the runway
+# approach envelopes are evaluated and flights are scored.
+env_dist_min = -10.
+env_dist_max = 0.1
+env_dist_step = 0.01
+
+
+# The fraction of approach points outside the +/-1 sigma envelope, in any
+# channel, above which an approach is flagged as unstable.
+env_frac_thresh = 0.5
+
+
+# Supervision of the worker processes. A task that takes longer than its
+# timeout (in seconds) has its worker killed and replaced. Tasks that time
+# out or kill their worker are retried up to task_retries times, tasks
+# that raise an error are not retried. Failed tasks are quarantined.
+task_timeout = 300.
+load_timeout = 900.
+task_retries = 1
+
+
+# Saved flights can be compressed by dropping points that can be linearly
+# interpolated from their neighbours, see OS_Compress. Every channel is
+# kept within these tolerances: positions (lat/lon, x/y, runway distance)
+# in km, altitudes in ft, vertical rates in ft/min, headings in degrees and
+# ground speeds in kts.
+compress_out = False
+compress_tol = {'pos': 0.03, 'alts': 25., 'gals': 25., 'rocs': 100.,
+                'hdgs': 2., 'spds': 2.}
+
+
+# Batches of input files are limited to n_files_proc files and to about
+# batch_mb megabytes of data on disk, so that each batch is a similar
+# amount of work. Set to None to always use n_files_proc files.
+batch_mb = 1500.
+
+
+# The estimated cost of processing a flight, used to start the largest
+# flights first so that a few long tracks do not hold up the end of a
+# batch. Each point, and each second of the flight (as it is resampled to
+# one second), add to the cost, and plotting the flight multiplies it.
+cost_point = 1.
+cost_second = 0.5
+cost_plot = 4.
+
+
+# How the worker processes are started. With 'forkserver' each worker is
+# forked from a server that has already imported OS_Preload (the common
+# modules and airport data), which is much quicker than 'spawn' and safe
+# when the main process runs threads. Can also be 'fork' or 'spawn'.
+start_method = 'forkserver'
+preload_modules = ['OS_Preload']
+
+
+# The maximum time, in seconds, that importing OS_Funcs in a new process
+# should take. Checked by running OS_Preload.py as a script.
+import_budget = 1.5
@@ -0,0 +1,361 @@
+"""Detect go-arounds from a script, service or notebook.
+
+detect() runs the same processing as GA_Detect.py but takes all of its
+settings as arguments and yields a 'detection' for each flight as soon as
+it has been processed, so that results can be used while a run is still
+in progress. Only one batch of files is held in memory at a time.
+
+watch() does the same for files as they are downloaded, and runs until it
+is stopped.
+"""
+from datetime import datetime
+import OS_Supervise as OSV
+import OS_Airports as OSA
+import OS_Output as OSO
+import OS_Metrics as OSM
+import OS_Funcs as OSF
+import OS_Stats as OSS
+import pandas as pd
+import glob
+import json
+import time
+import re
+import os
+
+
+# Matches the time in the filenames written by OpenSky_Get_Data.py
+_file_time = re.compile(r'OS_(\d{12})_')
+
+
+class config:
+    """Settings for a detection run.
+
+    indir = directory containing the OpenSky data, as .pkl files
+    outdir = directory to save plots and data into, split into the
+             OUT_PLOT/NORM, OUT_PLOT/PSGA, OUT_DATA/NORM and OUT_DATA/PSGA
+             subdirectories. If None, nothing is saved.
+    n_files_proc = maximum number of files to load in each batch, batches
+                   are also limited by batch_mb in OS_Consts
+    pool_proc = number of worker processes
+    do_plot = whether to plot every flight as it is processed
+    fl_log = filename prefix to log every event for every flight, or None
+    metrics_file = file to rewrite the live metrics into, or None
+    metrics_port = local port to serve the live metrics on, or None
+    metrics_int = interval between rewrites of metrics_file, in seconds
+    q_file = file to list quarantined flights and files in, or None
+    start_n = index of the first file to read
+    fidder = an open file to write log information into, or None
+    colormap = dict of colours used for flightpath labelling
+    """
+
+    def __init__(self, indir, outdir=None, n_files_proc=55, pool_proc=8,
+                 do_plot=False, fl_log=None, metrics_file=None,
+                 metrics_port=None, metrics_int=10., q_file=None,
+                 start_n=0, fidder=None, colormap=OSO.colormap):
+        """Setup the class."""
+        self.indir = indir
+        self.outdir = outdir
+        self.n_files_proc = n_files_proc
+        self.pool_proc = pool_proc
+        self.do_plot = do_plot
+        self.fl_log = fl_log
+        self.metrics_file = metrics_file
+        self.metrics_port = metrics_port
+        self.metrics_int = metrics_int
+        self.q_file = q_file
+        self.start_n = start_n
+        self.fidder = fidder
+        self.colormap = colormap
+
+    def odirs(self):
+        """Return the four output directories used by OS_Funcs.proc_fl()."""
+        if (self.outdir is None):
+            return [None, None, None, None]
+        return [os.path.join(self.outdir, 'OUT_PLOT', 'NORM', ''),
+                os.path.join(self.outdir, 'OUT_PLOT', 'PSGA', ''),
+                os.path.join(self.outdir, 'OUT_DATA', 'NORM', ''),
+                os.path.join(self.outdir, 'OUT_DATA', 'PSGA', '')]
+
+
+class detection:
+    """The result of processing a single landing flight.
+
+    is_ga = True if the flight made a go-around
+    icao24 = icao24 address of the aircraft
+    callsign = callsign of the flight
+    l_time = mid-point time of the flight, used to select the METAR
+    ga_time = time of the go-around, or the start of the flight if none
+    rwy = name of the runway, 'None' if it could not be found
+    hdg, alt, lat, lon = heading, altitude and position at the go-around
+    gapt = array position of the go-around in the flight data
+    rocvar, hdgvar, latvar, lonvar, gspvar = rate of change of the standard
+            deviation of each value before the go-around or landing
+    metar = the METAR used for the barometric correction (metobs), or None
+    source = the file that the flight was first seen in
+    """
+
+    __slots__ = ('is_ga', 'icao24', 'callsign', 'l_time', 'ga_time', 'rwy',
+                 'hdg', 'alt', 'lat', 'lon', 'gapt', 'rocvar', 'hdgvar',
+                 'latvar', 'lonvar', 'gspvar', 'metar', 'source')
+
+    def __init__(self, res, source=None):
+        """Setup the class from the list returned by OS_Funcs.proc_fl()."""
+        for name, val in zip(self.__slots__[:-1], res):
+            setattr(self, name, val)
+        self.is_ga = bool(self.is_ga)
+        # Headings are stored in the range 0 -> 360
+        if (self.hdg < 0):
+            self.hdg = 360 + self.hdg
+        self.source = source
+
+    def __repr__(self):
+        """Return a short description of the detection."""
+        return ('detection(' + self.icao24 + ', ' + self.callsign + ', ' +
+                ('GA' if self.is_ga else 'LANDING') + ', ' + self.rwy +
+                ', ' + str(self.ga_time) + ')')
+
+
+def file_time(inf):
+    """Return the start time of an OpenSky data file, or None if unknown."""
+    mat = _file_time.search(os.path.basename(inf))
+    if (mat is None):
+        return None
+    return datetime.strptime(mat.group(1), '%Y%m%d%H%M')
+
+
+def _file_key(inf):
+    """Sort files by the time in their name, then by their path."""
+    f_time = file_time(inf)
+    return (f_time is not None, f_time or datetime.min, inf)
+
+
+def list_files(indir, start=None, end=None):
+    """Return the sorted list of input files within a time range.
+
+    Files in YYYYMMDD subdirectories, as written by OpenSky_Get_Data.py
+    with 'subdir' set, are included.
+    Inputs:
+        -   The directory containing the OpenSky data
+        -   (optional) The earliest time to include, a datetime
+        -   (optional) The latest time to include, a datetime
+    Returns:
+        -   A list of filenames sorted by the time in their name. If a time
+            range is given then only files with a time in their name within
+            the range are included.
+    """
+    files = sorted(glob.glob(os.path.join(indir, '**', '*.pkl'),
+                             recursive=True), key=_file_key)
+    if (start is None and end is None):
+        return files
+    start = pd.Timestamp(start or pd.Timestamp.min).tz_localize(None)
+    end = pd.Timestamp(end or pd.Timestamp.max).tz_localize(None)
+    return [inf for inf in files
+            if (file_time(inf) is not None and
+                start <= file_time(inf) <= end)]
+
+
+def _file_age(inf):
+    """Return the time since a file was last modified, or -1 if missing."""
+    try:
+        return time.time() - os.path.getmtime(inf)
+    except OSError:
+        return -1.
+
+
+def watch_files(indir, poll=60., settle=120., state_file=None, start=None):
+    """Yield each group of new input files as it appears, forever.
+
+    OpenSky_Get_Data.py only gives a file its final name once it has been
+    completely written, but it downloads several hours at once and they
+    can finish in any order. Files are therefore only used once they have
+    not changed for 'settle' seconds, and are then taken in time order.
+    Inputs:
+        -   The directory containing the OpenSky data
+        -   (optional) The time between checks for new files, in seconds
+        -   (optional) The time a file must be unchanged to be used
+        -   (optional) A JSON file listing the files already processed, so
+            that they are skipped if watching is restarted
+        -   (optional) The earliest file time to process, a datetime
+    Yields:
+        -   The number of files yielded before this group
+        -   A list of new files in time order
+    """
+    done = set()
+    if (state_file is not None and os.path.exists(state_file)):
+        with open(state_file, 'r') as fid:
+            done = set(json.load(fid))
+    n_done = 0
+    while True:
+        new = [inf for inf in list_files(indir, start)
+               if (inf not in done and _file_age(inf) >= settle)]
+        if (len(new) == 0):
+            time.sleep(poll)
+            continue
+        yield n_done, new
+        # The files have now been processed, apart from any flights held
+        # back to join onto the next file
+        done.update(new)
+        n_done += len(new)
+        if (state_file is not None):
+            with open(state_file + '.tmp', 'w') as fid:
+                json.dump(sorted(done), fid, indent=0)
+            os.replace(state_file + '.tmp', state_file)
+
+
+def detect(airport, start=None, end=None, cfg=None, tally=None,
+           mets=None, on_batch=None):
+    """Detect go-arounds, yielding each result as soon as it is ready.
+
+    The workers are stopped when the generator finishes, or when it is
+    closed early by the caller.
+    Inputs:
+        -   An airport class from OS_Airports.get_airport(), or its ICAO code
+        -   (optional) The earliest file time to process, a datetime
+        -   (optional) The latest file time to process, a datetime
+        -   (optional) A config class, if None the input directory is the
+            current directory and nothing is saved
+        -   (optional) An OS_Stats.tally class to add the event counts to
+        -   (optional) An OS_Metrics.metrics class, if None then one is
+            made when cfg.metrics_file or cfg.metrics_port are set
+        -   (optional) A function called with the list of detections in
+            each batch once the batch is complete, i.e: to save them
+    Yields:
+        -   A detection class for each landing flight
+    """
+    if (cfg is None):
+        cfg = config('./')
+    files = list_files(cfg.indir, start, end)
+    yield from _run(airport, cfg, tally, mets, on_batch, files)
+
+
+def watch(airport, cfg, tally=None, mets=None, on_batch=None, poll=60.,
+          settle=120., state_file=None, start=None):
+    """Detect go-arounds in new files as they are downloaded.
+
+    Each new file, or group of files, is processed as soon as it is ready
+    (see watch_files()). Flights that end close to the end of the data
+    are held back until the next file arrives, as they may continue into
+    it. This never finishes, the workers are stopped when the generator
+    is closed or the process is interrupted.
+    Inputs:
+        -   An airport class from OS_Airports.get_airport(), or its ICAO code
+        -   A config class, cfg.indir is the directory to watch
+        -   (optional) An OS_Stats.tally class to add the event counts to
+        -   (optional) An OS_Metrics.metrics class
+        -   (optional) A function called with the list of detections in
+            each batch once the batch is complete
+        -   (optional) The time between checks for new files, in seconds
+        -   (optional) The time a file must be unchanged to be used
+        -   (optional) A JSON file to record the files processed in, so
+            that watching can be restarted
+        -   (optional) The earliest file time to process, a datetime
+    Yields:
+        -   A detection class for each landing flight
+    """
+    batches = watch_files(cfg.indir, poll, settle, state_file, start)
+    yield from _run(airport, cfg, tally, mets, on_batch, None, batches)
+
+
+def _run(airport, cfg, tally, mets, on_batch, files, batches=None):
+    """Run the detection on a list of files, or on batches of files.
+
+    See detect() and watch() for the inputs, 'files' and 'batches' are
+    passed to OS_Funcs.get_batches().
+    """
+    if (isinstance(airport, str)):
+        airport = OSA.get_airport(airport)
+    if (tally is None):
+        tally = OSS.tally()
+    odirs = cfg.odirs()
+    for odir in odirs:
+        if (odir is not None):
+            os.makedirs(odir, exist_ok=True)
+
+    # Parse the METARs (or load them from the cache) once, before the
+    # workers start, so that every worker shares the same table
+    OSF.use_metars(airport.metar_file)
+    OSF.get_metar_table()
+
+    own_mets = False
+    if (mets is None and (cfg.metrics_file is not None or
+                          cfg.metrics_port is not None)):
+        mets = OSM.metrics(cfg.pool_proc)
+        mets.start(cfg.metrics_file, cfg.metrics_port, cfg.metrics_int)
+        own_mets = True
+
+    # Total number of aircraft seen, and of which go-arounds
+    tot_n_ac = 0
+    tot_n_ga = 0
+
+    pool = OSV.supervisor(cfg.pool_proc, initializer=OSF.init_worker,
+                          initargs=(airport.metar_file, cfg.fl_log),
+                          qfile=cfg.q_file, preload=[airport.icao_name])
+    try:
+        for main_count, flights, srcs in OSF.get_batches(files, cfg.start_n,
+                                                         cfg.n_files_proc,
+                                                         pool, airport,
+                                                         cfg.fidder, mets,
+                                                         batches):
+            t_start = time.perf_counter()
+            tasks = []
+            costs = []
+            dets = []
+            for flight in flights:
+                key = (flight.icao24, flight.callsign,
+                       srcs.get(flight.flight_id))
+                costs.append(OSF.flight_cost(flight, cfg.do_plot))
+                tasks.append((key, (OSF.proc_fl,
+                                    flight,
+                                    airport.rwy_list,
+                                    odirs,
+                                    cfg.colormap,
+                                    cfg.do_plot,
+                                    cfg.fl_log is not None,)))
+
+            # Start the longest flights first, so that the workers all
+            # finish at about the same time
+            for i, (key, p_res) in enumerate(pool.run(OSS.run_counted, tasks,
+                                                      costs=costs)):
+                t_res, t_cnt, t_time = p_res
+                tally.add(t_cnt)
+                if (mets is not None):
+                    mets.add_events(t_cnt)
+                    mets.observe('proc', t_time)
+                    mets.inc('ga_worker_busy_seconds_total', t_time,
+                             'Time spent by workers processing flights')
+                    mets.inc('ga_flights_total', 1, 'Flights processed')
+                    mets.set('ga_flight_queue_depth', len(tasks) - i - 1,
+                             'Flights waiting for or being processed')
+                if (t_res == -1):
+                    continue
+                det = detection(t_res, key[2])
+                tot_n_ac += 1
+                if (det.is_ga):
+                    tot_n_ga += 1
+                    if (mets is not None):
+                        mets.inc('ga_go_arounds_total', 1,
+                                 'Go-arounds detected')
+                dets.append(det)
+                yield det
+
+            print("\t-\tHave processed " + str(tot_n_ac) +
+                  " aircraft. Have seen " + str(tot_n_ga) + " go-arounds.")
+
+            # Include the counts from this process, i.e: the pre-filter
+            t_cnt = OSS.take()
+            tally.add(t_cnt)
+            if (mets is not None):
+                mets.add_events(t_cnt)
+                mets.observe('batch', time.perf_counter() - t_start)
+            if (on_batch is not None):
+                on_batch(dets)
+            batch_rep = tally.end_batch()
+            if (cfg.fidder is not None):
+                cfg.fidder.write(batch_rep)
+    finally:
+        if (own_mets):
+            mets.stop()
+        pool.close()
+        if (len(pool.quarantine) > 0):
+            print("Quarantined " + str(len(pool.quarantine)) +
+                  " flights or files, see " + str(cfg.q_file))
@@ -0,0 +1,139 @@
+"""Approach envelopes for each runway and conformance scoring of flights.
+
+Each runway in OS_Airports holds polynomial fits (mean and +/-1 sigma) of
+several flight parameters against distance to the runway threshold. These
+are evaluated once per runway onto a fixed distance grid and cached, so
+that plots and scoring only need array lookups.
+"""
+import OS_Consts as CNS
+import numpy as np
+
+
+# Channels in the envelope: name -> (flight data key, runway attributes)
+channels = {'alt': ('alts', ('alts1', 'altm', 'altp1')),
+            'roc': ('rocs', ('rocs1', 'rocm', 'rocp1')),
+            'hdg': ('hdgs', ('hdgs1', 'hdgm', 'hdgp1')),
+            'gal': ('gals', ('gals1', 'galm', 'galp1')),
+            'lat': ('lats', ('lats1', 'latm', 'latp1')),
+            'lon': ('lons', ('lons1', 'lonm', 'lonp1'))}
+
+# Evaluated envelopes, keyed by runway name and threshold position
+_envelopes = {}
+
+
+class envelope:
+    """The approach envelope of a runway, evaluated on a distance grid.
+
+    dists = distance to threshold of each grid point in km
+    names = list of channels available for this runway
+    table = array of shape (n_channels, 3, n_dists) holding the -1 sigma,
+            mean and +1 sigma values of each channel at each distance
+    """
+
+    def __init__(self, rwy):
+        """Evaluate the polynomials for a runway from OS_Airports."""
+        self.dmin = CNS.env_dist_min
+        self.step = CNS.env_dist_step
+        self.dists = np.arange(CNS.env_dist_min,
+                               CNS.env_dist_max + self.step,
+                               self.step)
+        self.names = []
+        tabs = []
+        for chan in channels:
+            attrs = channels[chan][1]
+            if (any(getattr(rwy, attr, None) is None for attr in attrs)):
+                continue
+            self.names.append(chan)
+            tabs.append([np.polyval(getattr(rwy, attr), self.dists)
+                         for attr in attrs])
+        self.table = np.array(tabs, dtype=np.float64).reshape(
+            (len(self.names), 3, len(self.dists)))
+
+    def get(self, chan):
+        """Return the -1 sigma, mean and +1 sigma arrays for a channel.
+
+        Returns None if the runway has no fit for the channel.
+        """
+        if (chan not in self.names):
+            return None
+        tab = self.table[self.names.index(chan)]
+        return tab[0], tab[1], tab[2]
+
+    def lookup(self, rdis):
+        """Find the grid position for each distance.
+
+        Input:
+            -   An array of distances to the runway threshold in km
+        Returns:
+            -   An int array of grid positions, -1 outside the grid
+        """
+        idx = np.rint((np.asarray(rdis) - self.dmin) / self.step)
+        idx[~np.isfinite(idx)] = -1
+        idx = idx.astype(np.int64)
+        idx[(idx < 0) | (idx >= len(self.dists))] = -1
+        return idx
+
+
+def get_envelope(rwy):
+    """Return the cached envelope for a runway, creating it if needed.
+
+    Input:
+        -   A runway class, defined in OS_Airports
+    Returns:
+        -   An envelope class
+    """
+    key = (rwy.name, tuple(rwy.rwy))
+    if (key not in _envelopes):
+        _envelopes[key] = envelope(rwy)
+    return _envelopes[key]
+
+
+def score_flight(fd, rwy):
+    """Score how closely a flight follows the approach envelope of a runway.
+
+    All channels and points are scored together. Each point within the
+    envelope grid is converted into a deviation from the mean in units of
+    sigma, where sigma is half the spread between the -1 and +1 envelopes.
+    Inputs:
+        -   A flight_data class, which must include 'rdis'
+        -   A runway class, defined in OS_Airports
+    Returns:
+        A dict containing:
+        -   npts: Number of points within the envelope grid
+        -   One entry per channel, giving a dict of:
+            -   frac: Fraction of points outside +/-1 sigma
+            -   rms: Root mean square deviation in sigma
+            -   max: Largest absolute deviation in sigma
+        -   worst: The largest 'frac' across all channels
+        -   unstable: True if 'worst' exceeds CNS.env_frac_thresh
+    """
+    env = get_envelope(rwy)
+    idx = env.lookup(fd['rdis'])
+    good = (idx >= 0).nonzero()[0]
+    metrics = {'npts': len(good), 'worst': 0., 'unstable': False}
+    if (len(good) == 0 or len(env.names) == 0):
+        return metrics
+
+    vals = np.array([fd[channels[chan][0]][good] for chan in env.names],
+                    dtype=np.float64)
+    tab = env.table[:, :, idx[good]]
+    sigma = np.abs(tab[:, 2, :] - tab[:, 0, :]) / 2.
+    sigma[sigma == 0] = np.nan
+    dev = np.abs(vals - tab[:, 1, :]) / sigma
+
+    with np.errstate(invalid='ignore'):
+        n_ok = np.sum(np.isfinite(dev), axis=1)
+        n_out = np.sum(dev > 1, axis=1)
+        frac = np.where(n_ok > 0, n_out / np.maximum(n_ok, 1), 0.)
+        sq = np.where(np.isfinite(dev), dev * dev, 0.)
+        rms = np.sqrt(np.sum(sq, axis=1) / np.maximum(n_ok, 1))
+        mx = np.max(np.where(np.isfinite(dev), dev, 0.), axis=1)
+
+    for i, chan in enumerate(env.names):
+        metrics[chan] = {'frac': float(frac[i]),
+                         'rms': float(rms[i]),
+                         'max': float(mx[i])}
+    metrics['worst'] = float(np.max(frac))
+    metrics['unstable'] = metrics['worst'] > CNS.env_frac_thresh
+
+    return metrics
@@ -0,0 +1,406 @@
+"""A local stand-in for the OpenSky history database.
+
+fake_opensky.history() takes the same arguments as opensky.history() from
+the 'traffic' library and returns the same kind of result, so that
+OpenSky_Get_Data.py can be run, timed and tested without the real service.
+Data are either taken from an existing archive of hourly files or made up
+as synthetic approaches to the airport's runways. The time taken by each
+query, the number of queries that can run at once and the failures are all
+configurable. Random values are seeded by the time requested, so the data
+and the failures do not depend on the number or order of the workers.
+
+Running this file as a script summarises the request log of a fake run.
+"""
+from datetime import datetime, timedelta
+import OS_Airports as OSA
+import pandas as pd
+import numpy as np
+import click
+import fcntl
+import glob
+import json
+import time
+import os
+
+
+# The ways in which a query can fail:
+#   error: raise an exception after the latency
+#   timeout: raise an exception after fail_wait seconds
+#   empty: return no data, as for an hour with no flights
+fail_modes = ['error', 'timeout', 'empty']
+
+# Filename of the request log, within state_dir
+log_name = 'FAKESKY_LOG.jsonl'
+
+# Instances already made in this process, see get_fake()
+_fakes = {}
+
+
+class fake_opensky:
+    """A fake OpenSky history database.
+
+    apt = airport class, synthetic approaches are made to its runways
+    src = directory of hourly files to serve instead of synthetic data
+    n_hour = mean number of synthetic flights landing per hour
+    ga_frac = fraction of synthetic flights that go around
+    step = time between the synthetic positions of a flight, in seconds
+    latency = time before every query returns, in seconds
+    jitter = maximum random time added to the latency, in seconds
+    row_rate = maximum rows returned per second by each query, or None
+    max_active = maximum number of queries that run at once, or None.
+                 This is shared between processes through state_dir.
+    fail_rate = probability that a query fails
+    fail_mode = how a query fails, one of fail_modes
+    fail_wait = time before a query fails in 'timeout' mode, in seconds
+    max_fails = maximum number of failures for each hour, so that retries
+                eventually succeed, or None for no limit
+    seed = seed for all random values
+    state_dir = directory for the request log and the query slots, or None.
+                Failures are counted across processes and runs only if set.
+    """
+
+    def __init__(self, apt, src=None, n_hour=30., ga_frac=0.02, step=5.,
+                 latency=0.5, jitter=0., row_rate=None, max_active=None,
+                 fail_rate=0., fail_mode='error', fail_wait=30.,
+                 max_fails=None, seed=0, state_dir=None):
+        """Setup the class."""
+        if (isinstance(apt, str)):
+            apt = OSA.get_airport(apt)
+        if (fail_mode not in fail_modes):
+            raise ValueError("Unknown fail_mode " + str(fail_mode) +
+                             ", choose from " + ', '.join(fail_modes))
+        if (max_active is not None and state_dir is None):
+            raise ValueError("max_active needs a state_dir to share slots")
+        self.apt = apt
+        self.src = src
+        self.n_hour = n_hour
+        self.ga_frac = ga_frac
+        self.step = step
+        self.latency = latency
+        self.jitter = jitter
+        self.row_rate = row_rate
+        self.max_active = max_active
+        self.fail_rate = fail_rate
+        self.fail_mode = fail_mode
+        self.fail_wait = fail_wait
+        self.max_fails = max_fails
+        self.seed = seed
+        self.state_dir = state_dir
+        self._fails = {}
+        if (state_dir is not None):
+            os.makedirs(state_dir, exist_ok=True)
+
+    def history(self, start, stop, bounds, other_params=None, **kwargs):
+        """Return the state vectors within a time range and bounds.
+
+        Inputs:
+            -   The start time, a datetime
+            -   The end time, a datetime
+            -   A list of [min lon, min lat, max lon, max lat]
+            -   (optional) Ignored, as are any other arguments that
+                opensky.history() accepts
+        Returns:
+            -   A Traffic class, or None if there is no data
+        """
+        start = pd.Timestamp(start)
+        if (start.tzinfo is None):
+            start = start.tz_localize('UTC')
+        stop = pd.Timestamp(stop)
+        if (stop.tzinfo is None):
+            stop = stop.tz_localize('UTC')
+        key = start.strftime("%Y%m%d%H%M")
+        n_fail = self._count_fails(key)
+        rng = np.random.default_rng([self.seed, int(start.timestamp()),
+                                     n_fail])
+
+        slot = self._acquire()
+        t_req = time.time()
+        status = 'OK'
+        rows = 0
+        try:
+            wait = self.latency + self.jitter * rng.uniform()
+            if ((self.max_fails is None or n_fail < self.max_fails) and
+                    rng.uniform() < self.fail_rate):
+                status = self.fail_mode.upper()
+                if (self.fail_mode == 'timeout'):
+                    wait = self.fail_wait
+                time.sleep(wait)
+                if (self.fail_mode == 'empty'):
+                    return None
+                raise RuntimeError("Fake OpenSky query failed (" +
+                                   self.fail_mode + ") for " + key)
+
+            if (self.src is not None):
+                df = self._recorded(start, stop, bounds)
+            else:
+                df = self._synthetic(start, stop, bounds)
+            rows = len(df)
+            if (self.row_rate is not None):
+                wait = wait + rows / self.row_rate
+            # Data are made while the latency is counting down
+            time.sleep(max(0., t_req + wait - time.time()))
+            if (rows == 0):
+                status = 'EMPTY'
+                return None
+            from traffic.core import Traffic
+            return Traffic(df)
+        finally:
+            self._release(slot)
+            self._log(key, t_req, status, rows, n_fail)
+
+    def _count_fails(self, key):
+        """Return the number of earlier failures for an hour."""
+        if (self.state_dir is None):
+            return self._fails.get(key, 0)
+        logf = os.path.join(self.state_dir, log_name)
+        if (not os.path.exists(logf)):
+            return 0
+        n_fail = 0
+        with open(logf, 'r') as fid:
+            for line in fid:
+                entry = json.loads(line)
+                if (entry['hour'] == key and entry['status'] not in
+                        ('OK', 'EMPTY')):
+                    n_fail += 1
+        return n_fail
+
+    def _log(self, key, t_req, status, rows, n_fail):
+        """Record a query in the request log."""
+        if (status not in ('OK', 'EMPTY')):
+            self._fails[key] = self._fails.get(key, 0) + 1
+        if (self.state_dir is None):
+            return
+        entry = {'hour': key, 'pid': os.getpid(), 't_req': t_req,
+                 't_done': time.time(), 'status': status, 'rows': rows,
+                 'attempt': n_fail}
+        # A single short write, so lines from several processes don't mix
+        with open(os.path.join(self.state_dir, log_name), 'a') as fid:
+            fid.write(json.dumps(entry) + '\n')
+
+    def _acquire(self):
+        """Wait for a free query slot, if the number of queries is limited.
+
+        Returns:
+            -   The open, locked slot file, or None if not limited
+        """
+        if (self.max_active is None):
+            return None
+        while True:
+            for n_slot in range(self.max_active):
+                fid = open(os.path.join(self.state_dir,
+                                        'SLOT_' + str(n_slot) + '.lock'), 'a')
+                try:
+                    fcntl.flock(fid, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fid
+                except OSError:
+                    fid.close()
+            time.sleep(0.01)
+
+    def _release(self, slot):
+        """Free a query slot from _acquire()."""
+        if (slot is not None):
+            fcntl.flock(slot, fcntl.LOCK_UN)
+            slot.close()
+
+    def _recorded(self, start, stop, bounds):
+        """Select the state vectors for a query from the archive in src."""
+        t0 = start.tz_convert(None).to_pydatetime() - timedelta(hours=1)
+        t1 = stop.tz_convert(None).to_pydatetime()
+        dfs = []
+        for inf in sorted(glob.glob(os.path.join(self.src, '**', 'OS_*.pkl'),
+                                    recursive=True)):
+            # Filenames are as written by OpenSky_Get_Data.hour_file()
+            try:
+                f_time = datetime.strptime(os.path.basename(inf)[3:15],
+                                           '%Y%m%d%H%M')
+            except ValueError:
+                continue
+            if (f_time < t0 or f_time > t1):
+                continue
+            df = pd.read_pickle(inf)
+            times = pd.to_datetime(df['timestamp'], utc=True)
+            dfs.append(df[(times >= start) & (times < stop) &
+                          (df['longitude'] >= bounds[0]) &
+                          (df['latitude'] >= bounds[1]) &
+                          (df['longitude'] <= bounds[2]) &
+                          (df['latitude'] <= bounds[3])])
+        if (len(dfs) == 0):
+            return pd.DataFrame()
+        return pd.concat(dfs, ignore_index=True)
+
+    def _synthetic(self, start, stop, bounds):
+        """Make the state vectors for a query from synthetic approaches.
+
+        The flights landing in each hour are made from a seed for that
+        hour, and the hours either side are included, so flights that
+        cross the edges of a query match those in the next query.
+        """
+        dfs = []
+        hour = start.floor('h') - pd.Timedelta(hours=1)
+        while (hour <= stop):
+            dfs.extend(self._hour_flights(hour))
+            hour = hour + pd.Timedelta(hours=1)
+        if (len(dfs) == 0):
+            return pd.DataFrame()
+        df = pd.concat(dfs, ignore_index=True)
+        keep = ((df['timestamp'] >= start) & (df['timestamp'] < stop) &
+                (df['longitude'] >= bounds[0]) &
+                (df['latitude'] >= bounds[1]) &
+                (df['longitude'] <= bounds[2]) &
+                (df['latitude'] <= bounds[3]))
+        return df[keep].sort_values('timestamp', kind='stable').reset_index(
+            drop=True)
+
+    def _hour_flights(self, hour):
+        """Make the synthetic flights that land within one hour."""
+        rng = np.random.default_rng([self.seed, int(hour.timestamp()), 1])
+        n_fl = rng.poisson(self.n_hour)
+        land = np.sort(rng.uniform(0, 3600, n_fl))
+        return [make_approach(self.apt.rwy_list[rng.integers(
+                    len(self.apt.rwy_list))],
+                    hour + pd.Timedelta(seconds=float(land[i])),
+                    rng.uniform() < self.ga_frac, self.step, rng)
+                for i in range(n_fl)]
+
+
+def make_approach(rwy, l_time, is_ga, step, rng):
+    """Make the state vectors of a synthetic approach to a runway.
+
+    The aircraft descends along the extended centreline on a 3 degree
+    glideslope. It then either lands and slows down along the runway, or
+    goes around and climbs away.
+    Inputs:
+        -   A runway class, defined in OS_Airports
+        -   The time of landing, or of the go-around, a UTC Timestamp
+        -   A bool, True for a go-around
+        -   The time between positions, in seconds
+        -   A numpy random Generator
+    Returns:
+        -   A dataframe in the same format as Traffic.data
+    """
+    # Seconds from landing, 12 minutes before to 2 minutes after
+    secs = np.arange(-720., 120. + step, step)
+    npts = len(secs)
+    spds = np.where(secs < 0, 140. - 0.02 * secs, 140. - 1.0 * secs)
+    if (is_ga):
+        spds = np.where(secs < 0, spds, 140. + 0.2 * secs)
+    spds = np.maximum(spds, 15.) + rng.normal(0, 2, npts)
+    # Distance to the threshold in km, negative on the approach
+    dist = np.cumsum(spds * 0.000514 * step)
+    dist = dist - np.interp(0., secs, dist)
+    alts = np.where(dist < 0, 50. - dist * 172., 0.)
+    if (is_ga):
+        alts = np.where(secs < 0, alts, 50. + 25. * secs)
+    alts = alts + rng.normal(0, 15, npts)
+    ongd = (alts < 20.) & (secs >= 0)
+    alts[ongd] = 0.
+
+    # Position along the centreline, using the gate for the approach and
+    # the far end of the runway after the threshold
+    rlat, rlon = rwy.rwy
+    gate_km = np.hypot((rwy.gate[0] - rlat) * 111.,
+                       (rwy.gate[1] - rlon) * 111. * np.cos(np.radians(rlat)))
+    rwy_km = np.hypot((rwy.rwy2[0] - rlat) * 111.,
+                      (rwy.rwy2[1] - rlon) * 111. * np.cos(np.radians(rlat)))
+    lats = np.where(dist < 0, rlat - (rwy.gate[0] - rlat) * dist / gate_km,
+                    rlat + (rwy.rwy2[0] - rlat) * dist / rwy_km)
+    lons = np.where(dist < 0, rlon - (rwy.gate[1] - rlon) * dist / gate_km,
+                    rlon + (rwy.rwy2[1] - rlon) * dist / rwy_km)
+    times = l_time + pd.to_timedelta(secs, unit='s')
+
+    return pd.DataFrame({'timestamp': times,
+                         'last_position': times,
+                         'icao24': '%06x' % rng.integers(0x800000, 0x8fffff),
+                         'callsign': 'FAK' + str(rng.integers(100, 9999)),
+                         'latitude': lats + rng.normal(0, 2e-5, npts),
+                         'longitude': lons + rng.normal(0, 2e-5, npts),
+                         'altitude': alts,
+                         'geoaltitude': alts + 150. + rng.normal(0, 10, npts),
+                         'groundspeed': spds,
+                         'track': (rwy.mainhdg + rng.normal(0, 1, npts)) % 360,
+                         'vertical_rate': np.gradient(alts, secs) * 60.,
+                         'onground': ongd})
+
+
+def get_fake(icao, opts):
+    """Return a fake_opensky for an airport, made once per process.
+
+    Inputs:
+        -   The ICAO code of the airport
+        -   A dict of settings for fake_opensky
+    Returns:
+        -   A fake_opensky class
+    """
+    key = (icao, json.dumps(opts, sort_keys=True))
+    if (key not in _fakes):
+        _fakes[key] = fake_opensky(icao, **opts)
+    return _fakes[key]
+
+
+def parse_opts(items):
+    """Convert 'name=value' strings into settings for fake_opensky.
+
+    Values are read as JSON where possible, and as strings otherwise.
+    Input:
+        -   A list of strings, i.e: ['latency=2', 'fail_mode=timeout']
+    Returns:
+        -   A dict of name -> value
+    """
+    opts = {}
+    for item in items:
+        name, val = item.split('=', 1)
+        try:
+            opts[name.strip()] = json.loads(val)
+        except ValueError:
+            opts[name.strip()] = val
+    return opts
+
+
+def summarise(state_dir):
+    """Summarise the request log of a fake run.
+
+    Input:
+        -   The state_dir given to fake_opensky
+    Returns:
+        A dict containing:
+        -   n_req: Number of queries
+        -   n_fail: Number of failed queries
+        -   n_hours: Number of distinct hours requested
+        -   wall: Time from the first query to the last reply, in seconds
+        -   mean_dur: Mean duration of a query, in seconds
+        -   peak_active: Largest number of queries running at once
+        -   rows: Total rows returned
+        -   rows_per_sec: Rows returned per second of wall time
+    """
+    with open(os.path.join(state_dir, log_name), 'r') as fid:
+        log = [json.loads(line) for line in fid]
+    if (len(log) == 0):
+        return {'n_req': 0}
+    t_req = np.array([entry['t_req'] for entry in log])
+    t_done = np.array([entry['t_done'] for entry in log])
+    # Each query adds one when it starts and removes one when it ends
+    events = np.concatenate((np.ones(len(log)), -np.ones(len(log))))
+    order = np.lexsort((events, np.concatenate((t_req, t_done))))
+    wall = float(np.max(t_done) - np.min(t_req))
+    rows = sum(entry['rows'] for entry in log)
+    return {'n_req': len(log),
+            'n_fail': sum(entry['status'] not in ('OK', 'EMPTY')
+                          for entry in log),
+            'n_hours': len(set(entry['hour'] for entry in log)),
+            'wall': wall,
+            'mean_dur': float(np.mean(t_done - t_req)),
+            'peak_active': int(np.max(np.cumsum(events[order]))),
+            'rows': rows,
+            'rows_per_sec': rows / wall if (wall > 0) else 0.}
+
+
+@click.command()
+@click.argument('state_dir')
+def main(state_dir):
+    """Print a summary of the request log in STATE_DIR."""
+    for key, val in summarise(state_dir).items():
+        print(key + ':', val)
+
+
+if __name__ == '__main__':
+    main()
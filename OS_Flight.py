@@ -0,0 +1,195 @@
+"""A compact container for the data of a single flight.
+
+The per-point data (positions, altitudes, rates, labels etc) are held as
+float64, float32, int32 or int8 columns packed into one contiguous buffer,
+and the per-flight details are stored as integers where possible. Values
+are read and written by name, as with a dict, so fd['alts'] returns a view
+of the altitude column and fd['strt'] returns the start time as a
+Timestamp.
+"""
+import pandas as pd
+import numpy as np
+
+
+# The per-point columns and their storage types. Columns are packed into
+# the buffer in this order, widest first, so that each one is aligned.
+# Latitude and longitude stay float64, as float32 only resolves ~1e-6
+# degrees and the latvar / lonvar features are computed from them.
+columns = [('lats', np.float64),
+           ('lons', np.float64),
+           ('time', np.int32),
+           ('alts', np.float32),
+           ('spds', np.float32),
+           ('gals', np.float32),
+           ('hdgs', np.float32),
+           ('rocs', np.float32),
+           ('xs', np.float32),
+           ('ys', np.float32),
+           ('rdis', np.float32),
+           ('xtrk', np.float32),
+           ('ongd', np.bool_),
+           ('labl', np.int8)]
+
+col_names = [name for name, dtype in columns]
+col_types = dict(columns)
+
+# Flight phase labels, stored in the 'labl' column as an index into this
+label_names = np.array(['NA', 'GND', 'CL', 'CR', 'DE', 'LVL'])
+
+# The per-flight values
+meta_names = ['call', 'ic24', 'strt', 'stop', 'dura', 'rwy', 'posser',
+              'gapt', 'min_alt_pt', 'envs']
+
+
+def _layout():
+    """Return the position, per point, and type of each column."""
+    lay = {}
+    off = 0
+    for i, (name, dtype) in enumerate(columns):
+        size = np.dtype(dtype).itemsize
+        lay[name] = (i, off, size, dtype)
+        off += size
+    return lay, off
+
+
+_cols, _row_size = _layout()
+
+
+def encode_labels(labels):
+    """Convert flight phase labels into the codes used in the 'labl' column.
+
+    Input:
+        -   An array of string labels, such as that from do_labels()
+    Returns:
+        -   An int8 array of codes, labels not in label_names are 'NA'
+    """
+    labels = np.asarray(labels)
+    codes = np.zeros(len(labels), dtype=np.int8)
+    for i, name in enumerate(label_names):
+        codes[labels == name] = i
+    return codes
+
+
+class flight_data:
+    """The data for a single flight, with one buffer for all the columns.
+
+    n = number of points in the flight
+    buf = uint8 array holding every column
+    has = bitmask of the columns that have been set
+    call = callsign
+    ic24 = icao24 address, as an int
+    strt, stop = time of the first and last position, in ns since 1970
+    dura = duration of the flight in ns
+    rwy = name of the landing runway, 'None' if not found
+    posser = array position of the landing
+    gapt = array position of the go-around
+    min_alt_pt = array position of the minimum altitude
+    envs = approach envelope scores, from OS_Envelope.score_flight()
+    """
+
+    __slots__ = ('n', 'buf', 'has', 'call', 'ic24', 'strt', 'stop', 'dura',
+                 'rwy', 'posser', 'gapt', 'min_alt_pt', 'envs')
+
+    def __init__(self, n):
+        """Setup the class with space for n points."""
+        self.n = n
+        self.buf = np.zeros(n * _row_size, dtype=np.uint8)
+        self.has = 0
+        for name in meta_names:
+            setattr(self, name, None)
+
+    def _col(self, name):
+        """Return a view of a single column in the buffer."""
+        i, off, size, dtype = _cols[name]
+        off = off * self.n
+        return self.buf[off:off + size * self.n].view(dtype)
+
+    def __getitem__(self, key):
+        """Return a column, or a per-flight value, by name."""
+        if (key in _cols):
+            if (not self.has & (1 << _cols[key][0])):
+                raise KeyError(key)
+            if (key == 'labl'):
+                return label_names[self._col(key)]
+            return self._col(key)
+        if (key not in meta_names or getattr(self, key) is None):
+            raise KeyError(key)
+        val = getattr(self, key)
+        if (key == 'ic24'):
+            return format(val, '06x')
+        elif (key in ('strt', 'stop')):
+            return pd.Timestamp(val)
+        elif (key == 'dura'):
+            return pd.Timedelta(val)
+        return val
+
+    def __setitem__(self, key, val):
+        """Set a column, or a per-flight value, by name."""
+        if (key in _cols):
+            val = np.asarray(val)
+            if (val.shape != (self.n,)):
+                raise ValueError('Column ' + key + ' must have ' +
+                                 str(self.n) + ' points, not ' +
+                                 str(val.shape))
+            if (key == 'labl' and not np.issubdtype(val.dtype, np.integer)):
+                val = encode_labels(val)
+            self._col(key)[:] = val
+            self.has |= 1 << _cols[key][0]
+        elif (key == 'ic24'):
+            self.ic24 = int(val, 16)
+        elif (key in ('strt', 'stop')):
+            setattr(self, key, pd.Timestamp(val).value)
+        elif (key == 'dura'):
+            self.dura = pd.Timedelta(val).value
+        elif (key == 'min_alt_pt'):
+            pts = np.ravel(val)
+            self.min_alt_pt = int(pts[0]) if (len(pts) > 0) else -1
+        elif (key in meta_names):
+            setattr(self, key, val)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        """Check whether a column or per-flight value has been set."""
+        if (key in _cols):
+            return bool(self.has & (1 << _cols[key][0]))
+        return key in meta_names and getattr(self, key) is not None
+
+    def __len__(self):
+        """Return the number of points in the flight."""
+        return self.n
+
+    def get(self, key, default=None):
+        """Return a column or per-flight value, or default if not set."""
+        if (key in self):
+            return self[key]
+        return default
+
+    def keys(self):
+        """Return the names of the columns and values that have been set."""
+        return [key for key in col_names + meta_names if key in self]
+
+    def codes(self, key='labl'):
+        """Return the integer codes of the flight phase labels."""
+        if (key not in self):
+            raise KeyError(key)
+        return self._col(key)
+
+    def copy(self):
+        """Return a copy of the flight, with its own buffer."""
+        out = flight_data.__new__(flight_data)
+        for name in self.__slots__:
+            setattr(out, name, getattr(self, name))
+        out.buf = self.buf.copy()
+        if (isinstance(self.envs, dict)):
+            out.envs = dict(self.envs)
+        return out
+
+    def __getstate__(self):
+        """Return the state for pickling."""
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        """Restore the state when unpickling."""
+        for name, val in zip(self.__slots__, state):
+            setattr(self, name, val)
@@ -1,25 +1,69 @@
 """Core methods for processing ADS-B data and detecting go-arounds."""
-from scipy.interpolate import UnivariateSpline as UniSpl
-from traffic.core import Traffic
+from OS_Airports.projection import runway_coords
 from datetime import timedelta
 import metar_parse as MEP
 import pandas as pd
 
-import flightphase as flph
+# traffic and flightphase are slow to import, so are only imported by the
+# functions that use them. See also OS_Preload.
+import OS_Envelope as OSE
+import OS_Kernels as OSK
+import OS_Flight as OSFL
 import OS_Output as OSO
 import OS_Consts as CNS
+import OS_Stats as OSS
 import numpy as np
+import time
+import os
 
 
-# Read METARs from disk
-metars = MEP.get_metars('/home/proud/Desktop/GoAround_Paper/VABB_METAR')
+# The METAR archive for the airport being processed, set by use_metars().
+# It is only read when first needed, see get_metar_table().
+metar_file = None
+_metar_tab = None
+
+
+def use_metars(inf):
+    """Set the METAR archive used to correct barometric altitudes.
+
+    Input:
+        -   The filename of the METAR archive, or None to skip correction
+    """
+    global metar_file, _metar_tab
+    if (inf != metar_file):
+        metar_file = inf
+        _metar_tab = None
+
+
+def get_metar_table():
+    """Return the METAR table, loading it on first use.
+
+    Returns:
+        -   A metar_parse.metar_table class, or None if no archive is set
+    """
+    global _metar_tab
+    if (_metar_tab is None and metar_file is not None):
+        _metar_tab = MEP.load_table(metar_file)
+    return _metar_tab
+
+
+def init_worker(inf, fl_log=None):
+    """Setup a worker process.
+
+    Inputs:
+        -   The filename of the METAR archive, see use_metars()
+        -   (optional) A filename prefix for the event log, see
+            OS_Stats.set_sink()
+    """
+    use_metars(inf)
+    OSS.set_sink(fl_log)
 
 
 def estimate_rwy(df, rwy_list, verbose):
     """Guess which runway a flight is attempting to land on.
 
     Inputs:
-        -   df, a dict containing flight information
+        -   df, the flight data, such as from preproc_data()
         -   rwy_list, a list of runways to check, defined in OS_Airports
         -   verbose, a bool specifying whether to verbosely print updates
     Returns:
@@ -29,35 +73,37 @@ def estimate_rwy(df, rwy_list, verbose):
     b_rwy = None
     b_pos = -1.
 
+    # Distances to each gate are the same for both runs, so find once.
+    # Use projected positions (in km) if available, otherwise degrees.
+    if ('xs' in df and all(hasattr(rwy, 'gate_xy') for rwy in rwy_list)):
+        gates = [rwy.gate_xy for rwy in rwy_list]
+        min_ds, pts1, min_ds2, pts2 = OSK.gate_closest(df['xs'], df['ys'],
+                                                       gates)
+        gate_dist = CNS.gate_dist
+    else:
+        gates = [rwy.gate for rwy in rwy_list]
+        min_ds, pts1, min_ds2, pts2 = OSK.gate_closest(df['lats'],
+                                                       df['lons'], gates)
+        gate_dist = CNS.gate_dist / 112.
+
     for run in range(0, 2):
-        for rwy in rwy_list:
-            dists2 = np.sqrt((df['lats'] - rwy.gate[0]) *
-                             (df['lats'] - rwy.gate[0]) +
-                             (df['lons'] - rwy.gate[1]) *
-                             (df['lons'] - rwy.gate[1]))
-            min_d = np.nanmin(dists2)
+        for i, rwy in enumerate(rwy_list):
+            min_d = min_ds[i]
             if (min_d < b_dist):
-                pt2 = (min_d == dists2).nonzero()
-                if (len(pt2[0]) > 0):
-                    pt2 = pt2[0]
-                pt2 = pt2[0]
-
+                # The second run uses the second closest point, and
+                # compares its distance from then on
                 if (run == 1):
-                    dists2[pt2] = 999.
-                    min_d = np.nanmin(dists2)
-                    pt2 = (min_d == dists2).nonzero()
-                    if (len(pt2[0]) > 0):
-                        pt2 = pt2[0]
-                    pt2 = pt2[0]
+                    pt2 = pts2[i]
+                    min_d = min_ds2[i]
+                else:
+                    pt2 = pts1[i]
                 if (df['gals'][pt2] > CNS.gate_alt):
-                    if (verbose):
-                        print("Bad geo alt", df['call'],
-                              df['gals'][pt2], CNS.gate_alt)
+                    OSS.event('RWY_BAD_GEO_ALT', df['call'],
+                              df['gals'][pt2], CNS.gate_alt, verbose=verbose)
                     continue
                 if (df['rocs'][pt2] > CNS.gate_roc):
-                    if (verbose):
-                        print("Bad rate of climb", df['call'],
-                              df['rocs'][pt2], CNS.gate_roc)
+                    OSS.event('RWY_BAD_ROC', df['call'],
+                              df['rocs'][pt2], CNS.gate_roc, verbose=verbose)
                     continue
                 if (df['hdgs'][pt2] >= rwy.heading[0] and
                         df['hdgs'][pt2] <= rwy.heading[1]):
@@ -70,15 +116,15 @@ def estimate_rwy(df, rwy_list, verbose):
                     b_rwy = rwy
                     b_pos = pt2
                 else:
-                    if (verbose):
-                        print("Bad heading", df['call'],
-                              df['hdgs'][pt2], rwy.heading)
+                    OSS.event('RWY_BAD_HEADING', df['call'],
+                              df['hdgs'][pt2], rwy.heading, verbose=verbose)
                     continue
-    if (b_dist > CNS.gate_dist):
-        if (verbose):
-            print("too far", df['call'], b_dist, CNS.gate_dist)
+    if (b_dist > gate_dist):
+        OSS.event('RWY_TOO_FAR', df['call'], b_dist, gate_dist,
+                  verbose=verbose)
         return None, b_pos
 
+    OSS.event('RWY_FOUND', df['call'], b_rwy.name, verbose=verbose)
     return b_rwy, b_pos
 
 
@@ -88,40 +134,252 @@ def get_flight(inf):
     Input:
         -   inf, the input filename
     Returns:
-        -   a list of flights
+        -   a dataframe holding the cleaned data for every flight in the file
     """
-    flist = []
+    from traffic.core import Traffic
+
 #    try:
     fdata = Traffic.from_file(inf).query("latitude == latitude")
     fdata = fdata.clean_invalid().filter().eval()
 #    except:
-#        return flist
-    for flight in fdata:
-        pos = flight.callsign.find(CNS.search_call)
-        if (pos < 0):
+#        return pd.DataFrame()
+    return clean_data(fdata.data)
+
+
+def split_flights(df):
+    """Give every point in a batch the id of the flight it belongs to.
+
+    Points are grouped by icao24 and callsign, and each group is split
+    wherever there is a gap of more than CNS.flight_gap minutes, so that
+    a departure and a later arrival of the same aircraft are kept apart.
+    Input:
+        -   A dataframe of flight data, such as Traffic.data
+    Returns:
+        -   The dataframe sorted by flight and time, with an integer
+            'flight_id' column. Any existing ids are replaced.
+    """
+    df = df.sort_values(['icao24', 'callsign', 'timestamp'], kind='stable')
+    new = ((df['icao24'] != df['icao24'].shift()) |
+           (df['callsign'] != df['callsign'].shift()) |
+           (df['timestamp'].diff() > timedelta(minutes=CNS.flight_gap)))
+    df['flight_id'] = new.cumsum().values
+    return df
+
+
+def clean_data(df):
+    """Clean the data for a whole batch of flights in a single pass.
+
+    Each step is applied to the full dataframe, grouped by flight, rather
+    than flight by flight. Points are removed if they duplicate the time,
+    longitude or latitude of an earlier point in the same flight, if they
+    are above 10000ft or if any value is missing.
+    Input:
+        -   A dataframe of flight data, such as Traffic.data
+    Returns:
+        -   The cleaned dataframe, with flights split by split_flights()
+            if it has no 'flight_id' column
+    """
+    if ('flight_id' not in df.columns):
+        df = split_flights(df)
+    keys = ['flight_id']
+
+    if (CNS.search_call != ''):
+        pts = df['callsign'].str.contains(CNS.search_call,
+                                          regex=False, na=False)
+        df = df[pts]
+    df = df.drop_duplicates(keys + ['timestamp'])
+    df = df.drop_duplicates(keys + ['longitude'])
+    df = df.drop_duplicates(keys + ['latitude'])
+    df = df[df['altitude'] < 10000]
+    df = df.dropna()
+
+    return df
+
+
+def add_projection(df, apt):
+    """Add the local projected position of every point in a batch.
+
+    This is done once for the whole batch, the positions are then used for
+    runway estimation and runway-aligned distances in each flight.
+    Inputs:
+        -   A dataframe of flight data, such as Traffic.data
+        -   An airport class, from OS_Airports.get_airport()
+    Returns:
+        -   Nothing, 'x' and 'y' columns (km east/north) are added to df
+    """
+    x, y = apt.proj.to_xy(df['latitude'].values, df['longitude'].values)
+    df['x'] = x
+    df['y'] = y
+
+
+def file_mb(inf):
+    """Return the size of a file in megabytes, or 0 if it is missing."""
+    try:
+        return os.path.getsize(inf) / 1e6
+    except OSError:
+        return 0.
+
+
+def plan_batches(files, start_n, n_files_proc, max_mb=None):
+    """Split the input files into batches of a similar amount of data.
+
+    Inputs:
+        -   A sorted list of input filenames
+        -   The index of the first file to read
+        -   An int specifying the maximum number of files in each batch
+        -   (optional) A float specifying the maximum size of each batch in
+            megabytes. If None, batch_mb in OS_Consts is used. A batch
+            always contains at least one file.
+    Returns:
+        -   A list of (first, last + 1) file indices, one per batch
+    """
+    if (max_mb is None):
+        max_mb = CNS.batch_mb
+    batches = []
+    i = start_n
+    while (i < len(files)):
+        j = i
+        b_size = 0.
+        while (j < len(files) and j - i < n_files_proc):
+            f_size = file_mb(files[j])
+            if (j > i and max_mb is not None and b_size + f_size > max_mb):
+                break
+            b_size += f_size
+            j += 1
+        batches.append((i, j))
+        i = j
+    return batches
+
+
+def flight_cost(flight, do_plot=False):
+    """Estimate the cost of processing a flight, see proc_fl().
+
+    Inputs:
+        -   A 'traffic' flight object
+        -   (optional) A bool specifying whether the flight will be plotted
+    Returns:
+        -   A float cost, in arbitrary units
+    """
+    cost = (CNS.cost_point * len(flight.data) +
+            CNS.cost_second * flight.duration.total_seconds())
+    if (do_plot):
+        cost = cost * CNS.cost_plot
+    return cost
+
+
+def get_batches(files, start_n, n_files_proc, pool, apt, fidder=None,
+                mets=None, batches=None):
+    """Load files in batches and yield the flights that are ready to process.
+
+    Several files are loaded at once using the pool, with the batches
+    formed by plan_batches() and the largest files loaded first. Flights
+    that finish within five minutes of the end of a batch may continue
+    into the next file, so these are held back and joined onto the next
+    batch.
+    Inputs:
+        -   A sorted list of input filenames
+        -   The index of the first file to read
+        -   An int specifying the maximum number of files in each batch
+        -   A pool of workers, from OS_Supervise.supervisor()
+        -   An airport class, from OS_Airports.get_airport()
+        -   (optional) An open file to write log information into
+        -   (optional) An OS_Metrics.metrics class to record throughput
+        -   (optional) An iterable of (index of the first file, list of
+            files) giving each batch to load, used instead of the files
+            and plan_batches(), i.e: from OS_Detect.watch_files()
+    Yields:
+        -   The index of the first file in the batch
+        -   A list of 'traffic' flights that have passed prefilter_flights()
+        -   A dict of flight_id -> the file each flight was first seen in
+    """
+    from traffic.core import Traffic
+
+    fli_len = ''
+    if (batches is None):
+        fli_len = " of " + str(len(files)).zfill(5)
+        batches = ((i, files[i:j])
+                   for i, j in plan_batches(files, start_n, n_files_proc))
+    f_data = []
+    for main_count, b_files in batches:
+        msg = ("Processing batch starting with " +
+               str(main_count + 1).zfill(5) + fli_len + ", " +
+               str(len(b_files)) + " files")
+        print(msg)
+        if (fidder is not None):
+            fidder.write(msg + '\n')
+
+        t_start = time.perf_counter()
+        # First we load several files at once
+        tasks = [((None, None, inf), (inf,)) for inf in b_files]
+        costs = [file_mb(inf) for inf in b_files]
+
+        for i, (key, t_res) in enumerate(pool.run(get_flight, tasks,
+                                                  CNS.load_timeout, costs)):
+            if (mets is not None):
+                mets.set('ga_file_queue_depth', len(tasks) - i - 1,
+                         'Files waiting to be loaded')
+                mets.inc('ga_files_total', 1, 'Input files loaded')
+            if (len(t_res) > 0):
+                # Note which file each point came from
+                t_res['src'] = key[2]
+                f_data.append(t_res)
+        if (mets is not None):
+            mets.observe('load', time.perf_counter() - t_start)
+        if (len(f_data) < 1):
             continue
-        f_data = flight.data
-        f_data = f_data.drop_duplicates('timestamp')
-        f_data = f_data.drop_duplicates('longitude')
-        f_data = f_data.drop_duplicates('latitude')
-        f_data = f_data.query('altitude<10000')
-        f_data = f_data.dropna()
-        flight.data = f_data
-        flist.append(flight)
-    return flist
+        t_start = time.perf_counter()
+        # Flights are split again over the whole batch, as they may
+        # continue from one file, or batch, into the next
+        traf_arr = Traffic(split_flights(pd.concat(f_data, sort=False)))
+        f_data = []
+        # Extend array end time if there's only one flight, else processing
+        # will fail as we check to ensure latest flight is > 5 mins from end
+        if (len(traf_arr) == 1):
+            end_time = traf_arr.end_time + timedelta(minutes=10)
+            print("Extending timespan due to single aircraft")
+        else:
+            end_time = traf_arr.end_time
+
+        # Project every point in the batch into local airport coordinates
+        add_projection(traf_arr.data, apt)
+
+        # Screen the whole batch at once so that flights that cannot be
+        # arrivals are never resampled or sent to the pool
+        fl_stat = prefilter_flights(traf_arr.data)
+
+        flights = []
+        fl_srcs = {}
+        for flight in traf_arr:
+            fl_id = flight.flight_id
+            if (flight.stop + timedelta(minutes=5) < end_time):
+                # Only counted here, as flights that continue into the
+                # next batch are screened again there
+                reason = fl_stat.get(fl_id, 'NO_ID')
+                OSS.event('PREFILTER_' + reason, flight.callsign)
+                if (reason != 'OK'):
+                    continue
+                flights.append(flight)
+                fl_srcs[fl_id] = flight.data['src'].iloc[0]
+            else:
+                f_data.append(flight.data)
+        if (mets is not None):
+            mets.observe('prefilter', time.perf_counter() - t_start)
+
+        yield main_count, flights, fl_srcs
 
 
 def check_takeoff(df):
     """Check if a flight is taking off. If so, we're not interested.
 
     Input:
-        -   df, a dict containing flight data
+        -   df, the flight data, such as from preproc_data()
     Returns:
         -   True if a takeoff, otherwise False
     """
     lf = len(df['gals'])
     # Check if there's enough data to process
     if (lf < 10):
+        OSS.event('TAKEOFF_SHORT')
         return True
     # Check if the first datapoints are all low alt
     # Two options here: geo alt or baro alt.
@@ -132,13 +390,17 @@ def check_takeoff(df):
 
     if (np.all(df['ongd'][0:5])):
         if (np.nanmean(alt_sub2 < 3000)):
+            OSS.event('TAKEOFF_GROUND')
             return True
     if (np.all(alt_sub < CNS.takeoff_thresh_alt)):
+        OSS.event('TAKEOFF_LOW')
         return True
     if (np.nanmean(alt_sub) < 3000):
         if (np.nanmean(alt_sub2[0:2]) < np.nanmean(alt_sub2[2:5])):
+            OSS.event('TAKEOFF_CLIMB')
             return True
     if (np.nanmean(df['rocs'][0:5] > 1500)):
+        OSS.event('TAKEOFF_ROC')
         return True
 
     return False
@@ -169,8 +431,8 @@ def check_ga(fd, verbose, first_pos=-1):
     """Check if a go-around occurred based on some simple tests.
 
     Inputs:
-        -   A dict containing flight data
-        -   A boolean for verbose mode. If True, a g/a warning is printed
+        -   A flight_data class, such as from preproc_data()
+        -   A boolean for verbose mode. If True, a g/a warning is logged
         -   (optional) An int specifying the first position in array to check
             This is useful for situations with multiple g/a's in one track
     Returns:
@@ -182,11 +444,7 @@ def check_ga(fd, verbose, first_pos=-1):
 
     labels = fd['labl']
 
-    lblen = len(labels)
-    cng = np.zeros(lblen, dtype=bool)
-    for i in range(1, lblen):
-        if (labels[i] != labels[i-1]):
-            cng[i] = True
+    cng = OSK.label_changes(labels)
     main_pts = (cng).nonzero()
     if np.all(cng is False):
         return ga_flag
@@ -227,61 +485,46 @@ def check_ga(fd, verbose, first_pos=-1):
         pts = (alt_sub > 20000).nonzero()
         alt_sub[pts] = -10000
 
-        alt_test = (alt_sub > CNS.alt_thresh)
-        pts_alt = (alt_test).nonzero()
-        if (len(pts_alt[0]) > 0):
-            pts_alt = pts_alt[0]
-
-        vrt_test = (vrt_sub > CNS.vrt_thresh)
-        pts_vrt = (vrt_test).nonzero()
-        if (len(pts_vrt[0]) > 0):
-            pts_vrt = pts_vrt[0]
-
-        n_pts_alt = len(pts_alt)
-        n_pts_vrt = len(pts_vrt)
+        n_pts_alt, n_pts_vrt = OSK.window_counts(alt_sub, vrt_sub,
+                                                 CNS.alt_thresh,
+                                                 CNS.vrt_thresh)
         alts_p = (n_pts_alt/n_pos)*100.
         vrts_p = (n_pts_vrt/n_pos)*100.
 
         if (n_pos > 10 and alts_p > 50 and vrts_p > 20):
-            if verbose:
-                ga_time = fd['strt'] + timedelta(seconds=int(fd['time'][pt]))
-                print("\t-\tG/A warning:",
+            ga_time = fd['strt'] + timedelta(seconds=int(fd['time'][pt]))
+            OSS.event('GA_WARNING',
                       fd['call'],
                       fd['ic24'],
-                      ga_time.strftime("%Y-%m-%d %H:%M"))
+                      ga_time.strftime("%Y-%m-%d %H:%M"),
+                      verbose=verbose)
             ga_flag = True
             bpt = pt
 
     return ga_flag, bpt
 
 
-def proc_fl(flight, check_rwys, odirs, colormap, do_save, verbose):
-    """Filter, assign phases and determine go-around status for a given flight.
+def prep_fl(flight, verbose):
+    """Filter, preprocess and assign phases for a given flight.
 
+    This covers all the steps in proc_fl() that do not depend on the
+    go-around or runway thresholds in OS_Consts.
     Inputs:
         -   A 'traffic' flight object
-        -   A list storing potential landing runways to check
-        -   A 4-element list specifying various output directories:
-            -   normal plot output
-            -   go-around plot output
-            -   normal numpy data output
-            -   go-around numpy data output
-        -   A dict of colours used for flightpath labelling
-        -   A boolean specifying whether to save data or not
         -   A boolean specifying whether to use verbose mode
     Returns:
-        -   Nothing
+        -   The flight data, including labels, as from preproc_data()
+        -   The flight data resampled to one second
+        or -1 if the flight is not suitable for processing
     """
     # First, check if a flight is not on exclusion list
     gd_fl = check_good_flight(flight)
     if (not gd_fl):
-        if (verbose):
-            print("\t-\tBad flight call:", flight.callsign)
+        OSS.event('BAD_CALL', flight.callsign, verbose=verbose)
         return -1
 
     # Print some details if verbose
-    if (verbose):
-        print("\t-\tProcessing:", flight.callsign)
+    OSS.event('PROCESSING', flight.callsign, verbose=verbose)
 
     # Resample trajectory to one second, this is used for runway estimation
     flight2 = flight.resample("1s")
@@ -292,26 +535,79 @@ def proc_fl(flight, check_rwys, odirs, colormap, do_save, verbose):
 
     # If we don't have good data here, skip
     if (fd is None):
-        if (verbose):
-            print("\t-\tBad flight data:", flight.callsign, fd)
+        OSS.event('BAD_DATA', flight.callsign, fd, verbose=verbose)
         return -1
     if (fd2 is None):
-        if verbose:
-            print("\t-\tBad flight data:", flight.callsign, fd2)
+        OSS.event('BAD_DATA_RESAMPLED', flight.callsign, fd2,
+                  verbose=verbose)
         return -1
 
     # We don't care about take-offs, so find and exclude
     takeoff = check_takeoff(fd)
     if takeoff:
+        OSS.event('TAKEOFF', flight.callsign, verbose=verbose)
         return -1
     # Use Junzi's labelling method to get flight phases
     labels = do_labels(fd)
+    if (labels is None):
+        return -1
     if (np.all(labels == labels[0])):
-        if verbose:
-            print("\t-\tNo state change:", flight.callsign)
+        OSS.event('NO_STATE_CHANGE', flight.callsign, verbose=verbose)
         return -1
     fd['labl'] = labels
 
+    return fd, fd2
+
+
+def baro_correct_fl(fd):
+    """Correct the barometric altitudes of a flight using the closest METAR.
+
+    Input:
+        -   A flight_data class, such as that returned by preproc_data()
+    Returns:
+        -   The time used to find the METAR (mid-point of the flight)
+        -   The METAR used for the correction (as metobs), or None
+    """
+    t_alt = fd['alts']
+    l_time = fd['strt'] + (fd['dura'] / 2)
+    l_time = pd.Timestamp(l_time, tz='UTC')
+    metars = get_metar_table()
+    if (metars is not None):
+        bmet, tdiff = find_closest_metar(l_time, metars)
+    else:
+        bmet, tdiff = None, None
+    if (bmet is not None):
+        t_alt = correct_baro(t_alt, bmet.temp, bmet.pres)
+    else:
+        OSS.event('NO_METAR', bmet, tdiff, l_time, verbose=True)
+    fd['alts'] = t_alt
+
+    return l_time, bmet
+
+
+def proc_fl(flight, check_rwys, odirs, colormap, do_save, verbose):
+    """Filter, assign phases and determine go-around status for a given flight.
+
+    Inputs:
+        -   A 'traffic' flight object
+        -   A list storing potential landing runways to check
+        -   A 4-element list specifying various output directories:
+            -   normal plot output
+            -   go-around plot output
+            -   normal numpy data output
+            -   go-around numpy data output
+            Data is not saved if its output directory is None.
+        -   A dict of colours used for flightpath labelling
+        -   A boolean specifying whether to save plots or not
+        -   A boolean specifying whether to use verbose mode
+    Returns:
+        -   Nothing
+    """
+    t_res = prep_fl(flight, verbose)
+    if (t_res == -1):
+        return -1
+    fd, fd2 = t_res
+
     # Estimate which runway the flight is landing on (rwy), and at what
     # point in the data arrays it does so (posser).
     rwy, posser = estimate_rwy(fd2, check_rwys, verbose)
@@ -324,14 +620,17 @@ def proc_fl(flight, check_rwys, odirs, colormap, do_save, verbose):
         min_alt_pt = min_alt_pt[0]
     min_alt_pt = min_alt_pt[0]
     if rwy is None:
-        if verbose:
-            print('WARNING: Cannot find runway for flight '
-                  + fd['call'] + ' ' + fd['ic24'])
+        OSS.event('NO_RUNWAY', fd['call'], fd['ic24'], verbose=verbose)
         fd['rwy'] = "None"
         r_dis = np.sqrt((fd['lats'] - fd['lats'][min_alt_pt]) *
                         (fd['lats'] - fd['lats'][min_alt_pt]) +
                         (fd['lons'] - fd['lons'][min_alt_pt]) *
                         (fd['lons'] - fd['lons'][min_alt_pt]))
+    elif ('xs' in fd and hasattr(rwy, 'rwy_xy')):
+        fd['rwy'] = rwy.name
+        r_dis = None
+        # Distances along and across the runway centreline, in km
+        fd['rdis'], fd['xtrk'] = runway_coords(fd['xs'], fd['ys'], rwy)
     else:
         fd['rwy'] = rwy.name
         r_dis = np.sqrt((fd['lats'] - rwy.rwy[0]) *
@@ -339,40 +638,41 @@ def proc_fl(flight, check_rwys, odirs, colormap, do_save, verbose):
                         (fd['lons'] - rwy.rwy[1]) *
                         (fd['lons'] - rwy.rwy[1]))
 
-    # Convert degrees into km, not perfect but good enough
-    r_dis = r_dis * 112.
-    pt = (np.nanmin(r_dis) == r_dis).nonzero()
-    if (len(pt[0]) > 0):
+    if (r_dis is not None):
+        # Convert degrees into km, not perfect but good enough
+        r_dis = r_dis * 112.
+        pt = (np.nanmin(r_dis) == r_dis).nonzero()
+        if (len(pt[0]) > 0):
+            pt = pt[0]
         pt = pt[0]
-    pt = pt[0]
-    r_dis[0:pt] = r_dis[0:pt] * -1
-    fd['rdis'] = r_dis
+        r_dis[0:pt] = r_dis[0:pt] * -1
+        fd['rdis'] = r_dis
 
     # Correct barometric altitudes
-    t_alt = fd['alts']
-    l_time = fd['strt'] + (fd['dura'] / 2)
-    l_time = pd.Timestamp(l_time, tz='UTC')
-    bmet, tdiff = find_closest_metar(l_time, metars)
-    if (bmet is not None):
-        t_alt = correct_baro(t_alt, bmet.temp, bmet.pres)
-    else:
-        print("Warning: No METAR available for alt correction!",
-              bmet, tdiff, l_time)
-    fd['alts'] = t_alt
+    l_time, bmet = baro_correct_fl(fd)
 
     # Now the actual go-around check
-    ga_flag, gapt = check_ga(fd, True)
+    ga_flag, gapt = check_ga(fd, verbose)
+
+    # Score the approach against the runway envelope, if one is known
+    if rwy is not None:
+        fd['envs'] = OSE.score_flight(fd, rwy)
+        if (fd['envs']['unstable']):
+            OSS.event('ENV_UNSTABLE', fd['call'], fd['envs']['worst'],
+                      verbose=verbose)
 
-    # Make some plots if required, this needs a spline to smooth output
+    # Choose output directory based upon go-around flag
+    if (ga_flag):
+        odir_pl = odirs[1]
+        odir_np = odirs[3]
+    else:
+        odir_pl = odirs[0]
+        odir_np = odirs[2]
+
+    # Make some plots if required, this needs a spline to smooth output.
+    # Plots can also be made later from the saved data using GA_View.
     if do_save:
-        spldict = create_spline(fd, bpos=None)
-        # Choose output directory based upon go-around flag
-        if (ga_flag):
-            odir_pl = odirs[1]
-            odir_np = odirs[3]
-        else:
-            odir_pl = odirs[0]
-            odir_np = odirs[2]
+        spldict = OSO.create_spline(fd, bpos=None)
         OSO.do_plots(fd,
                      spldict,
                      colormap,
@@ -436,9 +736,12 @@ def proc_fl(flight, check_rwys, odirs, colormap, do_save, verbose):
     fd['posser'] = posser2
     fd['gapt'] = gapt
     fd['min_alt_pt'] = min_alt_pt
-    OSO.to_numpy(fd, odir_np)
-    if (verbose):
-        print("\t-\tDONE")
+    if (odir_np is not None):
+        OSO.to_numpy(fd, odir_np)
+    if (ga_flag):
+        OSS.event('GA', fd['call'], verbose=verbose)
+    else:
+        OSS.event('LANDING', fd['call'], verbose=verbose)
     return garr
 
 
@@ -455,22 +758,109 @@ def check_good_flight(flight):
     """
     if (flight.icao24 in CNS.exclude_list):
         return False
-    if (flight.callsign[0:7] == 'WILDLIF'):
-        return False
-    elif (flight.callsign[0:6] == 'AGM000'):
-        return False
-    elif (flight.callsign[0:7] == 'FOLOWME'):
-        return False
-    elif (flight.callsign[0:5] == 'RADAR'):
-        return False
-    elif (flight.callsign[0:7] == 'FIRETEN'):
-        return False
-    elif (flight.callsign[0:8] == 'DUTYOFIR'):
+    if (match_prefix(flight.callsign, _exclude_lookup)):
         return False
     else:
         return True
 
 
+def make_prefix_lookup(prefixes):
+    """Group a list of callsign prefixes by length for fast matching.
+
+    Input:
+        -   A list of callsign prefixes, such as CNS.exclude_calls
+    Returns:
+        -   A dict mapping prefix length -> set of prefixes of that length
+    """
+    lookup = {}
+    for pref in prefixes:
+        lookup.setdefault(len(pref), set()).add(pref)
+    return lookup
+
+
+# The excluded callsign prefixes, built once for every flight to use
+_exclude_lookup = make_prefix_lookup(CNS.exclude_calls)
+
+
+def match_prefix(call, lookup):
+    """Check if a callsign starts with any of a set of prefixes.
+
+    Inputs:
+        -   A callsign string
+        -   A prefix lookup, such as that returned by make_prefix_lookup()
+    Returns:
+        -   True if the callsign matches a prefix, False otherwise
+    """
+    for plen in lookup:
+        if (call[0:plen] in lookup[plen]):
+            return True
+    return False
+
+
+def prefilter_flights(df):
+    """Screen every flight in a batch before any are dispatched to workers.
+
+    This applies the same rules as check_good_flight(), check_good_data()
+    and check_takeoff(), but using groupby aggregates over the whole batch
+    so that flights which cannot be arrivals are never resampled or sent
+    to the pool.
+    Input:
+        -   A dataframe of flight data, such as Traffic.data, with flights
+            split by split_flights()
+    Returns:
+        -   A pandas series indexed by flight_id giving 'OK' for
+            plausible arrivals or otherwise the reason for rejection.
+    """
+    keys = ['flight_id']
+    fkey = [df[k] for k in keys]
+    flts = df.groupby(keys, sort=False).agg(npts=('icao24', 'size'),
+                                            ic24=('icao24', 'first'),
+                                            call=('callsign', 'first'))
+    reason = pd.Series('OK', index=flts.index, dtype=object)
+
+    # Screens on the whole flight, as in check_good_data()
+    flts['g_high'] = (df['geoaltitude'] > 3000).groupby(fkey).all()
+    flts['b_high'] = (df['altitude'] > 3000).groupby(fkey).all()
+    flts['g_low'] = (df['geoaltitude'] < 500).groupby(fkey).all()
+    flts['slow'] = (df['groundspeed'] < 50).groupby(fkey).all()
+    flts['ground'] = df['onground'].astype(bool).groupby(fkey).all()
+
+    # Takeoff screen on the first five points, as in check_takeoff()
+    tdf = df
+    if ('last_position' in tdf.columns):
+        tdf = tdf.drop_duplicates(keys + ['last_position'])
+    tdf = tdf.sort_values('timestamp', kind='stable')
+    npts = tdf.groupby(keys, sort=False).size()
+    tdf = tdf.groupby(keys, sort=False).head(5)
+    pos = tdf.groupby(keys, sort=False).cumcount()
+    tkey = [tdf[k] for k in keys]
+    t_gnd = (tdf['onground'].astype(bool).groupby(tkey).all() &
+             (tdf['altitude'] < 3000).groupby(tkey).any())
+    t_low = (tdf['geoaltitude'] < CNS.takeoff_thresh_alt).groupby(tkey).all()
+    t_clb = (tdf['geoaltitude'].groupby(tkey).mean() < 3000)
+    alt1 = tdf['altitude'].where(pos < 2).groupby(tkey).mean()
+    alt2 = tdf['altitude'].where(pos >= 2).groupby(tkey).mean()
+    t_clb = t_clb & (alt1 < alt2)
+    t_roc = (tdf['vertical_rate'] > 1500).groupby(tkey).any()
+    takeoff = (npts < 10) | t_gnd | t_low | t_clb | t_roc
+    flts['takeoff'] = takeoff.reindex(flts.index, fill_value=True)
+
+    # Set lookups for excluded aircraft and callsigns
+    excl = set(CNS.exclude_list)
+    flts['excl'] = [ic in excl for ic in flts['ic24']]
+    flts['bad_call'] = [match_prefix(str(cs), _exclude_lookup)
+                        for cs in flts['call']]
+
+    # Apply in reverse order so the first matching rule sets the reason
+    for col, why in [('takeoff', 'TAKEOFF'), ('ground', 'GROUND'),
+                     ('slow', 'SLOW'), ('g_low', 'G_LOW'),
+                     ('b_high', 'B_HIGH'), ('g_high', 'G_HIGH'),
+                     ('bad_call', 'BAD_CALL'), ('excl', 'EXCLUDED')]:
+        reason[flts[col].values.astype(bool)] = why
+
+    return reason
+
+
 def check_good_data(flight):
     """Check that a flight has data suitable for inclusion in the study.
 
@@ -503,7 +893,7 @@ def preproc_data(flight, verbose):
         -   A flight produced by the 'traffic' library.
         -   A bool specifying verbose mode
     Returns:
-        A dict containing:
+        An OS_Flight.flight_data class containing:
         -   time: The time-since-first-contact for each datapoint
         -   lats: Reported latitude of each datapoint
         -   lons: Reported longitude
@@ -512,8 +902,9 @@ def preproc_data(flight, verbose):
         -   gals: Reported geometric altitude
         -   hdgs: Reported track angle
         -   rocs: Reported vertical rate
-        -   lpos: Last position report timestamp
         -   ongd: Flag indicating whether aircraft is on ground (True/False)
+        -   xs: Projected x position in km, if available
+        -   ys: Projected y position in km, if available
         -   call: Reported callsign for the flight
         -   ic24: Reported icao24 hex code for the flight
         -   strt: Time of first position in the flight datastream
@@ -523,8 +914,8 @@ def preproc_data(flight, verbose):
     """
     isgd = check_good_data(flight)
     if (not isgd):
-        if (verbose):
-            print("Unsuitable flight:", flight.callsign, isgd)
+        OSS.event('PREPROC_UNSUITABLE', flight.callsign, isgd,
+                  verbose=verbose)
         return None
 
     f_data = flight.data
@@ -534,43 +925,37 @@ def preproc_data(flight, verbose):
         None
 
     if(len(f_data) < 5):
+        OSS.event('PREPROC_SHORT', flight.callsign, len(f_data),
+                  verbose=verbose)
         return None
-    fdata = {}
-
     tmp = f_data['timestamp'].values
     ts = (tmp - np.datetime64('1970-01-01T00:00:00')) / np.timedelta64(1, 's')
-    times = ts.astype(np.int)
+    times = ts.astype(np.int64)
 
     # Correct headings into -180 -> 180 range
     hdgs = f_data['track'].values
     pts = (hdgs > 180.).nonzero()
     hdgs[pts] = hdgs[pts] - 360.
 
-    fdata['time'] = times - times[0]
-    fdata['lats'] = f_data['latitude'].values
-    fdata['lons'] = f_data['longitude'].values
-    fdata['alts'] = f_data['altitude'].values
-    fdata['spds'] = f_data['groundspeed'].values
-    fdata['gals'] = f_data['geoaltitude'].values
-    fdata['hdgs'] = hdgs
-    fdata['rocs'] = f_data['vertical_rate'].values
-    fdata['ongd'] = f_data['onground'].values
-
     # The next bit is needed in case a flight crosses two pkl files, which are
     # usually one hour long. So a flight going from 00:59 -> 01:00 is in two
     # files, and due to multiprocessing the two segments may be reversed.
-    df_tmp = pd.DataFrame(fdata)
-    df_new = df_tmp.sort_values(by=['time'])
-
-    fdata['time'] = df_new['time'].values
-    fdata['lats'] = df_new['lats'].values
-    fdata['lons'] = df_new['lons'].values
-    fdata['alts'] = df_new['alts'].values
-    fdata['spds'] = df_new['spds'].values
-    fdata['gals'] = df_new['gals'].values
-    fdata['hdgs'] = df_new['hdgs'].values
-    fdata['rocs'] = df_new['rocs'].values
-    fdata['ongd'] = df_new['ongd'].values
+    order = np.argsort(times, kind='stable')
+
+    fdata = OSFL.flight_data(len(times))
+    fdata['time'] = (times - times[0])[order]
+    fdata['lats'] = f_data['latitude'].values[order]
+    fdata['lons'] = f_data['longitude'].values[order]
+    fdata['alts'] = f_data['altitude'].values[order]
+    fdata['spds'] = f_data['groundspeed'].values[order]
+    fdata['gals'] = f_data['geoaltitude'].values[order]
+    fdata['hdgs'] = hdgs[order]
+    fdata['rocs'] = f_data['vertical_rate'].values[order]
+    fdata['ongd'] = f_data['onground'].values[order]
+    # Projected positions, only present if add_projection() has been run
+    if ('x' in f_data.columns):
+        fdata['xs'] = f_data['x'].values[order]
+        fdata['ys'] = f_data['y'].values[order]
     fdata['call'] = flight.callsign
     fdata['ic24'] = flight.icao24
     fdata['strt'] = flight.start
@@ -581,24 +966,18 @@ def preproc_data(flight, verbose):
 
 
 def find_closest_metar(l_time, metars):
-    """Find the best-fitting metar from a dict that matches a specified time value.
+    """Find the best-fitting metar from a table that matches a specified time value.
 
     Inputs:
         -   The time to match (datetime)
-        -   A dict of METARS, each as a metobs class
+        -   A table of METARs, as a metar_parse.metar_table class
     Returns:
         The best metar (as metobs) and the time difference in seconds
 
     """
-    tdiff = 1e8
-    bmet = None
-
-    timelist = list(metars.keys())
-    in_time = l_time.to_pydatetime()
-    btim = min(timelist, key=lambda date: abs(in_time-date))
-    tdiff = abs((btim - in_time).total_seconds())
-    if (tdiff < 3600):
-        bmet = metars[btim]
+    bmet, tdiff = metars.closest(l_time.to_pydatetime())
+    if (tdiff >= 3600):
+        bmet = None
     return bmet, tdiff
 
 
@@ -629,59 +1008,26 @@ def correct_baro(balt, t0, p0):
     return alt
 
 
-def create_spline(fd, bpos=None):
-    """Create the splines needed for plotting smoothed lines on the output graphs.
-
-    Input:
-        -   A dict of flight data, such as that returned by preproc_data()
-        -   An int speicfying the max array value to use
-    Returns:
-        A dict containing:
-        -   altspl
-        -   spdspl
-        -   rocspl
-        -   galspl
-        -   hdgspl
-
-    """
-    spldict = {}
-    if (bpos is None):
-        bpos = len(fd['time'])
-    spldict['altspl'] = UniSpl(fd['time'][0: bpos],
-                               fd['alts'][0: bpos])(fd['time'][0: bpos])
-    spldict['spdspl'] = UniSpl(fd['time'][0: bpos],
-                               fd['spds'][0: bpos])(fd['time'][0: bpos])
-    spldict['rocspl'] = UniSpl(fd['time'][0: bpos],
-                               fd['rocs'][0: bpos])(fd['time'][0: bpos])
-    spldict['galspl'] = UniSpl(fd['time'][0: bpos],
-                               fd['gals'][0: bpos])(fd['time'][0: bpos])
-    spldict['hdgspl'] = UniSpl(fd['time'][0: bpos],
-                               fd['hdgs'][0: bpos])(fd['time'][0: bpos])
-    spldict['latspl'] = UniSpl(fd['time'][0: bpos],
-                               fd['lats'][0: bpos])(fd['time'][0: bpos])
-    spldict['lonspl'] = UniSpl(fd['time'][0: bpos],
-                               fd['lons'][0: bpos])(fd['time'][0: bpos])
-
-    return spldict
-
-
 def do_labels(fd):
     """Perform the fuzzy labelling using Junzi's method.
 
     Add an additional force label of aircraft with 'onground=True' to
     the 'GND' label category.
     Input:
-        -   A dict of flight data, such as that returned by preproc_data()
+        -   A flight_data class, such as that returned by preproc_data()
     Returns:
-        -   A numpy array containing categorised flight phases.
+        -   A numpy array containing categorised flight phases, or None if
+            the labelling failed.
 
     """
+    import flightphase as flph
+
     try:
         labels = flph.fuzzylabels(fd['time'], fd['alts'],
                                   fd['spds'], fd['rocs'], twindow=15)
     except Exception as e:
-        print("Error creating spline", e, fd['call'])
-        quit()
+        OSS.event('LABEL_ERROR', e, fd['call'], verbose=True)
+        return None
     pts = (fd['ongd']).nonzero()
     labels[pts] = 'GND'
 
@@ -0,0 +1,313 @@
+"""Per-point kernels used by the go-around detection routines.
+
+Each kernel has a plain NumPy implementation and, if the 'numba' library
+is installed, a JIT-compiled version of the equivalent loop. The backend
+is chosen using 'kernel_backend' in OS_Consts, or can be passed directly
+to each kernel. The loops can also be run as plain Python, which is slow
+but needs nothing else. All backends must give identical results to a
+port of the original code, this can be checked by running this file as a
+script.
+"""
+import importlib.util
+import OS_Consts as CNS
+import numpy as np
+
+# numba is slow to import, so it is only imported when a numba kernel is
+# first used, see get_kernel()
+have_numba = importlib.util.find_spec('numba') is not None
+
+
+def get_backend(backend=None):
+    """Resolve the name of the kernel backend to use.
+
+    Inputs:
+        -   (optional) A string specifying the backend: 'auto', 'numba',
+            'numpy' or 'python'. If None, the value in OS_Consts is used.
+    Returns:
+        -   Either 'numba', 'numpy' or 'python'
+    """
+    if (backend is None):
+        backend = CNS.kernel_backend
+    if (backend == 'auto'):
+        if (have_numba):
+            return 'numba'
+        return 'numpy'
+    if (backend == 'numba'):
+        if (not have_numba):
+            raise ImportError("The numba kernel backend was requested "
+                              "but numba is not installed.")
+        return 'numba'
+    if (backend in ('numpy', 'python')):
+        return backend
+    raise ValueError("Unknown kernel backend: " + str(backend))
+
+
+def encode_labels(labels):
+    """Convert an array of flight phase labels into integer codes.
+
+    Input:
+        -   An array of string labels, such as that from do_labels()
+    Returns:
+        -   An int array with one code per label
+    """
+    _, codes = np.unique(np.asarray(labels), return_inverse=True)
+    return codes.astype(np.int64).ravel()
+
+
+def _label_changes_np(codes):
+    cng = np.zeros(len(codes), dtype=bool)
+    if (len(codes) > 1):
+        cng[1:] = codes[1:] != codes[:-1]
+    return cng
+
+
+def _label_changes_loop(codes):
+    lblen = len(codes)
+    cng = np.zeros(lblen, dtype=np.bool_)
+    for i in range(1, lblen):
+        if (codes[i] != codes[i-1]):
+            cng[i] = True
+    return cng
+
+
+def _window_counts_np(alt_sub, vrt_sub, alt_thresh, vrt_thresh):
+    n_alt = np.count_nonzero(alt_sub > alt_thresh)
+    n_vrt = np.count_nonzero(vrt_sub > vrt_thresh)
+    return n_alt, n_vrt
+
+
+def _window_counts_loop(alt_sub, vrt_sub, alt_thresh, vrt_thresh):
+    n_alt = 0
+    n_vrt = 0
+    for i in range(0, len(alt_sub)):
+        if (alt_sub[i] > alt_thresh):
+            n_alt += 1
+    for i in range(0, len(vrt_sub)):
+        if (vrt_sub[i] > vrt_thresh):
+            n_vrt += 1
+    return n_alt, n_vrt
+
+
+def _gate_closest_np(lats, lons, glats, glons):
+    dlat = lats[np.newaxis, :] - glats[:, np.newaxis]
+    dlon = lons[np.newaxis, :] - glons[:, np.newaxis]
+    dists = np.sqrt(dlat * dlat + dlon * dlon)
+    dists[np.isnan(dists)] = np.inf
+
+    n_rwy = len(glats)
+    rows = np.arange(0, n_rwy)
+    pt1 = np.argmin(dists, axis=1)
+    min_d = dists[rows, pt1]
+    dists[rows, pt1] = 999.
+    pt2 = np.argmin(dists, axis=1)
+    min_d2 = dists[rows, pt2]
+
+    bad = (min_d == np.inf).nonzero()
+    min_d[bad] = np.nan
+    min_d2[bad] = np.nan
+    pt1[bad] = -1
+    pt2[bad] = -1
+    return min_d, pt1.astype(np.int64), min_d2, pt2.astype(np.int64)
+
+
+def _gate_closest_loop(lats, lons, glats, glons):
+    n_rwy = len(glats)
+    n_pts = len(lats)
+    min_d = np.full(n_rwy, np.nan)
+    min_d2 = np.full(n_rwy, np.nan)
+    pt1 = np.full(n_rwy, -1, dtype=np.int64)
+    pt2 = np.full(n_rwy, -1, dtype=np.int64)
+    for j in range(0, n_rwy):
+        b_d = np.inf
+        b_p = -1
+        s_d = np.inf
+        s_p = -1
+        for i in range(0, n_pts):
+            dlat = lats[i] - glats[j]
+            dlon = lons[i] - glons[j]
+            dist = np.sqrt(dlat * dlat + dlon * dlon)
+            if (dist < b_d):
+                # The old best becomes the second best
+                s_d = b_d
+                s_p = b_p
+                b_d = dist
+                b_p = i
+            elif (dist < s_d):
+                s_d = dist
+                s_p = i
+        if (b_p < 0):
+            continue
+        min_d[j] = b_d
+        pt1[j] = b_p
+        # The closest point is replaced by 999 before the second search
+        if (s_p < 0 or 999. < s_d or (999. == s_d and b_p < s_p)):
+            s_p = b_p
+            s_d = 999.
+        min_d2[j] = s_d
+        pt2[j] = s_p
+    return min_d, pt1, min_d2, pt2
+
+
+def _gate_closest_ref(lats, lons, glats, glons):
+    # A port of the search in the original estimate_rwy(), for checking
+    n_rwy = len(glats)
+    out = [np.full(n_rwy, np.nan), np.full(n_rwy, -1, dtype=np.int64),
+           np.full(n_rwy, np.nan), np.full(n_rwy, -1, dtype=np.int64)]
+    for j in range(0, n_rwy):
+        dists2 = np.sqrt((lats - glats[j]) * (lats - glats[j]) +
+                         (lons - glons[j]) * (lons - glons[j]))
+        if (np.all(np.isnan(dists2))):
+            continue
+        min_d = np.nanmin(dists2)
+        pt2 = (min_d == dists2).nonzero()[0][0]
+        out[0][j] = min_d
+        out[1][j] = pt2
+        dists2[pt2] = 999.
+        min_d = np.nanmin(dists2)
+        out[2][j] = min_d
+        out[3][j] = (min_d == dists2).nonzero()[0][0]
+    return tuple(out)
+
+
+_kernels = {'numpy': {'label_changes': _label_changes_np,
+                      'window_counts': _window_counts_np,
+                      'gate_closest': _gate_closest_np},
+            'python': {'label_changes': _label_changes_loop,
+                       'window_counts': _window_counts_loop,
+                       'gate_closest': _gate_closest_loop}}
+
+
+def get_kernel(name, backend=None):
+    """Return a kernel, compiling the numba kernels on first use.
+
+    Inputs:
+        -   The name of the kernel, i.e: 'label_changes'
+        -   (optional) A string specifying the kernel backend
+    Returns:
+        -   The kernel function
+    """
+    backend = get_backend(backend)
+    if (backend not in _kernels):
+        import numba
+        _kernels['numba'] = {
+            'label_changes': numba.njit(cache=True)(_label_changes_loop),
+            'window_counts': numba.njit(cache=True)(_window_counts_loop),
+            'gate_closest': numba.njit(cache=True)(_gate_closest_loop)}
+    return _kernels[backend][name]
+
+
+def label_changes(labels, backend=None):
+    """Find the positions at which the flight phase label changes.
+
+    Inputs:
+        -   An array of flight phase labels
+        -   (optional) A string specifying the kernel backend
+    Returns:
+        -   A bool array, True where a label differs from the previous one
+    """
+    kern = get_kernel('label_changes', backend)
+    return kern(encode_labels(labels))
+
+
+def window_counts(alt_sub, vrt_sub, alt_thresh, vrt_thresh, backend=None):
+    """Count the points in a window that exceed the go-around thresholds.
+
+    Inputs:
+        -   An array of altitudes within the window
+        -   An array of vertical rates within the window
+        -   A float altitude threshold
+        -   A float vertical rate threshold
+        -   (optional) A string specifying the kernel backend
+    Returns:
+        -   The number of points above the altitude threshold
+        -   The number of points above the vertical rate threshold
+    """
+    kern = get_kernel('window_counts', backend)
+    n_alt, n_vrt = kern(np.asarray(alt_sub, dtype=np.float64),
+                        np.asarray(vrt_sub, dtype=np.float64),
+                        float(alt_thresh), float(vrt_thresh))
+    return int(n_alt), int(n_vrt)
+
+
+def gate_closest(lats, lons, gates, backend=None):
+    """Find the points closest to the gate of each runway.
+
+    Inputs:
+        -   An array of latitudes, or projected x positions
+        -   An array of longitudes, or projected y positions
+        -   A list of gate positions in the same coordinates and order
+        -   (optional) A string specifying the kernel backend
+    Returns:
+        -   An array of the minimum distance to each gate (NaN if no data)
+        -   An int array of the first point at that minimum (-1 if no data)
+        -   An array of the minimum distance once that point is excluded,
+            999 if there is no other point
+        -   An int array of the closest point once the first is excluded
+    """
+    kern = get_kernel('gate_closest', backend)
+    gates = np.asarray(gates, dtype=np.float64).reshape((-1, 2))
+    return kern(np.asarray(lats, dtype=np.float64),
+                np.asarray(lons, dtype=np.float64),
+                np.ascontiguousarray(gates[:, 0]),
+                np.ascontiguousarray(gates[:, 1]))
+
+
+def check_parity(n_trials=200, seed=1):
+    """Check that all available backends give identical results.
+
+    Random synthetic tracks are passed through every kernel using each
+    backend, and the gate search is also compared against a port of the
+    original code. Any mismatch raises an AssertionError.
+    Inputs:
+        -   (optional) An int specifying the number of random trials
+        -   (optional) An int seed for the random number generator
+    Returns:
+        -   A list of the backends that were compared
+    """
+    backends = ['python', 'numpy']
+    if (have_numba):
+        backends.append('numba')
+    rng = np.random.default_rng(seed)
+    phases = np.array(['GND', 'CL', 'CR', 'DE', 'LVL', 'NA'])
+
+    for trial in range(0, n_trials):
+        npts = int(rng.integers(1, 400))
+        labels = phases[rng.integers(0, 3, size=npts)]
+        alts = rng.uniform(-500., 25000., size=npts)
+        rocs = rng.uniform(-2000., 2000., size=npts)
+        lats = 19.09 + rng.normal(0, 0.1, size=npts)
+        lons = 72.86 + rng.normal(0, 0.1, size=npts)
+        # Repeated positions and missing data both need to match
+        if (npts > 4):
+            lats[1] = lats[3]
+            lons[1] = lons[3]
+            lats[rng.integers(0, npts)] = np.nan
+        gates = [list(rng.normal([19.09, 72.86], 0.1))
+                 for i in range(0, int(rng.integers(1, 6)))]
+        gates.append([lats[-1], lons[-1]])
+
+        res = {}
+        for backend in backends:
+            res[backend] = (label_changes(labels, backend),
+                            window_counts(alts, rocs, CNS.alt_thresh,
+                                          CNS.vrt_thresh, backend),
+                            gate_closest(lats, lons, gates, backend))
+        gts = np.asarray(gates, dtype=np.float64)
+        ref = res[backends[0]]
+        with np.errstate(invalid='ignore'):
+            ref_gate = _gate_closest_ref(lats, lons, gts[:, 0], gts[:, 1])
+        for i in range(0, 4):
+            assert np.array_equal(ref_gate[i], ref[2][i],
+                                  equal_nan=True), ('gate_closest', trial)
+        for backend in backends[1:]:
+            cur = res[backend]
+            assert np.array_equal(ref[0], cur[0]), ('label_changes', trial)
+            assert ref[1] == cur[1], ('window_counts', trial)
+            for i in range(0, 4):
+                assert np.array_equal(ref[2][i], cur[2][i],
+                                      equal_nan=True), ('gate_closest', trial)
+    return backends
+
+
+if __name__ == '__main__':
+    print("Kernel backends with identical results:", check_parity())
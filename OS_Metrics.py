@@ -0,0 +1,196 @@
+"""Live throughput and utilisation metrics for long processing runs.
+
+Metrics are held by a 'metrics' class in the main process and exported in
+the Prometheus text format. They can be written to a file, rewritten
+every few seconds by a background thread, and/or served over HTTP on a
+local port so that a run can be monitored while it is in progress.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import threading
+import resource
+import time
+import os
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+lat_buckets = [0.01, 0.05, 0.1, 0.5, 1., 5., 10., 30., 60., 300., 1800.]
+
+
+def get_rss():
+    """Return the resident memory of this process in bytes."""
+    try:
+        with open('/proc/self/status', 'r') as fid:
+            for line in fid:
+                if (line.startswith('VmRSS:')):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Not available, so use the peak instead (kB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class metrics:
+    """Counters, gauges and latency histograms for a processing run.
+
+    n_workers = number of worker processes, used for the busy ratio
+    counters = dict of name -> (help, value), values only ever increase
+    gauges = dict of name -> (help, value), values can go up or down
+    hists = dict of stage name -> list of bucket counts, sum and count
+    events = dict of event name -> count, as recorded by OS_Stats
+    """
+
+    def __init__(self, n_workers):
+        """Setup the class."""
+        self.n_workers = n_workers
+        self.t_start = time.time()
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.hists = {}
+        self.events = {}
+        self._stop = None
+        self._thread = None
+        self._server = None
+
+    def inc(self, name, val=1, hlp=''):
+        """Increase a counter."""
+        with self.lock:
+            old = self.counters.get(name, (hlp, 0))
+            self.counters[name] = (old[0], old[1] + val)
+
+    def set(self, name, val, hlp=''):
+        """Set the value of a gauge."""
+        with self.lock:
+            old = self.gauges.get(name, (hlp, 0))
+            self.gauges[name] = (old[0] or hlp, val)
+
+    def observe(self, stage, secs):
+        """Add a latency, in seconds, to the histogram of a stage."""
+        with self.lock:
+            if (stage not in self.hists):
+                self.hists[stage] = [[0] * len(lat_buckets), 0., 0]
+            hist = self.hists[stage]
+            for i, bnd in enumerate(lat_buckets):
+                if (secs <= bnd):
+                    hist[0][i] += 1
+            hist[1] += secs
+            hist[2] += 1
+
+    def add_events(self, cnts):
+        """Add a dict of event counts, such as from OS_Stats.run_counted()."""
+        with self.lock:
+            for name in cnts:
+                self.events[name] = self.events.get(name, 0) + cnts[name]
+
+    def _derived(self):
+        """Update the gauges that are computed from other metrics."""
+        elapsed = max(time.time() - self.t_start, 1e-6)
+        busy = self.counters.get('ga_worker_busy_seconds_total', ('', 0))[1]
+        n_file = self.counters.get('ga_files_total', ('', 0))[1]
+        n_fl = self.counters.get('ga_flights_total', ('', 0))[1]
+        self.gauges['ga_uptime_seconds'] = ('Time since the run started',
+                                            elapsed)
+        self.gauges['ga_files_per_second'] = ('Mean file throughput',
+                                              n_file / elapsed)
+        self.gauges['ga_flights_per_second'] = ('Mean flight throughput',
+                                                n_fl / elapsed)
+        self.gauges['ga_worker_busy_ratio'] = (
+            'Fraction of worker time spent processing flights',
+            busy / (elapsed * self.n_workers))
+        self.gauges['ga_rss_bytes'] = ('Resident memory of the main process',
+                                       get_rss())
+        child = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        self.gauges['ga_worker_peak_rss_bytes'] = (
+            'Peak resident memory of any finished worker', child * 1024)
+
+    def export(self):
+        """Return all the metrics in the Prometheus text format."""
+        lines = []
+        with self.lock:
+            self._derived()
+            for name in sorted(self.counters):
+                hlp, val = self.counters[name]
+                lines.append('# HELP ' + name + ' ' + hlp)
+                lines.append('# TYPE ' + name + ' counter')
+                lines.append(name + ' ' + repr(float(val)))
+            for name in sorted(self.gauges):
+                hlp, val = self.gauges[name]
+                lines.append('# HELP ' + name + ' ' + hlp)
+                lines.append('# TYPE ' + name + ' gauge')
+                lines.append(name + ' ' + repr(float(val)))
+            name = 'ga_stage_seconds'
+            lines.append('# HELP ' + name + ' Latency of each stage')
+            lines.append('# TYPE ' + name + ' histogram')
+            for stage in sorted(self.hists):
+                bcnt, tsum, tcnt = self.hists[stage]
+                lab = 'stage="' + stage + '"'
+                for i, bnd in enumerate(lat_buckets):
+                    lines.append(name + '_bucket{' + lab + ',le="' +
+                                 repr(bnd) + '"} ' + str(bcnt[i]))
+                lines.append(name + '_bucket{' + lab + ',le="+Inf"} ' +
+                             str(tcnt))
+                lines.append(name + '_sum{' + lab + '} ' + repr(tsum))
+                lines.append(name + '_count{' + lab + '} ' + str(tcnt))
+            name = 'ga_events_total'
+            lines.append('# HELP ' + name + ' Decisions made for flights')
+            lines.append('# TYPE ' + name + ' counter')
+            for evt in sorted(self.events):
+                lines.append(name + '{event="' + evt + '"} ' +
+                             str(self.events[evt]))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, outf):
+        """Write the metrics to a file, replacing it in a single step."""
+        tmpf = outf + '.tmp'
+        with open(tmpf, 'w') as fid:
+            fid.write(self.export())
+        os.replace(tmpf, outf)
+
+    def start(self, outf=None, port=None, interval=10.):
+        """Start exporting the metrics in the background.
+
+        Inputs:
+            -   (optional) A filename to rewrite every 'interval' seconds
+            -   (optional) A local port to serve the metrics on over HTTP
+            -   (optional) A float specifying the file rewrite interval
+        """
+        if (outf is not None):
+            self._stop = threading.Event()
+
+            def writer():
+                while (not self._stop.wait(interval)):
+                    self.write(outf)
+                self.write(outf)
+
+            self._thread = threading.Thread(target=writer, daemon=True)
+            self._thread.start()
+
+        if (port is not None):
+            mets = self
+
+            class handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = mets.export().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type',
+                                     'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self._server = HTTPServer(('127.0.0.1', port), handler)
+            threading.Thread(target=self._server.serve_forever,
+                             daemon=True).start()
+
+    def stop(self):
+        """Stop exporting, writing the file one final time."""
+        if (self._stop is not None):
+            self._stop.set()
+        if (self._thread is not None):
+            self._thread.join()
+            self._thread = None
+        if (self._server is not None):
+            self._server.shutdown()
@@ -5,8 +5,16 @@ import os
 # This line stops matplotlib messing up in terminal mode
 os.environ['QT_QPA_PLATFORM'] = 'offscreen'
 
-from matplotlib.lines import Line2D
-import matplotlib.pyplot as plt
+# matplotlib and scipy are slow to import, and most processes never plot,
+# so they are only imported by the functions that use them
+import OS_Envelope as OSE
+import OS_Compress as OSC
+import OS_Consts as CNS
+
+
+# The default colours used for each flight phase label
+colormap = {'GND': 'black', 'CL': 'green', 'CR': 'blue',
+            'DE': 'orange', 'LVL': 'purple', 'NA': 'red'}
 
 
 def do_plots(fd, spld, cmap, outdir, app_ylim=True,
@@ -17,7 +25,7 @@ def do_plots(fd, spld, cmap, outdir, app_ylim=True,
     This version saves data with time since first appearance in the
     datastream on the x-axis.
     Inputs:
-        -   A dict of flight data, such as that returned by preproc_data()
+        -   A flight_data class, such as that returned by preproc_data()
         -   A fict of splines, such as that returned by create_spline()
         -   A colour map, defined as a dict of classifications -> colors
         -   A string specifying the output directory
@@ -28,6 +36,9 @@ def do_plots(fd, spld, cmap, outdir, app_ylim=True,
     Returns:
         -   Nothing
     """
+    from matplotlib.lines import Line2D
+    import matplotlib.pyplot as plt
+
     if bpos is None:
         bpos = len(fd['time'])
 
@@ -175,7 +186,7 @@ def do_plots_dist(fd, spld, cmap, outdir,
     This version saves data with distance to detected landing runway on the
     x-axis.
     Inputs:
-        -   A dict of flight data, such as that returned by preproc_data()
+        -   A flight_data class, such as that returned by preproc_data()
         -   A fict of splines, such as that returned by create_spline()
         -   A colour map, defined as a dict of classifications -> colors
         -   A string specifying the output directory
@@ -187,14 +198,19 @@ def do_plots_dist(fd, spld, cmap, outdir,
     Returns:
         -   Nothing
     """
+    from matplotlib.lines import Line2D
+    import matplotlib.pyplot as plt
+
     if bpos is None:
         bpos = len(fd['time'])
 
     xlims = [-10., 0.1]
-    distlist = np.arange(xlims[0], xlims[1] + 0.01, 0.01)
     if (rwy is not None):
+        env = OSE.get_envelope(rwy)
+        distlist = env.dists
         hdglim = [rwy.mainhdg - 5, rwy.mainhdg + 5]
     else:
+        env = None
         hme = np.nanmean(fd['hdgs'])
         hdglim = [hme - 5, hme + 5]
 
@@ -217,10 +233,10 @@ def do_plots_dist(fd, spld, cmap, outdir,
                 marker='.',
                 c=colors,
                 lw=0)
-    if (rwy is not None):
-        yvals1 = make_yvals(distlist, rwy.alts1)
-        yvalm = make_yvals(distlist, rwy.altm)
-        yvalp1 = make_yvals(distlist, rwy.altp1)
+    # Not every runway has a fit for every channel
+    env_vals = None if (env is None) else env.get('alt')
+    if (env_vals is not None):
+        yvals1, yvalm, yvalp1 = env_vals
         plt.plot(distlist, yvals1/1000., '-', color='k', lw=0.1)
         plt.plot(distlist, yvalm/1000., '-', color='k', lw=0.1)
         plt.plot(distlist, yvalp1/1000., '-', color='k', lw=0.1)
@@ -249,10 +265,9 @@ def do_plots_dist(fd, spld, cmap, outdir,
                 marker='.',
                 c=colors,
                 lw=0)
-    if (rwy is not None):
-        yvals1 = make_yvals(distlist, rwy.rocs1)
-        yvalm = make_yvals(distlist, rwy.rocm)
-        yvalp1 = make_yvals(distlist, rwy.rocp1)
+    env_vals = None if (env is None) else env.get('roc')
+    if (env_vals is not None):
+        yvals1, yvalm, yvalp1 = env_vals
         plt.plot(distlist, yvals1/1000., '-', color='k', lw=0.1)
         plt.plot(distlist, yvalm/1000., '-', color='k', lw=0.1)
         plt.plot(distlist, yvalp1/1000., '-', color='k', lw=0.1)
@@ -306,10 +321,9 @@ def do_plots_dist(fd, spld, cmap, outdir,
                 marker='.',
                 c=colors,
                 lw=0)
-    if (rwy is not None):
-        yvals1 = make_yvals(distlist, rwy.hdgs1)
-        yvalm = make_yvals(distlist, rwy.hdgm)
-        yvalp1 = make_yvals(distlist, rwy.hdgp1)
+    env_vals = None if (env is None) else env.get('hdg')
+    if (env_vals is not None):
+        yvals1, yvalm, yvalp1 = env_vals
         plt.plot(distlist, yvals1, '-', color='k', lw=0.1)
         plt.plot(distlist, yvalm, '-', color='k', lw=0.1)
         plt.plot(distlist, yvalp1, '-', color='k', lw=0.1)
@@ -338,10 +352,9 @@ def do_plots_dist(fd, spld, cmap, outdir,
                 marker='.',
                 c=colors,
                 lw=0)
-    if (rwy is not None):
-        yvals1 = make_yvals(distlist, rwy.lons1)
-        yvalm = make_yvals(distlist, rwy.lonm)
-        yvalp1 = make_yvals(distlist, rwy.lonp1)
+    env_vals = None if (env is None) else env.get('lon')
+    if (env_vals is not None):
+        yvals1, yvalm, yvalp1 = env_vals
         plt.plot(distlist, yvals1, '-', color='k', lw=0.1)
         plt.plot(distlist, yvalm, '-', color='k', lw=0.1)
         plt.plot(distlist, yvalp1, '-', color='k', lw=0.1)
@@ -369,10 +382,9 @@ def do_plots_dist(fd, spld, cmap, outdir,
                 marker='.',
                 c=colors,
                 lw=0)
-    if (rwy is not None):
-        yvals1 = make_yvals(distlist, rwy.lats1)
-        yvalm = make_yvals(distlist, rwy.latm)
-        yvalp1 = make_yvals(distlist, rwy.latp1)
+    env_vals = None if (env is None) else env.get('lat')
+    if (env_vals is not None):
+        yvals1, yvalm, yvalp1 = env_vals
         plt.plot(distlist, yvals1, '-', color='k', lw=0.1)
         plt.plot(distlist, yvalm, '-', color='k', lw=0.1)
         plt.plot(distlist, yvalp1, '-', color='k', lw=0.1)
@@ -396,16 +408,21 @@ def do_plots_dist(fd, spld, cmap, outdir,
     plt.clf()
 
 
-def to_numpy(fd, outdir):
+def to_numpy(fd, outdir, packed=None):
     """Save data for a single flight into a numpy pickle file.
 
     Files are saved in a YYYYMMDD subdirectory.
     Inputs:
-        -   fd: Dict containing flight info
+        -   fd: flight_data class containing flight info
         -   outdir: Location to store output
+        -   packed: (optional) A bool specifying whether to compress the
+            flight with OS_Compress into a .npz file. If None, the value of
+            compress_out in OS_Consts is used.
     Returns:
         -   Nothing
     """
+    if (packed is None):
+        packed = CNS.compress_out
     odir = outdir + fd['stop'].strftime("%Y%m%d") + '/'
     if (not os.path.exists(odir)):
         try:
@@ -415,4 +432,63 @@ def to_numpy(fd, outdir):
     outf = odir + 'FLT_' + fd['ic24'] + '_'
     outf = outf + fd['call'] + '_'
     outf = outf + fd['stop'].strftime("%Y%m%d%H%m") + '.pkl'
-    np.save(outf, fd)
+    if (packed):
+        OSC.save_flight(fd, outf + '.npz')
+        return
+    # Wrap in a 0-d array so numpy doesn't treat the class as a sequence
+    arr = np.empty((), dtype=object)
+    arr[()] = fd
+    np.save(outf, arr)
+
+
+def from_numpy(inf):
+    """Load the data for a single flight saved by to_numpy().
+
+    Compressed flights are returned as an OS_Compress.packed_flight, which
+    reconstructs each column when it is first used.
+    Input:
+        -   inf: The filename of the saved flight
+    Returns:
+        -   A flight_data or packed_flight class containing flight info
+    """
+    if (inf.endswith('.npz')):
+        return OSC.packed_flight(inf)
+    return np.load(inf, allow_pickle=True).item()
+
+
+def create_spline(fd, bpos=None):
+    """Create the splines needed for plotting smoothed lines on the output graphs.
+
+    Input:
+        -   A flight_data class, such as that returned by preproc_data()
+        -   An int speicfying the max array value to use
+    Returns:
+        A dict containing:
+        -   altspl
+        -   spdspl
+        -   rocspl
+        -   galspl
+        -   hdgspl
+
+    """
+    from scipy.interpolate import UnivariateSpline as UniSpl
+
+    spldict = {}
+    if (bpos is None):
+        bpos = len(fd['time'])
+    spldict['altspl'] = UniSpl(fd['time'][0: bpos],
+                               fd['alts'][0: bpos])(fd['time'][0: bpos])
+    spldict['spdspl'] = UniSpl(fd['time'][0: bpos],
+                               fd['spds'][0: bpos])(fd['time'][0: bpos])
+    spldict['rocspl'] = UniSpl(fd['time'][0: bpos],
+                               fd['rocs'][0: bpos])(fd['time'][0: bpos])
+    spldict['galspl'] = UniSpl(fd['time'][0: bpos],
+                               fd['gals'][0: bpos])(fd['time'][0: bpos])
+    spldict['hdgspl'] = UniSpl(fd['time'][0: bpos],
+                               fd['hdgs'][0: bpos])(fd['time'][0: bpos])
+    spldict['latspl'] = UniSpl(fd['time'][0: bpos],
+                               fd['lats'][0: bpos])(fd['time'][0: bpos])
+    spldict['lonspl'] = UniSpl(fd['time'][0: bpos],
+                               fd['lons'][0: bpos])(fd['time'][0: bpos])
+
+    return spldict
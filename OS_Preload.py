@@ -0,0 +1,94 @@
+"""Modules and data that are loaded once, before any worker starts.
+
+The supervised pool in OS_Supervise starts a 'forkserver' that imports
+this module, and every worker is then forked from it with these modules
+already imported. The airports named in the GA_PRELOAD_AIRPORTS
+environment variable (comma separated ICAO codes) are also loaded, along
+with the METAR table of the first of them.
+
+Running this file as a script checks that importing OS_Funcs in a new
+process stays within the time budget in OS_Consts, and that none of the
+slow, optional libraries are imported along with it.
+"""
+import OS_Airports as OSA
+import OS_Supervise as OSV
+import OS_Consts as CNS
+import OS_Funcs as OSF
+import subprocess
+import json
+import sys
+import os
+
+
+# Libraries that should only be imported when they are used
+lazy_modules = ['matplotlib', 'scipy', 'traffic', 'flightphase', 'metar',
+                'numba']
+
+
+def preload_libraries():
+    """Import the slow libraries that every worker needs.
+
+    Every worker in the detection pool is sent 'traffic' flights, so the
+    workers need traffic even though OS_Funcs only imports it when used.
+    """
+    # Imported only for its side effect of loading traffic in the workers
+    import traffic.core  # noqa: F401
+
+
+def preload_airports(icaos):
+    """Load airports, and the METAR table of the first one.
+
+    Input:
+        -   A list of ICAO codes
+    """
+    for i, icao in enumerate(icaos):
+        apt = OSA.get_airport(icao)
+        if (i == 0):
+            OSF.use_metars(apt.metar_file)
+            OSF.get_metar_table()
+
+
+def check_import_time(module='OS_Funcs', budget=None):
+    """Time the import of a module in a new process.
+
+    Inputs:
+        -   (optional) The name of the module to import
+        -   (optional) The time budget in seconds, if None then
+            import_budget in OS_Consts is used
+    Returns:
+        -   The import time in seconds
+        -   A list of the lazy modules that were imported with it
+        -   A bool, True if the time is within budget and no lazy modules
+            were imported
+    """
+    if (budget is None):
+        budget = CNS.import_budget
+    code = ('import time, sys, json\n'
+            't0 = time.perf_counter()\n'
+            'import ' + module + '\n'
+            't1 = time.perf_counter()\n'
+            'print(json.dumps([t1 - t0, sorted(sys.modules)]))\n')
+    out = subprocess.check_output([sys.executable, '-c', code],
+                                  cwd=os.path.dirname(os.path.abspath(
+                                      __file__)), text=True)
+    t_imp, mods = json.loads(out.strip().splitlines()[-1])
+    loaded = [mod for mod in lazy_modules if mod in mods]
+    return t_imp, loaded, (t_imp <= budget and len(loaded) == 0)
+
+
+if (__name__ != '__main__'):
+    # Imported by the forkserver, rather than run to check import times
+    preload_libraries()
+if (os.environ.get(OSV.preload_env)):
+    preload_airports(os.environ[OSV.preload_env].split(','))
+
+
+if __name__ == '__main__':
+    mod = sys.argv[1] if (len(sys.argv) > 1) else 'OS_Funcs'
+    t_imp, loaded, ok = check_import_time(mod)
+    print('Importing', mod, 'took %.3f s, the budget is %.3f s' %
+          (t_imp, CNS.import_budget))
+    if (len(loaded) > 0):
+        print('These should only be imported when used:', loaded)
+    if (not ok):
+        sys.exit(1)
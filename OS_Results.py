@@ -0,0 +1,255 @@
+"""A results database holding every landing and go-around.
+
+Detections are written to an SQLite file in a single transaction per
+batch. Each flight is identified by its icao24 address and landing time
+(l_time), so re-processing the same data replaces the earlier rows rather
+than adding duplicates. Running this file as a script can query the
+database or export it in the same CSV layout as GA_Detect.py.
+"""
+import pandas as pd
+import sqlite3
+import click
+import time
+
+
+# Name and SQL type of each column, times are in seconds since 1970
+columns = [('icao24', 'TEXT NOT NULL'),
+           ('l_time', 'INTEGER NOT NULL'),
+           ('callsign', 'TEXT'),
+           ('airport', 'TEXT'),
+           ('rwy', 'TEXT'),
+           ('is_ga', 'INTEGER'),
+           ('ga_time', 'INTEGER'),
+           ('hdg', 'REAL'),
+           ('alt', 'REAL'),
+           ('lat', 'REAL'),
+           ('lon', 'REAL'),
+           ('gapt', 'INTEGER'),
+           ('rocvar', 'REAL'),
+           ('hdgvar', 'REAL'),
+           ('latvar', 'REAL'),
+           ('lonvar', 'REAL'),
+           ('gspvar', 'REAL'),
+           ('temp', 'REAL'),
+           ('dewp', 'REAL'),
+           ('w_s', 'REAL'),
+           ('w_g', 'REAL'),
+           ('w_d', 'REAL'),
+           ('cld', 'REAL'),
+           ('cb', 'INTEGER'),
+           ('vis', 'REAL'),
+           ('pres', 'REAL'),
+           ('source', 'TEXT'),
+           ('updated', 'INTEGER')]
+
+col_names = [name for name, ctype in columns]
+
+# The METAR values, these are NULL if no METAR was found for the flight
+met_names = ['temp', 'dewp', 'w_s', 'w_g', 'w_d', 'cld', 'cb', 'vis', 'pres']
+
+_schema = ['CREATE TABLE IF NOT EXISTS detections (' +
+           ', '.join(name + ' ' + ctype for name, ctype in columns) +
+           ', PRIMARY KEY (icao24, l_time))',
+           'CREATE INDEX IF NOT EXISTS det_time ON detections (l_time)',
+           'CREATE INDEX IF NOT EXISTS det_rwy ON detections '
+           '(airport, rwy, l_time)',
+           'CREATE INDEX IF NOT EXISTS det_call ON detections (callsign)']
+
+_upsert = ('INSERT INTO detections (' + ', '.join(col_names) + ') VALUES (' +
+           ', '.join('?' * len(col_names)) + ') '
+           'ON CONFLICT (icao24, l_time) DO UPDATE SET ' +
+           ', '.join(name + ' = excluded.' + name
+                     for name in col_names[2:]))
+
+
+def open_db(inf):
+    """Open the results database, creating it if needed.
+
+    Input:
+        -   The database filename
+    Returns:
+        -   An sqlite3 connection
+    """
+    conn = sqlite3.connect(inf)
+    # Readers are not blocked by a run that is writing results
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    with conn:
+        for cmd in _schema:
+            conn.execute(cmd)
+    return conn
+
+
+def _secs(t_val):
+    """Return a Timestamp as whole seconds since 1970."""
+    return int(pd.Timestamp(t_val).value // 1000000000)
+
+
+def det_row(det, icao, t_now=None):
+    """Convert a detection into a row of the database.
+
+    Inputs:
+        -   A detection class, from OS_Detect.detect()
+        -   The ICAO code of the airport
+        -   (optional) The time of the update, in seconds since 1970
+    Returns:
+        -   A tuple of values in the order of 'columns'
+    """
+    if (t_now is None):
+        t_now = int(time.time())
+    met = det.metar
+    if (met is not None):
+        mvals = [float(getattr(met, name)) for name in met_names]
+        mvals[met_names.index('cb')] = int(met.cb)
+    else:
+        mvals = [None] * len(met_names)
+    return tuple([det.icao24, _secs(det.l_time), det.callsign, icao, det.rwy,
+                  int(det.is_ga), _secs(det.ga_time), float(det.hdg),
+                  float(det.alt), float(det.lat), float(det.lon),
+                  int(det.gapt), float(det.rocvar), float(det.hdgvar),
+                  float(det.latvar), float(det.lonvar), float(det.gspvar)] +
+                 mvals + [det.source, t_now])
+
+
+def save_batch(conn, dets, icao):
+    """Write the detections from one batch in a single transaction.
+
+    Flights already in the database, with the same icao24 and l_time, are
+    updated rather than added again.
+    Inputs:
+        -   An sqlite3 connection, from open_db()
+        -   A list of detection classes, from OS_Detect.detect()
+        -   The ICAO code of the airport
+    """
+    t_now = int(time.time())
+    with conn:
+        conn.executemany(_upsert, [det_row(det, icao, t_now) for det in dets])
+
+
+def query(conn, apt=None, rwy=None, start=None, end=None, call=None,
+          is_ga=None, limit=None):
+    """Select detections from the database.
+
+    Inputs:
+        -   An sqlite3 connection, from open_db()
+        -   (optional) An airport ICAO code to select
+        -   (optional) A runway name to select
+        -   (optional) The earliest l_time to include, a datetime or string
+        -   (optional) The latest l_time to include, a datetime or string
+        -   (optional) A callsign to select, may include SQL wildcards (%)
+        -   (optional) A bool, True for go-arounds only, False for landings
+        -   (optional) An int maximum number of rows to return
+    Returns:
+        -   A dataframe of detections in time order, with l_time and
+            ga_time as UTC Timestamps
+    """
+    cond = []
+    args = []
+    if (apt is not None):
+        cond.append('airport = ?')
+        args.append(apt)
+    if (rwy is not None):
+        cond.append('rwy = ?')
+        args.append(rwy)
+    if (start is not None):
+        cond.append('l_time >= ?')
+        args.append(_secs(start))
+    if (end is not None):
+        cond.append('l_time <= ?')
+        args.append(_secs(end))
+    if (call is not None):
+        cond.append('callsign LIKE ?')
+        args.append(call)
+    if (is_ga is not None):
+        cond.append('is_ga = ?')
+        args.append(int(is_ga))
+    sql = 'SELECT * FROM detections'
+    if (len(cond) > 0):
+        sql = sql + ' WHERE ' + ' AND '.join(cond)
+    sql = sql + ' ORDER BY l_time'
+    if (limit is not None):
+        sql = sql + ' LIMIT ' + str(int(limit))
+    res = pd.read_sql_query(sql, conn, params=args)
+    for name in ('l_time', 'ga_time', 'updated'):
+        res[name] = pd.to_datetime(res[name], unit='s', utc=True)
+    return res
+
+
+def export_csv(conn, outf, is_ga, **kwargs):
+    """Export detections in the layout of GA_MET_NEW.csv / GA_NOGA_NEW.csv.
+
+    Inputs:
+        -   An sqlite3 connection, from open_db()
+        -   The output CSV filename
+        -   A bool, True to export go-arounds and False for landings
+        -   (optional) Any of the selections accepted by query()
+    Returns:
+        -   The number of rows written
+    """
+    res = query(conn, is_ga=is_ga, **kwargs)
+    t_frmt = "%Y/%m/%d %H:%M:%S"
+    # The same columns, in the same order, as GA_Detect.py writes
+    out = pd.DataFrame({'ICAO24': res['icao24'],
+                        'Callsign': res['callsign'],
+                        'GA_Time': res['l_time'].dt.strftime(t_frmt),
+                        'L_Time': res['ga_time'].dt.strftime(t_frmt),
+                        'Runway': res['rwy']})
+    if (is_ga):
+        for name, col in (('Heading', 'hdg'), ('Alt', 'alt'),
+                          ('Lat', 'lat'), ('Lon', 'lon')):
+            out[name] = res[col]
+    for name in ('gapt', 'rocvar', 'hdgvar', 'latvar', 'lonvar', 'gspvar'):
+        out[name] = res[name]
+    for name, col in (('Temp', 'temp'), ('Dewp', 'dewp'),
+                      ('Wind_Spd', 'w_s'), ('Wind_Gust', 'w_g'),
+                      ('Wind_Dir', 'w_d'), ('Cld_Base', 'cld'), ('CB', 'cb'),
+                      ('Vis', 'vis'), ('Pressure', 'pres')):
+        out[name] = res[col]
+    out['CB'] = out['CB'].astype('Int64')
+    out.to_csv(outf, index=False)
+    return len(out)
+
+
+@click.group()
+@click.argument('inf')
+@click.pass_context
+def main(ctx, inf):
+    """Query or export the results database."""
+    ctx.obj = open_db(inf)
+
+
+@main.command('query')
+@click.option('--airport', default=None)
+@click.option('--rwy', default=None)
+@click.option('--start', default=None, help="Start time, i.e: 2019-08-01")
+@click.option('--end', default=None)
+@click.option('--callsign', default=None, help="Callsign, % is a wildcard")
+@click.option('--ga/--landing', default=None,
+              help="Only go-arounds, or only normal landings")
+@click.option('--limit', default=50)
+@click.pass_obj
+def query_cmd(conn, airport, rwy, start, end, callsign, ga, limit):
+    """Print the detections that match a selection."""
+    res = query(conn, airport, rwy, start, end, callsign, ga, limit)
+    show = ['icao24', 'callsign', 'airport', 'rwy', 'is_ga', 'l_time',
+            'ga_time', 'w_s', 'vis']
+    with pd.option_context('display.max_rows', None, 'display.width', 160):
+        print(res[show])
+
+
+@main.command('export')
+@click.argument('outf')
+@click.option('--ga/--landing', default=True,
+              help="Export go-arounds (default), or normal landings")
+@click.option('--airport', default=None)
+@click.option('--start', default=None)
+@click.option('--end', default=None)
+@click.pass_obj
+def export_cmd(conn, outf, ga, airport, start, end):
+    """Export detections to CSV, in the layout of GA_Detect.py."""
+    n_row = export_csv(conn, outf, ga, apt=airport, start=start, end=end)
+    print("Wrote", n_row, "rows to", outf)
+
+
+if __name__ == '__main__':
+    main()
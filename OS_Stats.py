@@ -0,0 +1,126 @@
+"""Counters for the decisions made while processing flights.
+
+Every rejection or decision branch records a named event. Events are
+counted in a buffer in each process, which is returned alongside the
+result of each task (see run_counted) and merged centrally into per-batch
+and per-run histograms. Details of each event, i.e: the callsign, can also
+be written to an optional log, one file per process.
+"""
+from collections import Counter
+import time
+import sys
+import os
+
+
+# Event counts for this process, since the last call to take()
+counts = Counter()
+
+# Where to write verbose per-flight event details
+sink = sys.stdout
+
+
+def set_sink(prefix=None):
+    """Set where verbose event details are written in this process.
+
+    Input:
+        -   (optional) A filename prefix, each process writes to
+            <prefix>_<pid>.txt. If None, details are printed to stdout.
+    """
+    global sink
+    if (prefix is None):
+        sink = sys.stdout
+    else:
+        sink = open(prefix + '_' + str(os.getpid()) + '.txt', 'a')
+
+
+def event(name, *info, verbose=False):
+    """Count an event, and write its details if in verbose mode.
+
+    Inputs:
+        -   The name of the event, i.e: 'RWY_TOO_FAR'
+        -   Any details of the event, such as the callsign
+        -   (optional) A bool specifying whether to write the details
+    """
+    counts[name] += 1
+    if (verbose):
+        sink.write('\t-\t' + name + ': ' +
+                   ' '.join(str(inf) for inf in info) + '\n')
+
+
+def take():
+    """Return the event counts for this process, and reset them."""
+    out = dict(counts)
+    counts.clear()
+    return out
+
+
+def run_counted(func, *args):
+    """Run a function and return its result with the events it recorded.
+
+    This is intended to be called in pool workers, so that the counts
+    are returned to the main process along with the result.
+    Inputs:
+        -   The function to run
+        -   The arguments to pass to the function
+    Returns:
+        -   The result of the function
+        -   A dict of event name -> count
+        -   The time taken by the function in seconds
+    """
+    counts.clear()
+    t_start = time.perf_counter()
+    res = func(*args)
+    return res, take(), time.perf_counter() - t_start
+
+
+def format_hist(cnts, title):
+    """Format a dict of event counts as a text histogram.
+
+    Inputs:
+        -   A dict of event name -> count
+        -   A string title for the histogram
+    Returns:
+        -   A multi-line string
+    """
+    lines = [title]
+    if (len(cnts) == 0):
+        return title + '\n\t(no events)\n'
+    width = max(len(name) for name in cnts)
+    top = max(cnts.values())
+    for name in sorted(cnts):
+        bar = '#' * int(round(40. * cnts[name] / top))
+        lines.append('\t' + name.ljust(width) + ' ' +
+                     str(cnts[name]).rjust(8) + ' ' + bar)
+    return '\n'.join(lines) + '\n'
+
+
+class tally:
+    """Merge event counts from many tasks into batch and run totals.
+
+    batch = Counter of events in the current batch
+    run = Counter of events in all batches so far
+    n_batch = number of completed batches
+    """
+
+    def __init__(self):
+        """Setup the class."""
+        self.batch = Counter()
+        self.run = Counter()
+        self.n_batch = 0
+
+    def add(self, cnts):
+        """Add a dict of event counts to the current batch."""
+        self.batch.update(cnts)
+
+    def end_batch(self):
+        """Finish the current batch, returning its histogram as a string."""
+        self.n_batch += 1
+        self.run.update(self.batch)
+        out = format_hist(self.batch, 'Events in batch ' + str(self.n_batch))
+        self.batch = Counter()
+        return out
+
+    def report(self):
+        """Return the histogram for the whole run as a string."""
+        return format_hist(self.run, 'Events in run of ' +
+                           str(self.n_batch) + ' batches')
@@ -0,0 +1,259 @@
+"""A supervised pool of worker processes.
+
+Unlike multiprocessing.Pool, each task has a timeout. A worker that runs
+past the timeout, or that dies, is killed and replaced by a new one, and
+its task is retried a limited number of times. Tasks that still fail, or
+that raise an error, are added to a quarantine list along with the reason
+and traceback so that the rest of a batch can complete.
+
+Workers are started using the method set by start_method in OS_Consts.
+With 'forkserver' they are forked from a server process that has already
+imported the modules in preload_modules, see OS_Preload.
+"""
+from multiprocessing.connection import wait
+import multiprocessing as mp
+from collections import deque
+import OS_Consts as CNS
+import OS_Stats as OSS
+import traceback
+import json
+import time
+import os
+
+
+# The environment variable used to pass the airports to preload to the
+# forkserver, see OS_Preload
+preload_env = 'GA_PRELOAD_AIRPORTS'
+
+
+def get_context(preload=None):
+    """Return the multiprocessing context used to start the workers.
+
+    Input:
+        -   (optional) A list of ICAO codes of airports to load in the
+            forkserver. Only used when the forkserver is first started.
+    Returns:
+        -   A multiprocessing context
+    """
+    method = CNS.start_method
+    if (method not in mp.get_all_start_methods()):
+        method = None
+    ctx = mp.get_context(method)
+    if (ctx.get_start_method() == 'forkserver'):
+        if (preload):
+            os.environ[preload_env] = ','.join(preload)
+        ctx.set_forkserver_preload(CNS.preload_modules)
+    return ctx
+
+
+def _worker(conn, initializer, initargs):
+    """Run tasks sent by the supervisor until told to stop."""
+    if (initializer is not None):
+        initializer(*initargs)
+    while True:
+        msg = conn.recv()
+        if (msg is None):
+            break
+        tid, func, args = msg
+        try:
+            res = (True, func(*args))
+        except Exception:
+            res = (False, traceback.format_exc())
+        conn.send((tid, res))
+
+
+class _slot:
+    """A single worker process, and the task it is running.
+
+    proc = the worker process
+    conn = the connection used to send tasks and receive results
+    task = the (task number, key, args) being run, or None if idle
+    t_start = the time at which the current task was started
+    """
+
+    def __init__(self, ctx, initializer, initargs):
+        """Setup the class, starting a new worker."""
+        self.conn, child = ctx.Pipe()
+        self.proc = ctx.Process(target=_worker,
+                                args=(child, initializer, initargs),
+                                daemon=True)
+        self.proc.start()
+        child.close()
+        self.task = None
+        self.t_start = 0.
+
+    def kill(self):
+        """Stop the worker immediately."""
+        self.proc.terminate()
+        self.proc.join(5)
+        if (self.proc.is_alive()):
+            self.proc.kill()
+            self.proc.join()
+        self.conn.close()
+
+
+class supervisor:
+    """A pool of worker processes with timeouts, retries and quarantine.
+
+    processes = number of worker processes
+    retries = number of times to retry a task that times out or crashes
+    quarantine = list of dicts describing each failed task
+    qfile = (optional) a file to append quarantined tasks to, as JSON lines
+    preload = (optional) a list of ICAO codes of airports to load before
+              the workers start, see get_context()
+    """
+
+    def __init__(self, processes, retries=None, initializer=None,
+                 initargs=(), qfile=None, preload=None):
+        """Setup the class, starting the workers."""
+        self.processes = processes
+        self.retries = CNS.task_retries if retries is None else retries
+        self.initializer = initializer
+        self.initargs = initargs
+        self.qfile = qfile
+        self.quarantine = []
+        self.ctx = get_context(preload)
+        self.slots = [self._spawn() for i in range(0, processes)]
+
+    def _spawn(self):
+        """Start a new worker."""
+        return _slot(self.ctx, self.initializer, self.initargs)
+
+    def _send(self, i, msg):
+        """Send a task to a worker, replacing the worker if it has died.
+
+        Inputs:
+            -   The index of the worker in self.slots
+            -   The message to send
+        Returns:
+            -   The slot that the task was sent to
+        """
+        try:
+            self.slots[i].conn.send(msg)
+        except (EOFError, OSError):
+            # The worker died while idle, so start the task on a new one
+            OSS.event('WORKER_DIED_IDLE')
+            self.slots[i].kill()
+            self.slots[i] = self._spawn()
+            try:
+                self.slots[i].conn.send(msg)
+            except (EOFError, OSError):
+                # Left to the crash check in run(), which retries or
+                # quarantines the task
+                pass
+        return self.slots[i]
+
+    def _quarantine(self, key, reason, attempts, tback):
+        """Record a task that could not be completed.
+
+        Inputs:
+            -   The task key, a tuple of (icao24, callsign, source file)
+            -   A string giving the reason, 'ERROR', 'TIMEOUT' or 'CRASH'
+            -   The number of times the task was attempted
+            -   A string traceback or description of the failure
+        """
+        icao24, call, src = key
+        entry = {'icao24': icao24, 'callsign': call, 'source': src,
+                 'reason': reason, 'attempts': attempts,
+                 'traceback': tback}
+        self.quarantine.append(entry)
+        OSS.event('QUARANTINE_' + reason, icao24, call, src, verbose=True)
+        if (self.qfile is not None):
+            with open(self.qfile, 'a') as fid:
+                fid.write(json.dumps(entry) + '\n')
+
+    def run(self, func, tasks, timeout=None, costs=None):
+        """Run a function on a list of tasks, yielding results as they finish.
+
+        Results are yielded in the order they complete, not the order of
+        the tasks. Tasks that fail are quarantined and yield nothing. If
+        costs are given, the most costly tasks are started first so that
+        the workers finish at about the same time.
+        Inputs:
+            -   The function to run, must be importable by the workers
+            -   A list of (key, args) tuples, where key is a tuple of
+                (icao24, callsign, source file) used to identify the task
+                in the quarantine list, and args is a tuple of arguments
+            -   (optional) The timeout for each task in seconds, if None
+                then OS_Consts.task_timeout is used
+            -   (optional) A list of the estimated cost of each task
+        Yields:
+            -   The key of the task
+            -   The result of the function
+        """
+        if (timeout is None):
+            timeout = CNS.task_timeout
+        order = range(0, len(tasks))
+        if (costs is not None):
+            order = sorted(order, key=lambda tid: -costs[tid])
+        pending = deque((tid, tasks[tid]) for tid in order)
+        attempts = [0] * len(tasks)
+        n_busy = 0
+
+        while (len(pending) > 0 or n_busy > 0):
+            # Give a task to every idle worker
+            for i, slot in enumerate(self.slots):
+                if (slot.task is None and len(pending) > 0):
+                    tid, (key, args) = pending.popleft()
+                    attempts[tid] += 1
+                    slot = self._send(i, (tid, func, args))
+                    slot.task = (tid, key, args)
+                    slot.t_start = time.monotonic()
+                    n_busy += 1
+
+            busy = [slot for slot in self.slots if slot.task is not None]
+            t_now = time.monotonic()
+            t_wait = min(slot.t_start + timeout - t_now for slot in busy)
+            wait([slot.conn for slot in busy] +
+                 [slot.proc.sentinel for slot in busy], max(t_wait, 0.))
+
+            for i, slot in enumerate(self.slots):
+                if (slot.task is None):
+                    continue
+                tid, key, args = slot.task
+                reason = None
+                try:
+                    if (slot.conn.poll()):
+                        r_tid, (r_ok, res) = slot.conn.recv()
+                        slot.task = None
+                        n_busy -= 1
+                        if (r_ok):
+                            yield key, res
+                        else:
+                            self._quarantine(key, 'ERROR', attempts[tid],
+                                             res)
+                        continue
+                except (EOFError, OSError):
+                    pass
+                if (not slot.proc.is_alive()):
+                    reason = 'CRASH'
+                    tback = ('Worker exited with code ' +
+                             str(slot.proc.exitcode))
+                elif (time.monotonic() - slot.t_start > timeout):
+                    reason = 'TIMEOUT'
+                    tback = 'Timed out after ' + str(timeout) + ' seconds'
+                else:
+                    continue
+
+                # Replace the worker, then retry or quarantine the task
+                slot.kill()
+                self.slots[i] = self._spawn()
+                n_busy -= 1
+                OSS.event('WORKER_' + reason, key[1])
+                if (attempts[tid] <= self.retries):
+                    pending.append((tid, (key, args)))
+                else:
+                    self._quarantine(key, reason, attempts[tid], tback)
+
+    def close(self):
+        """Stop all the workers once they are idle."""
+        for slot in self.slots:
+            try:
+                slot.conn.send(None)
+            except (EOFError, OSError):
+                # Already stopped, it is joined or killed below
+                pass
+        for slot in self.slots:
+            slot.proc.join(10)
+            if (slot.proc.is_alive()):
+                slot.kill()
@@ -0,0 +1,318 @@
+"""Refit the runway approach envelopes from processed normal landings.
+
+The polynomial fits (mean and +/-1 sigma) of each runway in OS_Airports
+are fitted against distance to the runway threshold. This reads the
+normal landings saved by GA_Detect.py in OUT_DATA/NORM one flight at a
+time, and keeps only running sums for each runway and channel:
+    -   The normal equations of a least squares fit, for the mean.
+    -   A histogram in each distance bin, for the -1 and +1 sigma values.
+Each histogram has a fixed number of bins, which are merged in pairs to
+double their width whenever a value falls outside the range covered, so
+the memory used does not depend on the number of flights. The new fits
+are written into the airport JSON file.
+"""
+import OS_Airports as OSA
+import OS_Envelope as OSE
+import OS_Output as OSO
+import OS_Consts as CNS
+import numpy as np
+import click
+import glob
+import json
+import os
+
+
+# Degree of the polynomial fits, the airport files hold degree + 1 values
+degree = 6
+
+# Quantiles used for the -1 and +1 sigma fits, as for a normal distribution
+q_lo = 0.158655
+q_hi = 0.841345
+
+# Width of the distance bins that hold a histogram, in km
+bin_width = 0.1
+
+# Number of bins in each histogram
+n_hist = 256
+
+# Minimum number of points in a distance bin for it to be used in a fit
+min_count = 20
+
+# Starting bin width of the histograms for each channel. This is only the
+# finest resolution, the bins are widened as needed.
+hist_res = {'alt': 1., 'roc': 5., 'hdg': 0.02, 'gal': 1.,
+            'lat': 1e-6, 'lon': 1e-6}
+
+# Distances are divided by this before the mean is fitted, so that the
+# normal equations are well conditioned
+d_scale = 10.
+
+
+class profile:
+    """Running sums for refitting the envelopes of one runway.
+
+    name = Name of the runway
+    mainhdg = Heading of the runway, headings are unwrapped around this
+    n_fl = Number of flights added
+    dmin = Distance to threshold of the start of the first distance bin
+    xtx = array (n_chan, degree + 1, degree + 1) of the normal equations
+    xty = array (n_chan, degree + 1) of the normal equations
+    npts = array (n_chan) of the number of points used in each channel
+    lo = array (n_chan, n_dbin) of the lowest value covered by each histogram
+    width = array (n_chan, n_dbin) of the bin width of each histogram,
+            zero until the first value is added
+    counts = array (n_chan, n_dbin, n_hist) of the histogram counts
+    """
+
+    def __init__(self, rwy):
+        """Setup the class for a runway from OS_Airports."""
+        self.name = rwy.name
+        self.mainhdg = rwy.mainhdg
+        self.n_fl = 0
+        self.dmin = CNS.env_dist_min
+        n_dbin = int(np.ceil((CNS.env_dist_max - self.dmin) / bin_width))
+        n_chan = len(OSE.channels)
+        n_coef = degree + 1
+        self.xtx = np.zeros((n_chan, n_coef, n_coef), dtype=np.float64)
+        self.xty = np.zeros((n_chan, n_coef), dtype=np.float64)
+        self.npts = np.zeros(n_chan, dtype=np.int64)
+        self.lo = np.zeros((n_chan, n_dbin), dtype=np.float64)
+        self.width = np.zeros((n_chan, n_dbin), dtype=np.float64)
+        self.counts = np.zeros((n_chan, n_dbin, n_hist), dtype=np.int64)
+
+    def add_flight(self, fd):
+        """Add the points of one flight that are within the distance grid.
+
+        Input:
+            -   A flight_data or packed_flight class, which must include 'rdis'
+        """
+        dist = np.asarray(fd['rdis'], dtype=np.float64)
+        dbin = np.floor((dist - self.dmin) / bin_width)
+        in_grid = (dbin >= 0) & (dbin < self.lo.shape[1])
+        if (not np.any(in_grid)):
+            return
+        self.n_fl += 1
+        for i, chan in enumerate(OSE.channels):
+            key = OSE.channels[chan][0]
+            if (key not in fd):
+                continue
+            vals = np.asarray(fd[key], dtype=np.float64)
+            good = in_grid & np.isfinite(vals)
+            if (not np.any(good)):
+                continue
+            vals = vals[good]
+            if (chan == 'hdg'):
+                # Keep headings within 180 degrees of the runway heading
+                vals = ((vals - self.mainhdg + 180.) % 360. - 180. +
+                        self.mainhdg)
+            xmat = np.vander(dist[good] / d_scale, degree + 1)
+            self.xtx[i] += xmat.T @ xmat
+            self.xty[i] += xmat.T @ vals
+            self.npts[i] += len(vals)
+            self._add_hist(i, chan, dbin[good].astype(np.int64), vals)
+
+    def _add_hist(self, i, chan, dbin, vals):
+        """Add values to the histograms of one channel."""
+        n_dbin = self.lo.shape[1]
+        vmin = np.full(n_dbin, np.inf)
+        vmax = np.full(n_dbin, -np.inf)
+        np.minimum.at(vmin, dbin, vals)
+        np.maximum.at(vmax, dbin, vals)
+        used = np.isfinite(vmin)
+
+        # Centre new histograms on the first values they are given
+        new = used & (self.width[i] == 0)
+        self.width[i, new] = hist_res[chan]
+        self.lo[i, new] = ((vmin[new] + vmax[new]) / 2. -
+                           hist_res[chan] * n_hist / 2.)
+
+        # Widen any histograms that do not cover the new values
+        top = self.lo[i] + self.width[i] * n_hist
+        for j in (used & ((vmin < self.lo[i]) | (vmax >= top))).nonzero()[0]:
+            self._widen(i, j, vmin[j], vmax[j])
+
+        pos = np.floor((vals - self.lo[i, dbin]) / self.width[i, dbin])
+        pos = np.clip(pos.astype(np.int64), 0, n_hist - 1)
+        self.counts[i] += np.bincount(dbin * n_hist + pos,
+                                      minlength=n_dbin * n_hist).reshape(
+                                          (n_dbin, n_hist))
+
+    def _widen(self, i, j, vmin, vmax):
+        """Double the bin width of a histogram until it covers a range."""
+        hist = self.counts[i, j]
+        while True:
+            span = self.width[i, j] * n_hist
+            if (vmin < self.lo[i, j]):
+                left = True
+            elif (vmax >= self.lo[i, j] + span):
+                left = False
+            else:
+                break
+            merged = hist[0::2] + hist[1::2]
+            hist[:] = 0
+            if (left):
+                hist[n_hist // 2:] = merged
+                self.lo[i, j] -= span
+            else:
+                hist[:n_hist // 2] = merged
+            self.width[i, j] *= 2.
+
+    def quantiles(self, chan, qvals):
+        """Estimate quantiles of a channel in each distance bin.
+
+        Inputs:
+            -   The name of a channel, as in OS_Envelope.channels
+            -   A list of quantiles, between 0 and 1
+        Returns:
+            -   The distance at the centre of each bin that has at least
+                min_count points
+            -   The number of points in each of those bins
+            -   An array (n_quantiles, n_bins) of the quantile values
+        """
+        i = list(OSE.channels).index(chan)
+        totals = self.counts[i].sum(axis=1)
+        good = (totals >= min_count).nonzero()[0]
+        dists = self.dmin + (good + 0.5) * bin_width
+        cums = np.cumsum(self.counts[i, good], axis=1)
+        out = np.zeros((len(qvals), len(good)), dtype=np.float64)
+        for k, qval in enumerate(qvals):
+            target = qval * totals[good]
+            for n, j in enumerate(good):
+                pos = np.searchsorted(cums[n], target[n])
+                below = cums[n, pos - 1] if (pos > 0) else 0
+                frac = (target[n] - below) / self.counts[i, j, pos]
+                out[k, n] = self.lo[i, j] + (pos + frac) * self.width[i, j]
+        return dists, totals[good], out
+
+    def fit(self):
+        """Fit the mean and +/-1 sigma polynomials of every channel.
+
+        Channels without enough points are left out.
+        Returns:
+            -   A dict of runway attribute name -> list of degree + 1
+                polynomial coefficients, as used by OS_Airports
+        """
+        powers = np.arange(degree, -1, -1)
+        fits = {}
+        for i, chan in enumerate(OSE.channels):
+            dists, totals, qvals = self.quantiles(chan, [q_lo, q_hi])
+            if (self.npts[i] <= degree or len(dists) <= degree):
+                continue
+            coefs = np.linalg.lstsq(self.xtx[i], self.xty[i], rcond=None)[0]
+            mean = coefs / np.power(d_scale, powers)
+            wgts = np.sqrt(totals)
+            low = np.polyfit(dists, qvals[0], degree, w=wgts)
+            high = np.polyfit(dists, qvals[1], degree, w=wgts)
+            for attr, vals in zip(OSE.channels[chan][1], (low, mean, high)):
+                fits[attr] = [float('%.10g' % val) for val in vals]
+        return fits
+
+
+def list_flights(indir):
+    """List the flights saved by OS_Output.to_numpy() in a directory.
+
+    Where a flight has been compressed by OS_Compress, only the compressed
+    file is listed.
+    Input:
+        -   The directory to search, including subdirectories
+    Returns:
+        -   A sorted list of filenames
+    """
+    files = glob.glob(os.path.join(indir, '**', 'FLT_*.np[yz]'),
+                      recursive=True)
+    packed = set(inf for inf in files if inf.endswith('.npz'))
+    return sorted(inf for inf in files
+                  if (inf.endswith('.npz') or inf[:-4] + '.npz' not in packed))
+
+
+def train(indir, apt):
+    """Accumulate the profiles of every runway from the saved landings.
+
+    Inputs:
+        -   The directory holding the normal landings, i.e: OUT_DATA/NORM
+        -   An airport class, from OS_Airports.get_airport()
+    Returns:
+        -   A dict of runway name -> profile class
+    """
+    profs = {rwy.name: profile(rwy) for rwy in apt.rwy_list}
+    for inf in list_flights(indir):
+        try:
+            fd = OSO.from_numpy(inf)
+        except Exception as e:
+            print("Cannot read", inf, e)
+            continue
+        prof = profs.get(fd.get('rwy'))
+        if (prof is None or 'rdis' not in fd):
+            continue
+        prof.add_flight(fd)
+    return profs
+
+
+def _format_json(adef):
+    """Write an airport definition in the layout of the OS_Airports files."""
+    lines = ['{']
+    keys = [key for key in adef if key != 'runways']
+    for key in keys:
+        lines.append('  ' + json.dumps(key) + ': ' + json.dumps(adef[key]) +
+                     ',')
+    lines.append('  "runways": [')
+    for n, rdef in enumerate(adef['runways']):
+        lines.append('    {')
+        items = ['      ' + json.dumps(key) + ': ' + json.dumps(rdef[key])
+                 for key in rdef]
+        lines.append(',\n'.join(items))
+        lines.append('    }' + (',' if n < len(adef['runways']) - 1 else ''))
+    lines.append('  ]')
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+def update_airport(apt, profs, outf=None, min_flights=50):
+    """Write the new fits into the JSON file of an airport.
+
+    Inputs:
+        -   An airport class, from OS_Airports.get_airport()
+        -   A dict of runway name -> profile class, from train()
+        -   (optional) The output filename, by default the airport's file
+        -   (optional) The minimum number of flights for a runway's fits
+            to be replaced
+    Returns:
+        -   A dict of runway name -> list of the attributes replaced
+    """
+    if (outf is None):
+        outf = apt.src
+    with open(apt.src, 'r') as fid:
+        adef = json.load(fid)
+    done = {}
+    for rdef in adef['runways']:
+        prof = profs.get(rdef['name'])
+        if (prof is None or prof.n_fl < min_flights):
+            continue
+        fits = prof.fit()
+        rdef.update(fits)
+        done[rdef['name']] = sorted(fits)
+    with open(outf + '.tmp', 'w') as fid:
+        fid.write(_format_json(adef))
+    os.replace(outf + '.tmp', outf)
+    return done
+
+
+@click.command()
+@click.argument('indir')
+@click.option('--airport', default='VABB')
+@click.option('--outf', default=None,
+              help="Output JSON file, by default the airport's own file")
+@click.option('--min-flights', default=50,
+              help="Only refit runways with at least this many landings")
+def main(indir, airport, outf, min_flights):
+    """Refit the runway envelopes from the landings in INDIR."""
+    apt = OSA.get_airport(airport)
+    profs = train(indir, apt)
+    done = update_airport(apt, profs, outf, min_flights)
+    for name in profs:
+        print("Runway", name + ":", profs[name].n_fl, "flights,",
+              len(done.get(name, [])), "fits replaced")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,20 @@
 """Download data from Opensky.
 
 This script downloads data from the opensky library for a particular airport,
-a small perimeter is set up around the airport to catch the approach path
+a small perimeter is set up around the airport to catch the approach path.
+With '--backend fake' the data come from OS_FakeSky instead, for testing
+and timing the downloader without the real service.
 """
 
 from datetime import datetime, timedelta, timezone
-from importlib import import_module
-from traffic.data import opensky
 import multiprocessing as mp
-import numpy as np
+import OS_Airports as OSA
+import pandas as pd
+import hashlib
 import pathlib
 import click
+import json
+import time
 import os
 
 
@@ -24,57 +28,145 @@ def get_bounds(rwys):
 
     This function computes the boundaries of the retrieval
     'box' based upon the runways selected for processing.
-    The box is approx. 0.25 degrees in each direction around
-    the airport midpoint.
+    The box is approx. 0.45 degrees in each direction around
+    the airport midpoint, see OS_Airports.registry.
     """
-    latlist = []
-    lonlist = []
-    for rwy in rwys:
-        latlist.append(rwy.rwy[0])
-        lonlist.append(rwy.rwy[1])
-        latlist.append(rwy.rwy2[0])
-        lonlist.append(rwy.rwy2[1])
+    return OSA.registry.compute_bounds(rwys)
 
-    lat_ave = np.nanmean(latlist)
-    lon_ave = np.nanmean(lonlist)
-    bounds = [lon_ave - 0.45, lat_ave - 0.45,
-              lon_ave + 0.45, lat_ave + 0.45]
 
-    return bounds
+def hour_file(init_time, timer, anam, outdir, subdir):
+    """Get the time and output filename for one hour of data."""
+    times = init_time + timedelta(hours=timer)
+    dtst = times.strftime("%Y%m%d%H%M")
+    # Check if we're saving into YYYMMDD subdirectories
+    if subdir is True:
+        odir = outdir + times.strftime("%Y%m%d") + '/'
+    else:
+        odir = outdir
+    return times, odir + 'OS_' + dtst + '_' + anam + '.pkl'
 
 
-def getter(init_time, bounds, timer, anam, outdir, subdir):
+def file_record(outf, rows=None):
+    """Describe a downloaded file for the coverage manifest.
+
+    Inputs:
+        -   The filename
+        -   (optional) The number of rows in the file. If None, the file
+            is loaded to count them.
+    Returns:
+        -   A dict giving the status, rows, bytes and checksum of the file
+    """
+    if (rows is None):
+        rows = len(pd.read_pickle(outf))
+    sha = hashlib.sha1()
+    with open(outf, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(1 << 20), b''):
+            sha.update(chunk)
+    return {'status': 'OK', 'rows': rows, 'bytes': os.path.getsize(outf),
+            'sha1': sha.hexdigest(), 'file': outf}
+
+
+def load_manifest(mfile):
+    """Load the coverage manifest, a dict of hour -> record."""
+    if (not os.path.exists(mfile)):
+        return {}
+    with open(mfile, 'r') as fid:
+        return json.load(fid)
+
+
+def save_manifest(manifest, mfile):
+    """Save the coverage manifest, replacing the old one in a single step."""
+    with open(mfile + '.tmp', 'w') as fid:
+        json.dump(manifest, fid, indent=1, sort_keys=True)
+    os.replace(mfile + '.tmp', mfile)
+
+
+def needs_download(rec, outf, fill_gaps, min_rows):
+    """Check whether an hour should be downloaded.
+
+    Hours that are not in the manifest are always downloaded. Hours that
+    are in the manifest are only downloaded again in fill_gaps mode, and
+    only if they failed, are suspiciously small, or if the file is missing
+    or no longer matches its checksum.
+    Inputs:
+        -   The manifest record for the hour, or None
+        -   The filename for the hour
+        -   A bool specifying whether to fill gaps
+        -   The number of rows below which an hour is suspiciously small
+    Returns:
+        -   A string giving the reason to download, or None if not needed
+    """
+    if (rec is None):
+        return 'MISSING'
+    if (not fill_gaps):
+        return None
+    if (rec['status'] == 'FAILED'):
+        return 'FAILED'
+    if (rec['rows'] < min_rows):
+        return 'SMALL'
+    if (rec['status'] == 'OK'):
+        if (not os.path.exists(outf)):
+            return 'NO_FILE'
+        if (file_record(outf, rec['rows'])['sha1'] != rec['sha1']):
+            return 'CHECKSUM'
+    return None
+
+
+def get_source(anam, fake=None):
+    """Return the object whose history() method downloads the data.
+
+    Inputs:
+        -   The ICAO code of the airport
+        -   (optional) A dict of settings for OS_FakeSky.fake_opensky. If
+            None, the real OpenSky database is used.
+    Returns:
+        -   traffic.data.opensky, or an OS_FakeSky.fake_opensky class
+    """
+    if (fake is None):
+        from traffic.data import opensky
+        return opensky
+    import OS_FakeSky as OSFS
+    return OSFS.get_fake(anam, fake)
+
+
+def getter(init_time, bounds, timer, anam, outdir, subdir, fake=None):
     """Get data from the opensky server.
 
     This is done in one hour segments. Each hour is downloaded
     separately using multiprocessing for efficiency.
+    If 'fake' is a dict of settings, OS_FakeSky is used instead.
+    Returns:
+        -   The hour, as a YYYYMMDDHHMM string
+        -   A dict describing the result for the coverage manifest
     """
+    times, outf = hour_file(init_time, timer, anam, outdir, subdir)
+    dtst = times.strftime("%Y%m%d%H%M")
     try:
-        times = init_time + timedelta(hours=timer)
-        dtst = times.strftime("%Y%m%d%H%M")
-        # Check if we're saving into YYYMMDD subdirectories,
-        # create directories if necessary
-        if subdir is True:
-            odir = outdir + times.strftime("%Y%m%d") + '/'
-        else:
-            odir = outdir
+        odir = os.path.dirname(outf) or '.'
         pathlib.Path(odir).mkdir(parents=True, exist_ok=True)
-        outf = odir + 'OS_' + dtst + '_' + anam + '.pkl'
-
-        # Check if the file has already been retrieved
-        if (os.path.exists(outf)):
-            print("Already retrieved", outf)
-            return
-        # Otherwise use 'traffic' to download
-        flights = opensky.history(start=times,
-                                  stop=times+timedelta(hours=1),
-                                  bounds=bounds,
-                                  other_params=" and time-lastcontact<=15 ")
-        flights.to_pickle(outf)
+        # Use 'traffic' to download
+        flights = get_source(anam, fake).history(
+            start=times,
+            stop=times+timedelta(hours=1),
+            bounds=bounds,
+            other_params=" and time-lastcontact<=15 ")
+        if (flights is None):
+            return dtst, {'status': 'EMPTY', 'rows': 0, 'bytes': 0,
+                          'sha1': None, 'file': None}
+        # Write to a temporary file first, so that a failed or interrupted
+        # download never leaves a truncated file in place
+        flights.to_pickle(outf + '.tmp')
+        os.replace(outf + '.tmp', outf)
+        return dtst, file_record(outf, len(flights.data))
     except Exception as e:
         print("There is a problem with this date/time combination:", e, times)
+        return dtst, {'status': 'FAILED', 'rows': 0, 'bytes': 0,
+                      'sha1': None, 'file': None, 'error': str(e)}
+
 
-    return
+def _getter_star(args):
+    """Unpack the arguments for getter(), for use with imap_unordered."""
+    return getter(*args)
 
 
 @click.command()
@@ -84,22 +176,80 @@ def getter(init_time, bounds, timer, anam, outdir, subdir):
 @click.option('--outdir', default='INDATA/')
 @click.option('--subdir', default=True)
 @click.option('--n-jobs', default=1)
-def main(airport, start_dt, end_dt, outdir, subdir, n_jobs):
+@click.option('--fill-gaps', is_flag=True,
+              help="Download failed, small or damaged hours again")
+@click.option('--min-rows', default=100,
+              help="Hours with fewer rows are redownloaded by --fill-gaps")
+@click.option('--backend', default='opensky',
+              type=click.Choice(['opensky', 'fake']),
+              help="Download from OpenSky, or from the local OS_FakeSky")
+@click.option('--fake-opt', multiple=True,
+              help="A setting for OS_FakeSky, i.e: latency=2 or fail_rate=0.1")
+def main(airport, start_dt, end_dt, outdir, subdir, n_jobs, fill_gaps,
+         min_rows, backend, fake_opt):
     """Set up the processing and run."""
-    airport = import_module('OS_Airports.' + airport)
-    bounds = get_bounds(airport.rwy_list)
+    fake = None
+    if (backend == 'fake'):
+        import OS_FakeSky as OSFS
+        fake = OSFS.parse_opts(fake_opt)
+    airport = OSA.get_airport(airport)
+    bounds = airport.bounds
     start_dt = datetime.strptime(start_dt, '%Y-%m-%d').replace(
         tzinfo=timezone.utc)
     end_dt = datetime.strptime(end_dt, '%Y-%m-%d').replace(
         tzinfo=timezone.utc)
     hours = int((end_dt - start_dt).total_seconds() / 60 / 60 + 0.5)
 
+    # The manifest records the status, size and checksum of every hour
+    mfile = outdir + 'MANIFEST_' + airport.icao_name + '.json'
+    pathlib.Path(outdir).mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(mfile)
+
+    todo = []
+    for hour in range(hours):
+        times, outf = hour_file(start_dt, hour, airport.icao_name, outdir,
+                                subdir)
+        dtst = times.strftime("%Y%m%d%H%M")
+        # Files from before the manifest existed are added, not downloaded
+        if (dtst not in manifest and os.path.exists(outf)):
+            try:
+                manifest[dtst] = file_record(outf)
+            except Exception as e:
+                manifest[dtst] = {'status': 'FAILED', 'rows': 0, 'bytes': 0,
+                                  'sha1': None, 'file': None,
+                                  'error': str(e)}
+        reason = needs_download(manifest.get(dtst), outf, fill_gaps,
+                                min_rows)
+        if (reason is None):
+            continue
+        print("Retrieving", dtst, reason)
+        todo.append(hour)
+    save_manifest(manifest, mfile)
+    print("Need to retrieve", len(todo), "of", hours, "hours")
+
+    t_start = time.perf_counter()
     pool = mp.Pool(n_jobs)
+    args = [(start_dt, bounds, hour, airport.icao_name, outdir, subdir, fake)
+            for hour in todo]
+    # Record each hour as soon as it finishes, so an interrupted run
+    # keeps its progress
+    for dtst, rec in pool.imap_unordered(_getter_star, args):
+        rec['retrieved'] = datetime.now(timezone.utc).isoformat()
+        manifest[dtst] = rec
+        save_manifest(manifest, mfile)
+    pool.close()
+    print("Retrieved", len(todo), "hours in",
+          round(time.perf_counter() - t_start, 2), "seconds")
 
-    pool.starmap(getter, [
-        (start_dt, bounds, hour, airport.icao_name, outdir, subdir)
-        for hour in range(hours)
-        ])
+    n_stat = {}
+    for hour in range(hours):
+        times, outf = hour_file(start_dt, hour, airport.icao_name, outdir,
+                                subdir)
+        stat = manifest.get(times.strftime("%Y%m%d%H%M"),
+                            {'status': 'MISSING'})['status']
+        n_stat[stat] = n_stat.get(stat, 0) + 1
+    print("Coverage:", ', '.join(stat + ': ' + str(n_stat[stat])
+                                 for stat in sorted(n_stat)))
 
 
 if __name__ == '__main__':
@@ -1,12 +1,58 @@
 """A script for processing METAR data.
 
-This uses the metar library available at:
+Most reports are decoded by a compiled regular expression that only reads
+the fields needed here. Reports that it cannot handle are decoded using the
+metar library available at:
 https://github.com/python-metar/python-metar
+Running this file on a METAR archive compares the two parsers for speed
+and checks that they give identical results.
+
+Each archive is only parsed once. The results are cached on disk as a
+compact table, keyed by the archive's path, size and modification time,
+which every process then maps read-only rather than holding its own copy.
 """
 
 from datetime import datetime
-from metar import Metar
+import numpy as np
+import hashlib
+import time
 import pytz
+import sys
+import re
+import os
+
+
+# Location of the cached METAR tables
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'OS_Airports', 'cache')
+
+# Increment this if the contents of the METAR table change
+table_version = 1
+
+# The layout of the METAR table, time is in seconds since 1970
+table_dtype = np.dtype([('time', np.int64), ('temp', np.float64),
+                        ('dewp', np.float64), ('w_s', np.float64),
+                        ('w_d', np.float64), ('w_g', np.float64),
+                        ('cb', np.bool_), ('vis', np.float64),
+                        ('pres', np.float64), ('cld', np.float64)])
+
+
+# The common layout of a report, up to and including the pressure group.
+# Anything after this (trends, remarks) does not change the fields we use.
+# Reports that do not match are decoded by python-metar instead.
+_wx = (r'(?:[-+]|VC)?(?:MI|PR|BC|DR|BL|SH|TS|FZ)?'
+       r'(?:DZ|RA|SN|SG|IC|PL|GR|GS)*(?:BR|FG|FU|VA|DU|SA|HZ)?')
+fast_re = re.compile(
+    r'^(?:(?:METAR|SPECI) )?[A-Z][A-Z0-9]{3} \d{6}Z (?:AUTO |COR )?'
+    r'(?P<wdir>\d{3}|VRB)(?P<wspd>\d{2,3})(?:G(?P<gust>\d{2,3}))?(?:KT|MPS) '
+    r'(?:\d{3}V\d{3} )?'
+    r'(?:(?P<vis>\d{4})(?:[NSEW][EW]?)? |CAVOK )'
+    r'(?:R\d\d[LRC]?/[MP]?\d{4}(?:V[MP]?\d{4})?(?:FT)?[/NDU]* )*'
+    r'(?:(?=[-+A-Z]{2})' + _wx + r' )*'
+    r'(?P<sky>(?:(?:FEW|SCT|BKN|OVC)\d{3}(?:CB|TCU)? |VV\d{3} |'
+    r'(?:NSC|NCD|SKC|CLR) )*)'
+    r'(?P<temp>M?\d{2})/(?P<dewp>M?\d{2})? '
+    r'(?P<punit>Q|A)(?P<pres>\d{4})(?: |$)')
 
 
 class metobs:
@@ -36,83 +82,300 @@ class metobs:
         self.cld = cld
 
 
-def get_metars(inf, verbose):
+def parse_fast(mettxt):
+    """Decode a METAR using a regular expression, for the common layout.
+
+    Input:
+        -   The METAR text
+    Returns:
+        -   A metobs, or None if the report does not have the common layout
+    """
+    mat = fast_re.match(mettxt)
+    if (mat is None):
+        return None
+    temp = float(mat['temp'].replace('M', '-'))
+    if (mat['dewp'] is not None):
+        dewp = float(mat['dewp'].replace('M', '-'))
+    else:
+        dewp = 10
+    w_s = float(mat['wspd'])
+    w_g = float(mat['gust']) if (mat['gust'] is not None) else 0
+    w_d = float(mat['wdir']) if (mat['wdir'] != 'VRB') else 0
+    press = float(mat['pres'])
+    if (mat['punit'] == 'A'):
+        press = press / 100
+    if (mat['vis'] is None or mat['vis'] == '9999'):
+        vis = 10000.
+    else:
+        vis = float(mat['vis'])
+
+    sky = mat['sky'].split()
+    cb = False
+    cld = 10000
+    for layer in sky:
+        if (layer.endswith('CB')):
+            cb = True
+    if (len(sky) > 0 and sky[0][0:3] in ('FEW', 'SCT', 'BKN', 'OVC')):
+        cld = float(int(sky[0][3:6]) * 100)
+    elif (len(sky) > 0 and sky[0][0:2] == 'VV'):
+        cld = float(int(sky[0][2:5]) * 100)
+
+    return metobs(temp, dewp, w_s, w_d, w_g, cb, vis, press, cld)
+
+
+def parse_full(mettxt, verbose):
+    """Decode a METAR using the python-metar library.
+
+    Input:
+        -   The METAR text
+        -   A bool specifying whether to print decoding errors
+    Returns:
+        -   A metobs, with default values for any missing fields
+    """
+    # Only imported when needed, as most reports never reach this
+    from metar import Metar
+
+    obs = Metar.Metar(mettxt, strict=False)
+    try:
+        temp = obs.temp.value()
+    except Exception as e:
+        if verbose:
+            print("ERROR: Bad temperature data", e)
+        temp = 15
+    try:
+        dewp = obs.dewpt.value()
+    except Exception as e:
+        if verbose:
+            print("ERROR: Bad dewpoint data", e)
+        dewp = 10
+    try:
+        w_s = obs.wind_speed.value()
+    except Exception as e:
+        if verbose:
+            print("ERROR: Bad wind speed data", e)
+        w_s = 0
+    try:
+        w_g = obs.wind_gust.value()
+    except Exception as e:
+        if verbose:
+            print("ERROR: Bad wind gust data", e)
+        w_g = 0
+    try:
+        w_d = obs.wind_dir.value()
+    except Exception as e:
+        if verbose:
+            print("ERROR: Bad wind direction data", e)
+        w_d = 0
+    try:
+        press = obs.press.value()
+    except Exception as e:
+        if verbose:
+            print("ERROR: Bad pressure data", e)
+        press = 1013.25
+    try:
+        vis = obs.vis.value()
+    except Exception as e:
+        if verbose:
+            print("ERROR: Bad visibility data", e)
+        vis = 10000
+
+    cb = False
+    try:
+        for wx in obs.sky:
+            if (wx[2] == "CB"):
+                cb = True
+    except Exception as e:
+        if verbose:
+            print("ERROR: Bad CB data", e)
+
+    cld = 10000
+    if (len(obs.sky) > 0):
+        if obs.sky[0][1] is not None:
+            cld = obs.sky[0][1].value()
+
+    return metobs(temp, dewp, w_s, w_d, w_g, cb, vis, press, cld)
+
+
+def read_lines(inf):
+    """Read the date and METAR text from each line of a METAR file."""
+    out = []
+    with open(inf, 'r') as fid:
+        for line in fid:
+            data = line.rstrip('\n').split(',')
+            metdate = datetime.strptime(data[1], '%Y-%m-%d %H:%M')
+            metdate = metdate.replace(tzinfo=pytz.UTC)
+            out.append((metdate, data[2]))
+    return out
+
+
+def get_metars(inf, verbose, fast=True):
     """A function to parse metars from a file and convert into a dict of metobs objects.
     Input:
         -   inf: The input file (as a string filename)
+        -   verbose: A bool specifying whether to print decoding errors
+        -   fast: (optional) A bool specifying whether to use parse_fast()
+            for reports with the common layout
     Output:
         -   a dict of metobs read from the file
     """
-
-    fid = open(inf, 'r')
-
     met_dict = {}
 
-    for line in fid:
-        data = line.rstrip('\n').split(',')
-        metdate = datetime.strptime(data[1], '%Y-%m-%d %H:%M')
-        metdate = metdate.replace(tzinfo=pytz.UTC)
-        mettxt = data[2]
-        obs = Metar.Metar(mettxt, strict=False)
-        obs.time = metdate
-        try:
-            temp = obs.temp.value()
-        except Exception as e:
-            if verbose:
-                print("ERROR: Bad temperature data", e)
-            temp = 15
-        try:
-            dewp = obs.dewpt.value()
-        except Exception as e:
-            if verbose:
-                print("ERROR: Bad dewpoint data", e)
-            dewp = 10
-        try:
-            w_s = obs.wind_speed.value()
-        except Exception as e:
-            if verbose:
-                print("ERROR: Bad wind speed data", e)
-            w_s = 0
-        try:
-            w_g = obs.wind_gust.value()
-        except Exception as e:
-            if verbose:
-                print("ERROR: Bad wind gust data", e)
-            w_g = 0
-        try:
-            w_d = obs.wind_dir.value()
-        except Exception as e:
-            if verbose:
-                print("ERROR: Bad wind direction data", e)
-            w_d = 0
-        try:
-            press = obs.press.value()
-        except Exception as e:
-            if verbose:
-                print("ERROR: Bad pressure data", e)
-            press = 1013.25
-        try:
-            vis = obs.vis.value()
-        except Exception as e:
-            if verbose:
-                print("ERROR: Bad visibility data", e)
-            vis = 10000
-
-        cb = False
-        try:
-            for wx in obs.sky:
-                if (wx[2] == "CB"):
-                    cb = True
-        except Exception as e:
-            if verbose:
-                print("ERROR: Bad CB data", e)
-
-        cld = 10000
-        if (len(obs.sky) > 0):
-            if obs.sky[0][1] is not None:
-                cld = obs.sky[0][1].value()
-
-        cur_obs = metobs(temp, dewp, w_s, w_d, w_g, cb, vis, press, cld)
+    for metdate, mettxt in read_lines(inf):
+        cur_obs = None
+        if (fast):
+            cur_obs = parse_fast(mettxt)
+        if (cur_obs is None):
+            cur_obs = parse_full(mettxt, verbose)
         met_dict[metdate] = cur_obs
 
     return met_dict
+
+
+class metar_table:
+    """A read-only table of METAR observations, sorted by time.
+
+    tab = structured array with one row per METAR, see table_dtype
+    """
+
+    def __init__(self, tab):
+        """Setup the class."""
+        self.tab = tab
+        self.times = tab['time']
+
+    def __len__(self):
+        """Return the number of METARs in the table."""
+        return len(self.tab)
+
+    def get(self, i):
+        """Return a single row of the table as a metobs."""
+        row = self.tab[i]
+        return metobs(float(row['temp']), float(row['dewp']),
+                      float(row['w_s']), float(row['w_d']),
+                      float(row['w_g']), bool(row['cb']),
+                      float(row['vis']), float(row['pres']),
+                      float(row['cld']))
+
+    def closest(self, in_time):
+        """Find the METAR closest in time to a given time.
+
+        Input:
+            -   The time to match (a timezone-aware datetime)
+        Returns:
+            -   The closest METAR (as metobs), or None if the table is empty
+            -   The time difference in seconds
+        """
+        if (len(self.tab) == 0):
+            return None, 1e8
+        t_in = in_time.timestamp()
+        pos = int(np.searchsorted(self.times, t_in))
+        # The earlier METAR wins if both are equally close
+        pts = [pt for pt in (pos - 1, pos) if (0 <= pt < len(self.tab))]
+        bpt = min(pts, key=lambda pt: abs(self.times[pt] - t_in))
+        return self.get(bpt), abs(float(self.times[bpt]) - t_in)
+
+
+def build_table(inf, verbose=False):
+    """Parse a METAR archive into a table.
+
+    Inputs:
+        -   inf: The input file (as a string filename)
+        -   verbose: (optional) A bool specifying whether to print errors
+    Returns:
+        -   A structured array, see table_dtype
+    """
+    met_dict = get_metars(inf, verbose)
+    tab = np.zeros(len(met_dict), dtype=table_dtype)
+    for i, metdate in enumerate(sorted(met_dict)):
+        obs = met_dict[metdate]
+        tab[i] = (int(metdate.timestamp()), obs.temp, obs.dewp, obs.w_s,
+                  obs.w_d, obs.w_g, obs.cb, obs.vis, obs.pres, obs.cld)
+    return tab
+
+
+def load_table(inf, verbose=False):
+    """Load a METAR archive as a table, using the cache where possible.
+
+    The cache is rebuilt if the archive changes. The cached table is
+    memory-mapped read-only, so the same memory is shared by every
+    process that loads it.
+    Inputs:
+        -   inf: The input file (as a string filename)
+        -   verbose: (optional) A bool specifying whether to print errors
+    Returns:
+        -   A metar_table class
+    """
+    src = os.path.abspath(inf)
+    stat = os.stat(src)
+    path_key = hashlib.sha1(src.encode('utf-8')).hexdigest()[0:10]
+    state = (str(table_version) + ':' + str(stat.st_size) + ':' +
+             str(stat.st_mtime_ns))
+    state_key = hashlib.sha1(state.encode('utf-8')).hexdigest()[0:10]
+    cfile = os.path.join(cache_dir, 'METAR_' + path_key + '_' +
+                         state_key + '.npy')
+
+    if (not os.path.exists(cfile)):
+        tab = build_table(src, verbose)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmpf = cfile + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpf, 'wb') as fid:
+            np.save(fid, tab)
+        os.replace(tmpf, cfile)
+        # Remove tables made from older versions of this archive
+        prefix = 'METAR_' + path_key + '_'
+        for fname in os.listdir(cache_dir):
+            if (fname.startswith(prefix) and fname.endswith('.npy') and
+                    os.path.join(cache_dir, fname) != cfile):
+                os.remove(os.path.join(cache_dir, fname))
+
+    return metar_table(np.load(cfile, mmap_mode='r'))
+
+
+def check_parsers(inf):
+    """Compare the speed and results of the fast and full METAR parsers.
+
+    Every report in the file is decoded with both parsers, and the fields
+    of each metobs are compared.
+    Input:
+        -   The filename of a METAR archive
+    Returns:
+        -   A dict giving the number of reports, the number handled by
+            parse_fast(), the run time of each parser in seconds and a list
+            of (date, METAR, field) for each mismatch
+    """
+    lines = read_lines(inf)
+    fields = ['temp', 'dewp', 'w_s', 'w_d', 'w_g', 'cb', 'vis', 'pres', 'cld']
+
+    t_start = time.perf_counter()
+    fast = [parse_fast(mettxt) for metdate, mettxt in lines]
+    t_fast = time.perf_counter() - t_start
+    t_start = time.perf_counter()
+    full = [parse_full(mettxt, False) for metdate, mettxt in lines]
+    t_full = time.perf_counter() - t_start
+    # Time taken by get_metars(), with the fallback for unhandled reports
+    t_mix = t_fast + sum(t_full / max(len(lines), 1)
+                         for obs in fast if obs is None)
+
+    mismatch = []
+    for (metdate, mettxt), f_obs, p_obs in zip(lines, fast, full):
+        if (f_obs is None):
+            continue
+        for field in fields:
+            if (getattr(f_obs, field) != getattr(p_obs, field)):
+                mismatch.append((metdate, mettxt, field))
+
+    return {'n_rep': len(lines),
+            'n_fast': sum(obs is not None for obs in fast),
+            't_fast': t_fast, 't_full': t_full, 't_mix': t_mix,
+            'mismatch': mismatch}
+
+
+if __name__ == '__main__':
+    for inf in sys.argv[1:]:
+        res = check_parsers(inf)
+        print(inf + ':', res['n_rep'], "reports,", res['n_fast'],
+              "decoded by the fast parser")
+        print("\tpython-metar: %.2fs, fast with fallback: %.2fs (est.)" %
+              (res['t_full'], res['t_mix']))
+        print("\tMismatched fields:", len(res['mismatch']))
+        for metdate, mettxt, field in res['mismatch'][0:20]:
+            print("\t\t", metdate, field, mettxt)